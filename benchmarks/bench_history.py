@@ -0,0 +1,196 @@
+"""
+End to end throughput of GithubHistory.start against a local fake github.
+
+Starts benchmarks/fakegithub.py with a synthetic data set, runs a full
+history sync into every store and writes records/sec, api calls per
+record, peak RSS and time to first record to a json file.
+
+    python benchmarks/bench_history.py --repos 4 --issues 500 -o bench.json
+
+Mongo runs on mongomock when it is installed and is skipped otherwise.
+
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import platform
+from multiprocessing import Process, Queue
+
+from fakegithub import FakeGithubServer
+
+from gitdump import GithubHistory
+from gitdump import messagestore
+
+
+class FirstWrite(object):
+    """
+    Wraps a target to note when the first record reaches it
+
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.first = None
+        self.records = 0
+
+    def insert_many(self, records):
+        if self.first is None:
+            self.first = time.time()
+        self.records += len(records)
+
+        insert_many = getattr(self.target, "insert_many", None)
+        if insert_many:
+            return insert_many(records)
+
+        for r in records:
+            self.target.insert_msg(r)
+
+    def insert_msg(self, record):
+        self.insert_many([record])
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+def sqlite_target(tmp):
+    return messagestore.SQLiteStore(
+        os.path.join(tmp, "bench.db"), "bench", journal_mode="WAL", synchronous="NORMAL"
+    )
+
+
+def normalized_sqlite_target(tmp):
+    return messagestore.NormalizedSQLiteStore(
+        os.path.join(tmp, "bench.db"), "bench", journal_mode="WAL", synchronous="NORMAL"
+    )
+
+
+def mongo_target(tmp):
+    import mongomock
+
+    messagestore.MongoClient = mongomock.MongoClient
+    return messagestore.MongoStore("bench", "bench")
+
+
+def file_target(tmp):
+    return messagestore.FileStore(os.path.join(tmp, "dump"), compression="gzip")
+
+
+def memory_target(tmp):
+    return messagestore.MemoryStore()
+
+
+STORES = {
+    "sqlite": sqlite_target,
+    "sqlite-normalized": normalized_sqlite_target,
+    "mongo": mongo_target,
+    "file": file_target,
+    "memory": memory_target,
+}
+
+
+def run_store(name, base_url, args, results):
+    # tmpfs when there is one, so the numbers measure gitdump, not the disk
+    tmp = tempfile.mkdtemp(dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    try:
+        target = FirstWrite(STORES[name](tmp))
+        git = GithubHistory(
+            auth_token="bench",
+            base_url=base_url,
+            status_path=tmp + "/",
+            targets=[target],
+            workers=args.workers,
+            sync_mode=args.sync_mode,
+            engine=args.engine,
+        )
+        git.limiter.reserve = 0
+        if git.engine:
+            git.engine.limiter.reserve = 0
+
+        t = time.time()
+        git.start()
+        elapsed = time.time() - t
+        git.close()
+
+        results.put(
+            dict(
+                store=name,
+                seconds=elapsed,
+                records=target.records,
+                records_per_sec=target.records / elapsed if elapsed else 0,
+                time_to_first_record=(target.first or t) - t,
+                peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            )
+        )
+    except ImportError as e:
+        results.put(dict(store=name, skipped=str(e)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--orgs", type=int, default=1)
+    parser.add_argument("--repos", type=int, default=2)
+    parser.add_argument("--issues", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--sync_mode", choices=("issues", "incremental", "backfill"), default="issues"
+    )
+    parser.add_argument("--engine", choices=("rest", "graphql"), default="rest")
+    parser.add_argument(
+        "--stores", nargs="+", choices=sorted(STORES), default=sorted(STORES)
+    )
+    parser.add_argument("-o", "--output", default="bench_history.json")
+    args = parser.parse_args()
+
+    server = FakeGithubServer(
+        orgs=args.orgs, repos=args.repos, issues=args.issues, comments=args.comments
+    ).start()
+    data = server.data
+
+    report = dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        python=platform.python_version(),
+        scale=dict(
+            orgs=args.orgs, repos=args.repos, issues=args.issues, comments=args.comments
+        ),
+        sync_mode=args.sync_mode,
+        engine=args.engine,
+        workers=args.workers,
+        source_records=data.record_count,
+        results=[],
+    )
+
+    for name in args.stores:
+        server.calls = 0
+        results = Queue()
+
+        # every store runs in its own process so peak RSS is its own
+        p = Process(target=run_store, args=(name, server.base_url, args, results))
+        p.start()
+        result = results.get()
+        p.join()
+
+        if "skipped" not in result:
+            result["api_calls"] = server.calls
+            result["api_calls_per_record"] = server.calls / float(
+                max(result["records"], 1)
+            )
+
+        report["results"].append(result)
+        print(json.dumps(result, sort_keys=True))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+CPU cost per record of fanning records out to the targets.
+
+Compares the old write path (a deepcopy and a pool job per record and
+target, every target encoding the json itself) with
+GithubHistory.write_messages (one shared read-only record, json encoded
+once), writing to an SQLiteStore and a MemoryStore.
+
+    python benchmarks/bench_write.py -n 5000
+
+"""
+
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+from copy import deepcopy
+from multiprocessing.pool import ThreadPool
+
+from gitdump import GithubHistory
+from gitdump.messagestore import SQLiteStore, MemoryStore
+
+
+def make_record(i):
+    repo = dict(("repo_field_%d" % n, "value %d" % n) for n in range(80))
+    repo.update(id=1, full_name="org/repo", updated_at="2018-02-15T09:17:49Z")
+    org = dict(("org_field_%d" % n, "value %d" % n) for n in range(30))
+    org.update(id=2, login="org", updated_at="2018-02-15T09:17:49Z")
+    issue = dict(("issue_field_%d" % n, "value %d" % n) for n in range(40))
+    issue.update(
+        id=i // 10,
+        number=i // 10,
+        created_at="2018-02-15T09:17:49Z",
+        updated_at="2018-02-16T09:17:49Z",
+    )
+    comment = {"id": i, "body": "x" * 500, "updated_at": "2018-02-16T09:17:49Z"}
+
+    return {
+        "id": "record-%d" % i,
+        "repository": repo,
+        "organization": org,
+        "issue": issue,
+        "comment": comment,
+    }
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def legacy_write(pool, targets, msg):
+    # write path before records were shared between targets
+    jobs = [pool.apply_async(t.insert_msg, (deepcopy(msg),)) for t in targets]
+    for j in jobs:
+        j.wait()
+
+
+def measure(name, fn, records):
+    c, t = cpu(), time.time()
+    fn(records)
+    c, t = cpu() - c, time.time() - t
+
+    print(
+        "%-28s %8.1f us cpu/record %10.0f records/sec"
+        % (name, c / len(records) * 1e6, len(records) / t)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("-n", type=int, default=5000, help="records per run")
+    args = parser.parse_args()
+
+    records = [make_record(i) for i in range(args.n)]
+    status_path = tempfile.mkdtemp() + "/"
+
+    def targets():
+        return [SQLiteStore(":memory:", "bench"), MemoryStore()]
+
+    try:
+        pool = ThreadPool()
+        t = targets()
+        measure(
+            "deepcopy per target",
+            lambda rs: [legacy_write(pool, t, r) for r in rs],
+            records,
+        )
+
+        git = GithubHistory(status_path=status_path, targets=targets())
+        measure(
+            "shared record",
+            lambda rs: [git.write_messages([r]) for r in rs],
+            records,
+        )
+
+        git.close()
+
+        # a fresh history, its dedup cache would drop the records already
+        # written above
+        git = GithubHistory(status_path=status_path, targets=targets())
+        measure(
+            "shared record, batch of 100",
+            lambda rs: [
+                git.write_messages(rs[i : i + 100]) for i in range(0, len(rs), 100)
+            ],
+            records,
+        )
+        git.close()
+    finally:
+        shutil.rmtree(status_path)
+
+
+if __name__ == "__main__":
+    main()
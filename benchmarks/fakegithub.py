@@ -0,0 +1,482 @@
+"""
+Local stand-in for the parts of the github REST api gitdump uses.
+
+Serves synthetic organizations, repositories, issues and comments with
+pagination (Link headers), `since`/`state`/`sort`/`direction` filtering,
+rate-limit headers and ETag revalidation, and counts the calls it answers.
+
+POST /graphql answers the queries of gitdump's GraphQL engine, matched
+by their operationName (the query text itself is not parsed).
+
+    python benchmarks/fakegithub.py --repos 5 --issues 200 --comments 5
+
+"""
+
+import re
+import json
+import base64
+import time
+import hashlib
+import argparse
+import threading
+import urlparse
+from datetime import datetime, timedelta
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+EPOCH = datetime(2018, 1, 1)
+
+
+def ts(minutes):
+    return (EPOCH + timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeGithubData(object):
+    """
+    Synthetic data set: `orgs` organizations owning `repos` repositories
+    each, every repository with `issues` issues of `comments` comments, the
+    last `pulls` fraction of them pull requests.
+
+    """
+
+    def __init__(
+        self, base_url, orgs=1, repos=2, issues=50, comments=3, closed=0.2, pulls=0
+    ):
+        self.base_url = base_url
+        self.orgs = {}
+        self.repos = {}
+        self.issues = {}
+        self.comments = {}
+
+        comment_id = 0
+        for o in range(orgs):
+            login = "org%d" % o
+            self.orgs[login] = {
+                "id": 1000 + o,
+                "login": login,
+                "url": "%s/orgs/%s" % (base_url, login),
+                "description": "synthetic organization %d" % o,
+                "updated_at": ts(0),
+            }
+
+            for r in range(repos):
+                full_name = "%s/repo%d" % (login, r)
+                url = "%s/repos/%s" % (base_url, full_name)
+
+                repo_issues = []
+                for n in range(1, issues + 1):
+                    created = n * 10
+                    issue = {
+                        "id": len(self.issues) + 1,
+                        "number": n,
+                        "title": "issue %d of %s" % (n, full_name),
+                        "body": "synthetic issue body " * 10,
+                        "state": "closed" if n <= issues * closed else "open",
+                        "user": {"login": "user%d" % (n % 7), "id": n % 7},
+                        "url": "%s/issues/%d" % (url, n),
+                        "comments": comments,
+                        "labels": [],
+                        "assignee": None,
+                        "assignees": [],
+                        "milestone": None,
+                        "author_association": "NONE",
+                        "locked": False,
+                        "created_at": ts(created),
+                        "updated_at": ts(created + comments),
+                        "closed_at": None,
+                    }
+                    if n > issues * (1 - pulls):
+                        issue["pull_request"] = {
+                            "url": "%s/pulls/%d" % (url, n),
+                            "html_url": None,
+                            "diff_url": None,
+                            "patch_url": None,
+                        }
+                    self.issues[(full_name, n)] = issue
+                    repo_issues.append(issue)
+
+                    for c in range(comments):
+                        comment_id += 1
+                        self.comments[comment_id] = {
+                            "id": comment_id,
+                            "issue_url": issue["url"],
+                            "url": "%s/issues/comments/%d" % (url, comment_id),
+                            "body": "synthetic comment %d " % comment_id * 5,
+                            "user": {"login": "user%d" % (c % 7), "id": c % 7},
+                            "created_at": ts(created + c + 1),
+                            "updated_at": ts(created + c + 1),
+                        }
+
+                self.repos[full_name] = {
+                    "id": 2000 + len(self.repos),
+                    "name": "repo%d" % r,
+                    "full_name": full_name,
+                    "url": url,
+                    "owner": {"login": login, "id": 1000 + o, "type": "Organization"},
+                    "open_issues": sum(1 for i in repo_issues if i["state"] == "open"),
+                    "open_issues_count": sum(
+                        1 for i in repo_issues if i["state"] == "open"
+                    ),
+                    "created_at": ts(0),
+                    "updated_at": ts(0),
+                }
+
+    @property
+    def record_count(self):
+        return len(self.issues) + len(self.comments)
+
+
+class FakeGithubHandler(BaseHTTPRequestHandler):
+
+    ROUTES = [
+        (r"^/rate_limit$", "rate_limit"),
+        (r"^/user/repos$", "user_repos"),
+        (r"^/orgs/([^/]+)$", "org"),
+        (r"^/repos/([^/]+/[^/]+)$", "repo"),
+        (r"^/repos/([^/]+/[^/]+)/issues$", "issues"),
+        (r"^/repos/([^/]+/[^/]+)/issues/comments$", "repo_comments"),
+        (r"^/repos/([^/]+/[^/]+)/issues/(\d+)$", "issue"),
+        (r"^/repos/([^/]+/[^/]+)/issues/(\d+)/comments$", "issue_comments"),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.params = dict(urlparse.parse_qsl(url.query))
+
+        for pattern, name in self.ROUTES:
+            m = re.match(pattern, url.path)
+            if m:
+                status, body, links = getattr(self, name)(*m.groups())
+                return self.respond(status, body, links)
+
+        self.respond(404, {"message": "Not Found"})
+
+    def do_POST(self):
+        if self.path != "/graphql":
+            return self.respond(404, {"message": "Not Found"})
+
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length))
+        operation = getattr(self, "gql_%s" % body.get("operationName"), None)
+        if operation is None:
+            return self.respond(200, {"errors": [{"message": "unknown operation"}]})
+
+        data = operation(**body.get("variables") or {})
+        self.respond(200, {"data": data})
+
+    def gql_page(self, items, first, after):
+        start = int(base64.b64decode(after)) if after else 0
+        end = start + first
+        return {
+            "pageInfo": {
+                "hasNextPage": end < len(items),
+                "endCursor": base64.b64encode(str(end)),
+            },
+            "nodes": items[start:end],
+        }
+
+    def gql_actor(self, user):
+        return {
+            "__typename": "User",
+            "login": user["login"],
+            "databaseId": user["id"],
+            "url": None,
+        }
+
+    def gql_comments(self, issue, first, after=None):
+        items = [
+            c
+            for c in self.server.data.comments.values()
+            if c["issue_url"] == issue["url"]
+        ]
+        items.sort(key=lambda c: c["id"])
+
+        page = self.gql_page(items, first, after)
+        page["totalCount"] = len(items)
+        page["nodes"] = [
+            {
+                "databaseId": c["id"],
+                "body": c["body"],
+                "url": c["url"],
+                "createdAt": c["created_at"],
+                "updatedAt": c["updated_at"],
+                "author": self.gql_actor(c["user"]),
+                "authorAssociation": "NONE",
+            }
+            for c in page["nodes"]
+        ]
+        return page
+
+    def gql_repo(self, owner, name):
+        data = self.server.data
+        repo = data.repos.get("%s/%s" % (owner, name))
+        if repo is None:
+            return None
+
+        org = data.orgs[repo["owner"]["login"]]
+        return {
+            "databaseId": repo["id"],
+            "name": repo["name"],
+            "nameWithOwner": repo["full_name"],
+            "description": None,
+            "url": repo["url"],
+            "isPrivate": False,
+            "isFork": False,
+            "createdAt": repo["created_at"],
+            "updatedAt": repo["updated_at"],
+            "pushedAt": repo["updated_at"],
+            "owner": {
+                "__typename": "Organization",
+                "login": org["login"],
+                "databaseId": org["id"],
+                "description": org["description"],
+                "url": org["url"],
+                "createdAt": org["updated_at"],
+                "updatedAt": org["updated_at"],
+            },
+            "openIssues": {"totalCount": repo["open_issues"]},
+        }
+
+    def gql_issue(self, issue, comments):
+        pull = "pull_request" in issue
+        node = {
+            "__typename": "PullRequest" if pull else "Issue",
+            "databaseId": issue["id"],
+            "number": issue["number"],
+            "title": issue["title"],
+            "body": issue["body"],
+            "state": issue["state"].upper(),
+            "locked": False,
+            "url": issue["url"],
+            "createdAt": issue["created_at"],
+            "updatedAt": issue["updated_at"],
+            "closedAt": None,
+            "authorAssociation": "NONE",
+            "author": self.gql_actor(issue["user"]),
+            "assignees": {"nodes": []},
+            "labels": {"nodes": []},
+            "milestone": None,
+            "comments": self.gql_comments(issue, comments),
+        }
+        if pull:
+            node["mergedAt"] = None
+        return node
+
+    def gql_issues(self, repo, pulls, states):
+        return [
+            i
+            for (full_name, _), i in self.server.data.issues.items()
+            if full_name == repo["nameWithOwner"]
+            and ("pull_request" in i) == pulls
+            and (not states or i["state"].upper() in states)
+        ]
+
+    def gql_RepoIssues(
+        self, owner, name, first, comments, after=None, since=None, states=None
+    ):
+        repo = self.gql_repo(owner, name)
+        if repo is None:
+            return {"repository": None}
+
+        items = [
+            i
+            for i in self.gql_issues(repo, False, states)
+            if not since or i["updated_at"] >= since
+        ]
+        items.sort(key=lambda i: i["number"])
+
+        page = self.gql_page(items, first, after)
+        page["nodes"] = [self.gql_issue(i, comments) for i in page["nodes"]]
+        repo["issues"] = page
+        return {"repository": repo}
+
+    def gql_RepoPullRequests(
+        self, owner, name, first, comments, after=None, states=None
+    ):
+        repo = self.gql_repo(owner, name)
+        if repo is None:
+            return {"repository": None}
+
+        items = self.gql_issues(repo, True, states)
+        items.sort(key=lambda i: i["updated_at"], reverse=True)
+
+        page = self.gql_page(items, first, after)
+        page["nodes"] = [self.gql_issue(i, comments) for i in page["nodes"]]
+        repo["pullRequests"] = page
+        return {"repository": repo}
+
+    def gql_IssueComments(self, owner, name, number, first, after=None):
+        issue = self.server.data.issues.get(("%s/%s" % (owner, name), number))
+        if issue is None:
+            return {"repository": None}
+
+        return {
+            "repository": {
+                "issueOrPullRequest": {
+                    "comments": self.gql_comments(issue, first, after)
+                }
+            }
+        }
+
+    def respond(self, status, body, links=None):
+        server = self.server
+        data = json.dumps(body)
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+
+        # conditional requests that match don't count against the limit
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status, data = 304, ""
+        else:
+            with server.lock:
+                server.calls += 1
+                server.remaining = max(server.remaining - 1, 0)
+
+        with server.lock:
+            server.requests += 1
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("ETag", etag)
+        self.send_header("X-RateLimit-Limit", str(server.limit))
+        self.send_header("X-RateLimit-Remaining", str(server.remaining))
+        self.send_header("X-RateLimit-Reset", str(int(server.reset)))
+        if links:
+            self.send_header("Link", links)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def paginate(self, items):
+        per_page = int(self.params.get("per_page", 30))
+        page = int(self.params.get("page", 1))
+        chunk = items[(page - 1) * per_page : page * per_page]
+
+        def link(page, rel):
+            params = dict(self.params, page=page)
+            query = "&".join("%s=%s" % kv for kv in sorted(params.items()))
+            path = urlparse.urlparse(self.path).path
+            return '<%s%s?%s>; rel="%s"' % (self.server.data.base_url, path, query, rel)
+
+        links = None
+        if page * per_page < len(items):
+            last = (len(items) + per_page - 1) // per_page
+            links = ", ".join([link(page + 1, "next"), link(last, "last")])
+
+        return 200, chunk, links
+
+    def since(self, items):
+        since = self.params.get("since")
+        if since:
+            items = [i for i in items if i["updated_at"] >= since]
+        return items
+
+    def rate_limit(self):
+        s = self.server
+        core = {"limit": s.limit, "remaining": s.remaining, "reset": int(s.reset)}
+        return 200, {"resources": {"core": core}, "rate": core}, None
+
+    def user_repos(self):
+        return self.paginate(
+            sorted(self.server.data.repos.values(), key=lambda r: r["id"])
+        )
+
+    def org(self, login):
+        org = self.server.data.orgs.get(login)
+        return (200, org, None) if org else (404, {"message": "Not Found"}, None)
+
+    def repo(self, full_name):
+        repo = self.server.data.repos.get(full_name)
+        return (200, repo, None) if repo else (404, {"message": "Not Found"}, None)
+
+    def issues(self, full_name):
+        state = self.params.get("state", "open")
+        items = [
+            i
+            for (name, _), i in self.server.data.issues.items()
+            if name == full_name and state in ("all", i["state"])
+        ]
+
+        key = "updated_at" if self.params.get("sort") == "updated" else "number"
+        reverse = self.params.get("direction", "desc") == "desc"
+        items.sort(key=lambda i: i[key], reverse=reverse)
+
+        return self.paginate(self.since(items))
+
+    def issue(self, full_name, number):
+        issue = self.server.data.issues.get((full_name, int(number)))
+        return (200, issue, None) if issue else (404, {"message": "Not Found"}, None)
+
+    def repo_comments(self, full_name):
+        prefix = "%s/repos/%s/" % (self.server.data.base_url, full_name)
+        items = [
+            c
+            for c in self.server.data.comments.values()
+            if c["issue_url"].startswith(prefix)
+        ]
+
+        key = "updated_at" if self.params.get("sort") == "updated" else "id"
+        reverse = self.params.get("direction", "asc") == "desc"
+        items.sort(key=lambda c: c[key], reverse=reverse)
+
+        return self.paginate(self.since(items))
+
+    def issue_comments(self, full_name, number):
+        issue = self.server.data.issues.get((full_name, int(number)))
+        items = [
+            c
+            for c in self.server.data.comments.values()
+            if issue and c["issue_url"] == issue["url"]
+        ]
+        items.sort(key=lambda c: c["id"])
+        return self.paginate(self.since(items))
+
+
+class FakeGithubServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, port=0, limit=1000000, **scale):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeGithubHandler)
+        self.base_url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.data = FakeGithubData(self.base_url, **scale)
+
+        self.lock = threading.Lock()
+        self.limit = self.remaining = limit
+        self.reset = time.time() + 3600
+        self.calls = 0
+        self.requests = 0
+
+    def start(self):
+        th = threading.Thread(target=self.serve_forever)
+        th.daemon = True
+        th.start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--orgs", type=int, default=1)
+    parser.add_argument("--repos", type=int, default=2)
+    parser.add_argument("--issues", type=int, default=50)
+    parser.add_argument("--comments", type=int, default=3)
+    parser.add_argument("--pulls", type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeGithubServer(
+        args.port,
+        orgs=args.orgs,
+        repos=args.repos,
+        issues=args.issues,
+        comments=args.comments,
+        pulls=args.pulls,
+    )
+    print("Serving %d records on %s" % (server.data.record_count, server.base_url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
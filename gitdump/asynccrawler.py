@@ -0,0 +1,618 @@
+import re
+import sys
+import json
+import time
+import itertools
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+from tornado.concurrent import Future
+from tornado.httputil import url_concat
+from tornado.httpclient import HTTPError
+from github.MainClass import DEFAULT_BASE_URL
+from deeputil import Dummy
+
+from util import Record
+from ratelimit import RateLimiter
+import metrics
+
+DUMMY_LOG = Dummy()
+
+PER_PAGE = 100
+
+
+def next_link(link):
+    """
+    The rel="next" url of a Link header
+
+    :param link: string or None
+    :rtype: string or None
+
+    >>> next_link('<https://api.github.com/x?page=2>; rel="next", <https://api.github.com/x?page=5>; rel="last"')
+    'https://api.github.com/x?page=2'
+    >>> next_link(None)
+
+    """
+    for url, rel in re.findall(r'<([^>]+)>;\s*rel="([^"]+)"', link or ""):
+        if rel == "next":
+            return url
+
+    return None
+
+
+def http_client(max_clients):
+    """
+    A pooled http client of its own: curl's (keep-alive connections) when
+    pycurl is installed, otherwise tornado's simple client
+
+    :param max_clients: int, requests in flight
+    :rtype: class 'tornado.httpclient.AsyncHTTPClient'
+
+    """
+    try:
+        from tornado.curl_httpclient import CurlAsyncHTTPClient as cls
+    except ImportError:
+        from tornado.simple_httpclient import SimpleAsyncHTTPClient as cls
+
+    return cls(force_instance=True, max_clients=max_clients)
+
+
+def in_thread(pool, fn, *args):
+    """
+    Runs fn in a thread of the pool, off the IOLoop
+
+    :param pool: class 'multiprocessing.pool.ThreadPool'
+    :rtype: class 'tornado.concurrent.Future', resolved on the current IOLoop
+
+    >>> pool = ThreadPool(1)
+    >>> IOLoop.current().run_sync(lambda: in_thread(pool, sum, [1, 2]))
+    3
+
+    """
+    future = Future()
+    io_loop = IOLoop.current()
+
+    def call():
+        try:
+            result = fn(*args)
+        except Exception:
+            io_loop.add_callback(future.set_exc_info, sys.exc_info())
+        else:
+            io_loop.add_callback(future.set_result, result)
+
+    pool.apply_async(call)
+    return future
+
+
+class AsyncCrawler(object):
+    """
+    History sync on the tornado IOLoop: the REST api is read with a pooled
+    async http client, `max_clients` requests in flight, instead of one
+    blocking PyGithub call per crawl thread.
+
+    Every repo is synced incrementally (issues and comments listed with one
+    repository level listing each, since the repo's high-water mark), open
+    issues and their comments only for the `issues` sync mode. The quota
+    comes from the X-RateLimit-* headers of the responses and is spent
+    through a RateLimiter that is waited on without blocking the loop.
+
+    Only the http requests run on the loop; responses are decoded, and the
+    records of a repo built and written, by threads of the crawler, so slow
+    targets hold up the crawl (it waits for its writes) but never the
+    webhook handlers. Listings are read a page at a time and checkpointed
+    per page, so the records of a big repo are never all held in memory.
+
+    """
+
+    def __init__(
+        self,
+        git,
+        auth_token=None,
+        base_url=DEFAULT_BASE_URL,
+        max_clients=20,
+        log=DUMMY_LOG,
+    ):
+        self.git = git
+        self.log = log
+        self.api_url = base_url.rstrip("/")
+        self.max_clients = max_clients
+
+        self.headers = {
+            "Accept": "application/vnd.github.v3+json",
+            "User-Agent": "gitdump",
+        }
+        if auth_token:
+            self.headers["Authorization"] = "token %s" % auth_token
+
+        # nothing asked yet, assume the full hourly quota
+        self.rate_limiting = (5000, 5000, time.time() + 3600)
+        self.limiter = RateLimiter(self.quota, log=log)
+
+        self.client = None
+        self._writer = ThreadPool(1)
+        self._reader = ThreadPool(1)
+        self._decoder = ThreadPool(1)
+        self._running = False
+        self._stopping = False
+
+    def is_alive(self):
+        return self._running
+
+    def in_thread(self, pool, fn, *args):
+        return in_thread(pool, fn, *args)
+
+    def quota(self):
+        """
+        The quota from the last response, rolled over to a full one once its
+        reset time has passed: no response arrives while the crawl waits for
+        quota, so the headers alone would never show the reset
+
+        >>> c = AsyncCrawler(None)
+        >>> c.rate_limiting = (0, 5000, time.time() - 5)
+        >>> remaining, limit, reset = c.quota()
+        >>> remaining, limit, reset > time.time()
+        (5000, 5000, True)
+        >>> c.limiter.try_acquire()
+        0.0
+
+        """
+        remaining, limit, reset = self.rate_limiting
+        now = time.time()
+        if reset <= now:
+            while reset <= now:
+                reset += 3600
+            self.rate_limiting = (limit, limit, reset)
+
+        return self.rate_limiting
+
+    @gen.coroutine
+    def acquire(self):
+        while True:
+            delay = self.limiter.try_acquire()
+            if not delay:
+                return
+
+            yield gen.sleep(delay)
+            self.limiter.waited(delay)
+
+    def update_quota(self, headers):
+        try:
+            self.rate_limiting = (
+                int(headers["X-RateLimit-Remaining"]),
+                int(headers["X-RateLimit-Limit"]),
+                int(headers["X-RateLimit-Reset"]),
+            )
+        except (KeyError, ValueError):
+            return
+
+        metrics.API_QUOTA_REMAINING.set(self.rate_limiting[0])
+        metrics.API_QUOTA_LIMIT.set(self.rate_limiting[1])
+
+    @gen.coroutine
+    def fetch(self, url, **params):
+        """
+        GETs an api url within the quota
+
+        :param url: string, path under the api url or a full url
+        :param params: query arguments
+        :rtype: (json, string or None) the decoded body and the next page url
+
+        """
+        if url.startswith("/"):
+            url = self.api_url + url
+        url = url_concat(url, params)
+
+        while True:
+            yield self.acquire()
+            try:
+                response = yield self.client.fetch(url, headers=self.headers)
+            except HTTPError as e:
+                if e.response is None:
+                    raise
+                response = e.response
+
+            metrics.API_CALLS.inc(status=response.code)
+            self.update_quota(response.headers)
+
+            # out of quota, wait for the reset and ask again
+            if response.code in (403, 429) and self.rate_limiting[0] == 0:
+                continue
+
+            response.rethrow()
+
+            # big listing pages are decoded off the loop
+            body = yield self.in_thread(self._decoder, json.loads, response.body)
+            raise gen.Return((body, next_link(response.headers.get("Link"))))
+
+    @gen.coroutine
+    def list_pages(self, url, on_page, **params):
+        """
+        Walks a paginated listing a page at a time: on_page(items) is
+        waited on for every page while the next one is already requested
+
+        :param on_page: function returning a Future
+        :rtype: int, items listed
+
+        """
+        params.setdefault("per_page", PER_PAGE)
+
+        count, page = 0, self.fetch(url, **params)
+        while page is not None:
+            items, url = yield page
+            page = self.fetch(url) if url else None
+            if items:
+                count += len(items)
+                yield on_page(items)
+
+        raise gen.Return(count)
+
+    @gen.coroutine
+    def get_repo_dict(self, name):
+        """
+        :param name: string, repo full name
+        :rtype: dict, the organization/repository part of its records
+
+        """
+        repo = self.git.repo_cache.get(name)
+        if repo is None:
+            repo, _ = yield self.fetch("/repos/%s" % name)
+            self.git.repo_cache.set(name, repo)
+
+        rp = {"repository": repo}
+        owner = repo["owner"]
+        if owner.get("type") == "Organization":
+            login = str(owner["login"])
+            org = self.git.org_cache.get(login)
+            if org is None:
+                org, _ = yield self.fetch("/orgs/%s" % login)
+                self.git.org_cache.set(login, org)
+            rp["organization"] = org
+
+        raise gen.Return(rp)
+
+    def build_record(self, rp, issue=None, comment=None):
+        parts = [rp]
+        if issue:
+            parts.append({"issue": issue})
+        if issue and comment:
+            parts.append({"comment": comment})
+
+        record = self.git.merge_dict(*parts)
+        record.update(self.git.get_key(record))
+        return Record(record)
+
+    def write_page(self, name, rp, items, **checkpoint):
+        """
+        Builds and writes the records of a page, then moves the repo's
+        checkpoint; runs in the writer thread, off the loop
+
+        :param name: string, repo full name
+        :param rp: dict, the organization/repository part of the records
+        :param items: list of (issue, comment) dicts, either may be None
+        :param checkpoint: checkpoint fields to set once written
+
+        """
+        git = self.git
+        records = [self.build_record(rp, i, c) for i, c in items]
+        for i in range(0, len(records), git.batch_size):
+            git.write_messages(records[i : i + git.batch_size])
+
+        if checkpoint:
+            git.checkpoints.update(name, **checkpoint)
+
+    @gen.coroutine
+    def get_issue(self, name, number):
+        """
+        :rtype: dict, or None when the issue is gone (deleted or transferred)
+
+        """
+        try:
+            issue, _ = yield self.fetch("/repos/%s/issues/%d" % (name, number))
+        except HTTPError as e:
+            if e.code not in (404, 410):
+                raise
+            self.log.info("Issue not found", repo=name, number=number)
+            issue = None
+
+        raise gen.Return(issue)
+
+    @gen.coroutine
+    def sync_repo(self, name):
+        """
+        Incremental sync of one repo, as GithubHistory.sync_repo
+
+        Both listings are read oldest update first and a page at a time:
+        every page is written before the next one is asked for, and its
+        latest updated_at checkpointed (issues_since, comments_since), so
+        an interrupted sync resumes from the last page written.
+
+        :param name: string, repo full name
+
+        >>> import tempfile
+        >>> from githubhistory import GithubHistory
+        >>> from messagestore import MemoryStore
+        >>> def crawler(**kwargs):
+        ...     git = GithubHistory(status_path=tempfile.mkdtemp() + '/',
+        ...                         targets=[MemoryStore()], **kwargs)
+        ...     crawler = AsyncCrawler(git)
+        ...     crawler.fetch = fetch
+        ...     return crawler
+        >>> def issue(n, state, t):
+        ...     return {'id': 100 + n, 'number': n, 'state': state,
+        ...             'created_at': t, 'updated_at': t,
+        ...             'url': 'https://api.github.com/repos/me/repo/issues/%d' % n}
+        >>> def comment(i, n, t):
+        ...     return {'id': i, 'created_at': t, 'updated_at': t,
+        ...             'issue_url': 'https://api.github.com/repos/me/repo/issues/%d' % n}
+        >>> pages = {
+        ...     '/repos/me/repo': [{'full_name': 'me/repo', 'owner': {'type': 'User'}}],
+        ...     '/repos/me/repo/issues': [[issue(1, 'open', 'T1'),
+        ...                                issue(2, 'closed', 'T2')]],
+        ...     '/repos/me/repo/issues/comments': [[comment(10, 1, 'T1')],
+        ...                                        [comment(11, 3, 'T3')]],
+        ... }
+        >>> asked = []
+        >>> @gen.coroutine
+        ... def fetch(url, **params):
+        ...     asked.append(url)
+        ...     if url == '/repos/me/repo/issues/3':
+        ...         raise HTTPError(404)
+        ...     url, _, page = url.partition('#')
+        ...     page = int(page or 0)
+        ...     items = pages[url][page]
+        ...     if params.get('state') == 'open':
+        ...         items = [i for i in items if i['state'] == 'open']
+        ...     more = page + 1 < len(pages[url])
+        ...     raise gen.Return((items, more and '%s#%d' % (url, page + 1)))
+
+        Every page is checkpointed, the comment of the deleted issue 3 is
+        skipped and the mark stops at the latest issue listed, older than
+        the latest comment:
+
+        >>> c = crawler(sync_mode='incremental')
+        >>> IOLoop.current().run_sync(lambda: c.sync_repo('me/repo'))
+        >>> c.close()
+        >>> records = c.git.targets[0].records.values()
+        >>> sorted(json.loads(r).get('comment', {}).get('id') for r in records)
+        [None, None, 10]
+        >>> cp = c.git.checkpoints.get('me/repo')
+        >>> cp['updated_at'], cp['completed'], cp['issues_since'], cp['comments_since']
+        ('T2', True, None, None)
+        >>> '/repos/me/repo/issues/3' in asked
+        True
+
+        For the issues sync mode only open issues are listed, and comments
+        of the issues not listed are dropped without asking for the issue:
+
+        >>> c, asked[:] = crawler(), []
+        >>> IOLoop.current().run_sync(lambda: c.sync_repo('me/repo'))
+        >>> c.close()
+        >>> len(c.git.targets[0].records), '/repos/me/repo/issues/3' in asked
+        (2, False)
+
+        """
+        self.log.debug("fun : async sync repo")
+
+        git = self.git
+        cp = git.checkpoints.get(name)
+        backfill = git.sync_mode == "backfill"
+        if backfill and cp.get("backfilled"):
+            self.log.info("Repo already backfilled", repo=name)
+            return
+
+        mark = None if backfill else cp.get("updated_at")
+        issues_since = cp.get("issues_since") or mark
+        comments_since = cp.get("comments_since") or mark
+
+        open_only = git.sync_mode == "issues"
+        rp = yield self.get_repo_dict(name)
+
+        # a comment updated since the mark also bumps its issue, so when the
+        # issues were listed from the mark in this run, the issue of every
+        # comment is normally already listed, and in the issues mode an
+        # issue not listed is not open
+        listed_all = not cp.get("issues_since")
+        issues = {}
+
+        # latest updated_at listed, the issues' from where they started
+        issues_seen = [issues_since]
+        comments_seen = [cp.get("comments_since")]
+
+        def since(value):
+            params = dict(sort="updated", direction="asc")
+            if value:
+                params["since"] = value
+            return params
+
+        @gen.coroutine
+        def issue_page(items):
+            issues.update((i["number"], i) for i in items)
+            latest = max(i["updated_at"] for i in items)
+            issues_seen.append(latest)
+            yield self.in_thread(
+                self._writer,
+                partial(self.write_page, issues_since=latest),
+                name,
+                rp,
+                [(i, None) for i in items],
+            )
+
+        @gen.coroutine
+        def comment_page(items):
+            numbers = set(git.get_issue_number(c) for c in items)
+            missing = numbers - set(issues)
+            if open_only and listed_all:
+                missing = set()
+
+            fetched = yield [self.get_issue(name, n) for n in missing]
+            issues.update((n, i) for n, i in zip(missing, fetched) if i)
+
+            pairs = []
+            for comment in items:
+                issue = issues.get(git.get_issue_number(comment))
+                if issue is None or (open_only and issue["state"] != "open"):
+                    continue
+                pairs.append((issue, comment))
+
+            latest = max(c["updated_at"] for c in items)
+            comments_seen.append(latest)
+            yield self.in_thread(
+                self._writer,
+                partial(self.write_page, comments_since=latest),
+                name,
+                rp,
+                pairs,
+            )
+
+        listed = yield self.list_pages(
+            "/repos/%s/issues" % name,
+            issue_page,
+            state="open" if open_only else "all",
+            **since(issues_since)
+        )
+        yield self.list_pages(
+            "/repos/%s/issues/comments" % name, comment_page, **since(comments_since)
+        )
+
+        # an issue edited while the comments were listed can be older than
+        # the latest comment, so the mark only moves as far as both listings
+        # got; since is inclusive, what is listed again is dropped by the dedup
+        mark = max(issues_seen)
+        if mark and max(comments_seen):
+            mark = min(mark, max(comments_seen))
+        mark = mark or None
+        checkpoint = dict(
+            updated_at=mark, completed=True, issues_since=None, comments_since=None
+        )
+        if backfill:
+            checkpoint["backfilled"] = True
+
+        # a repo without issues still gets its repository record once
+        empty = not (max(issues_seen + comments_seen) or cp.get("updated_at"))
+        items = [(None, None)] if empty else []
+        yield self.in_thread(
+            self._writer, partial(self.write_page, **checkpoint), name, rp, items
+        )
+
+        self.log.info(
+            "Repo synced", repo=name, issues=listed, since=mark, crawler="async"
+        )
+
+    @gen.coroutine
+    def crawl_repo(self, name):
+        t = time.time()
+        try:
+            yield self.sync_repo(name)
+            self.git.dd["repository"] = name
+        except Exception as e:
+            # one failing repo should not stop the others
+            self.log.exception(e, repo=name)
+        finally:
+            elapsed = time.time() - t
+            metrics.REPO_SYNC_SECONDS.observe(elapsed, mode=self.git.sync_mode)
+            metrics.REPO_LAST_SYNC_TIME.set(time.time())
+
+    @gen.coroutine
+    def iter_repo_names(self, queue):
+        """
+        Puts the names of the repos to sync on the queue
+
+        """
+        git = self.git
+        if git.repos or git.repos_file:
+            # the names may come from a file or stdin, read off the loop
+            names = git.iter_repo_names()
+            while not self._stopping:
+                batch = yield self.in_thread(
+                    self._reader, list, itertools.islice(names, 100)
+                )
+                if not batch:
+                    return
+                for name in batch:
+                    if git.in_shard(name):
+                        yield queue.put(name)
+            return
+
+        url, params = "/user/repos", {"per_page": PER_PAGE}
+        while url and not self._stopping:
+            repos, url = yield self.fetch(url, **params)
+            params = {}
+            for repo in repos:
+                if git.in_shard(repo["full_name"]):
+                    git.repo_cache.set(repo["full_name"], repo)
+                    yield queue.put(repo["full_name"])
+
+    @gen.coroutine
+    def get_history(self):
+        """
+        One pass over every repo, as many at once as there are requests in
+        flight
+
+        """
+        self.log.debug("fun : async get history")
+
+        queue = Queue(maxsize=self.max_clients)
+        done = object()
+
+        @gen.coroutine
+        def worker():
+            while True:
+                name = yield queue.get()
+                if name is done:
+                    return
+                if not self._stopping:
+                    yield self.crawl_repo(name)
+
+        workers = [worker() for _ in range(self.max_clients)]
+        try:
+            yield self.iter_repo_names(queue)
+        finally:
+            for _ in workers:
+                yield queue.put(done)
+            yield workers
+
+        yield self.in_thread(self._writer, self.git.checkpoints.flush)
+        self.git.summary.flush()
+        self.log.info("History pass done", rate_limit_sleep=self.limiter.slept)
+
+    @gen.coroutine
+    def start(self):
+        """
+        The history sync, as GithubHistory.start, run on the current IOLoop
+
+        """
+        self.log.debug("fun : async start")
+
+        self._running = True
+        self.client = http_client(self.max_clients)
+        try:
+            if self.git.dd.get("repository") is None:
+                yield self.get_history()
+
+            # recheck for new messages
+            yield self.get_history()
+            self.log.info("Messages stored successfully")
+        except Exception as e:
+            self.log.exception(e)
+        finally:
+            self._running = False
+            self.client.close()
+
+    def stop(self):
+        """
+        Lets the repos in flight finish and starts no new ones
+
+        """
+        self._stopping = True
+
+    def close(self):
+        """
+        Waits for the pending writes
+
+        """
+        for pool in (self._reader, self._decoder, self._writer):
+            pool.close()
+            pool.join()
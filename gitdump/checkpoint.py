@@ -0,0 +1,100 @@
+import time
+import threading
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class CheckpointStore(object):
+    """
+    Per-repo sync progress kept in the status DiskDict under
+    "checkpoint:<repo full_name>":
+
+        page        next page of the issue listing to fetch
+        number      latest issue number crawled by an unfinished pass, so
+                    it resumes after it even when the pages have shifted
+        updated_at  latest updated_at seen, the repo's high-water mark
+        completed   whether the last pass over the repo finished
+        issues_since, comments_since
+                    latest updated_at written by the async crawler's
+                    listings of an unfinished pass, where they resume
+
+    Updates are kept in memory and written in batches, every `flush_every`
+    updates or `flush_age` seconds, so checkpointing each page doesn't add
+    a store write per page.
+
+    >>> cp = CheckpointStore({}, flush_every=2)
+    >>> cp.update('org/repo', page=1, updated_at='2018-02-15T09:17:49Z')
+    >>> cp.dd
+    {}
+    >>> cp.get('org/repo')['page']
+    1
+    >>> cp.update('org/repo', page=2)
+    >>> cp.dd['checkpoint:org/repo']['page']
+    2
+
+    """
+
+    PREFIX = "checkpoint:"
+
+    def __init__(self, dd, flush_every=20, flush_age=10, log=DUMMY_LOG):
+        self.dd = dd
+        self.flush_every = flush_every
+        self.flush_age = flush_age
+        self.log = log
+
+        self._dirty = {}
+        self._pending = 0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+
+    def get(self, repo):
+        """
+        :param repo: string, repo full name
+        :rtype: dict
+
+        """
+        with self._lock:
+            cp = self._dirty.get(repo)
+            if cp is None:
+                cp = self.dd.get(self.PREFIX + repo)
+
+        return dict(cp or {})
+
+    def update(self, repo, **fields):
+        """
+        :param repo: string, repo full name
+        :param fields: checkpoint fields to change
+
+        """
+        cp = self.get(repo)
+        cp.update(fields)
+
+        with self._lock:
+            self._dirty[repo] = cp
+            self._pending += 1
+
+            due = (
+                self._pending >= self.flush_every
+                or time.time() - self._last_flush >= self.flush_age
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending checkpoints to the DiskDict
+
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._pending = 0
+            self._last_flush = time.time()
+
+            for repo, cp in dirty.items():
+                self.dd[self.PREFIX + repo] = cp
+
+        if dirty:
+            self.log.debug("checkpoints flushed", count=len(dirty))
@@ -1,29 +1,169 @@
+import os
 import json
+import signal
 import threading
+from Queue import Full
+from multiprocessing.pool import ThreadPool
 
 import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+from tornado import gen
 from basescript import BaseScript
 
 import util
 from messagestore import *
 from githubhistory import GithubHistory
+from ingest import IngestQueue
+import metrics
+from logutil import TraceLog
+from shard import ShardCoordinator
+from query import QueryService
+from asynccrawler import AsyncCrawler, in_thread
+from profiling import StackSampler, toggle_on_signal
 
 
 class RequestHandler(tornado.web.RequestHandler):
     def post(self):
-        data = json.loads(self.request.body)
+        log = self.application.log
+
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, "payload is not valid json")
+
+        if not isinstance(data, dict):
+            raise tornado.web.HTTPError(400, "payload must be a json object")
 
-        git = GithubWebhookScript().get_git_obj()
+        git = self.application.git
 
-        # gets unique hash key and append with webhook record and store in db
+        # github retries deliveries, a delivery already queued is acknowledged
+        # without storing it again
+        delivery = self.request.headers.get("X-GitHub-Delivery")
+        if delivery and git.dedup.seen("delivery:" + delivery):
+            log.info("Duplicate github delivery", delivery=delivery)
+            self.set_status(200)
+            return
+
+        # gets unique hash key and append with webhook record,
+        # the writer threads store it in db
         record = git.get_key(data)
         record.update(data)
-        git.write_message(record)
+        git.warm_cache(data)
 
-        log = self.application.log
-        log.info("Github webhooks key", msg_id=record["id"])
+        if git.dedup.seen(record["id"]):
+            log.info("Duplicate github record", msg_id=record["id"])
+            self.set_status(200)
+            return
+
+        try:
+            self.application.ingest.put(record)
+        except Full:
+            log.warning("Ingest queue full", msg_id=record["id"])
+            self.set_status(503)
+            self.set_header("Retry-After", self.application.retry_after)
+            return
+
+        if delivery:
+            git.dedup.add("delivery:" + delivery)
+
+        self.set_status(202)
+        log.debug("Github webhooks key", msg_id=record["id"])
+
+    def on_finish(self):
+        metrics.WEBHOOK_REQUESTS.inc(status=self.get_status())
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def get(self):
+        health = self.application.git.health()
+
+        th = self.application.history_thread
+        health["history_thread"] = bool(th and th.is_alive())
+        if isinstance(th, ShardCoordinator):
+            health["shards"] = th.stats()
+        health["ingest"] = self.application.ingest.stats()
+        if self.application.query:
+            health["cache"]["query"] = self.application.query.stats()
+
+        ok = all(health["targets"].values()) and not health["closed"]
+        self.set_status(200 if ok else 503)
+        self.write(health)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+
+        # the shard workers' metrics, as each one last reported them
+        shards = None
+        th = self.application.history_thread
+        if isinstance(th, ShardCoordinator):
+            shards = th.metrics()
+
+        self.write(metrics.REGISTRY.expose(shards))
+
+
+class QueryHandler(tornado.web.RequestHandler):
+
+    # records written per chunk of the streamed response
+    CHUNK = 100
+
+    def prepare(self):
+        if self.application.query is None:
+            raise tornado.web.HTTPError(501, "no target supports queries")
+
+    def page_args(self):
+        try:
+            limit = int(self.get_argument("limit", 100))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "limit must be a number")
+
+        limit = max(1, min(limit, self.application.query_max_limit))
+        return self.get_argument("cursor", None), limit
+
+    @gen.coroutine
+    def respond(self, fn, *args):
+        # the store lookups run on the query threads, not on the IOLoop
+        try:
+            records, cursor = yield in_thread(self.application.query_pool, fn, *args)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        # the records are the stored json, written out without decoding them
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write('{"records": [')
+        for i, record in enumerate(records):
+            if i:
+                self.write(",")
+            self.write(record)
+            if i % self.CHUNK == self.CHUNK - 1:
+                self.flush()
+        self.write('], "next": %s}' % json.dumps(cursor))
+
+
+class IssuesHandler(QueryHandler):
+    @gen.coroutine
+    def get(self, repo):
+        cursor, limit = self.page_args()
+        yield self.respond(self.application.query.issues, repo, cursor, limit)
+
+
+class CommentsHandler(QueryHandler):
+    @gen.coroutine
+    def get(self, repo, number):
+        cursor, limit = self.page_args()
+        yield self.respond(
+            self.application.query.comments, repo, int(number), cursor, limit
+        )
+
+
+class RecordsHandler(QueryHandler):
+    @gen.coroutine
+    def get(self):
+        since = self.get_argument("since", "")
+        cursor, limit = self.page_args()
+        yield self.respond(self.application.query.since, since, cursor, limit)
 
 
 class GithubWebhookScript(BaseScript):
@@ -50,11 +190,15 @@ class GithubWebhookScript(BaseScript):
 
         return path, args
 
-    def msg_store(self):
+    def msg_store(self, shard=None):
         self.log.debug("fun : msg store")
 
         targets = []
         for t in self.args.target:
+            # eg: path=/data/dump-{shard} gives every shard worker (and the
+            # webhook process, as "webhook") its own files
+            t = t.replace("{shard}", "webhook" if shard is None else str(shard))
+
             imp_path, args = self._parse_msg_target_arg(t)
             target_class = util.load_object(imp_path)
             target_obj = target_class(**args)
@@ -63,33 +207,210 @@ class GithubWebhookScript(BaseScript):
         return targets
 
     def run(self):
+        # the per-call debug traces are dropped (or sampled) unless --trace,
+        # before they reach the log formatting
+        self.log = TraceLog(
+            self.log, trace=self.args.trace, sample_every=self.args.log_sample
+        )
         self.log.debug("fun : run")
 
-        th = threading.Thread(target=self.get_git_obj().start)
-        th.daemon = True
-        th.start()
-        self.thread_watch_gmail = th
-        self.listen_realtime()
+        if self.args.history_workers and self.args.repos_file == "-":
+            raise ValueError("--repos_file - can't be shared by --history_workers")
+
+        if self.args.crawler == "async" and self.args.engine == "graphql":
+            raise ValueError("--engine graphql runs with --crawler thread")
+
+        # kill -USR2 <pid> samples the stacks of a running process until the
+        # next USR2
+        toggle_on_signal(
+            StackSampler(log=self.log),
+            self.args.profile_dump or self.args.status_path,
+            log=self.log,
+        )
+
+        # the shard workers are forked before any thread or connection exists
+        history = None
+        if self.args.history_workers:
+            history = ShardCoordinator(
+                self.run_shard, self.args.history_workers, log=self.log
+            )
+            history.start()
+
+        # one GithubHistory (and so one set of target connections) is shared
+        # by the history thread and every webhook request
+        self.git = self.get_git_obj()
+
+        self.ingest = IngestQueue(
+            self.git,
+            maxsize=self.args.queue_size,
+            workers=self.args.writer_workers,
+            batch_size=self.args.batch_size,
+            log=self.log,
+        )
+        self.ingest.start()
+
+        # read api over the first target that can be queried
+        self.query = None
+        store = next(
+            (t for t in self.git.targets if getattr(t, "QUERYABLE", False)), None
+        )
+        if store is not None:
+            self.query = QueryService(
+                store,
+                cache_size=self.args.query_cache_size,
+                cache_ttl=self.args.query_cache_ttl,
+                log=self.log,
+            )
+            self.git.write_listeners.append(self.query.invalidate)
+
+        if history is None and self.args.crawler == "async":
+            # runs on the webhook IOLoop once it starts, its writes go
+            # through a thread of its own
+            history = AsyncCrawler(
+                self.git,
+                auth_token=self.args.access_token.split(",")[0],
+                base_url=self.args.api_url,
+                max_clients=self.args.async_requests,
+                log=self.log,
+            )
+            tornado.ioloop.IOLoop.instance().add_callback(history.start)
+        elif history is None:
+            history = threading.Thread(target=self.git.start)
+            history.daemon = True
+            history.start()
+        self.thread_watch_gmail = history
+
+        try:
+            self.listen_realtime()
+        finally:
+            self.shutdown()
 
     def listen_realtime(self):
         self.log.debug("fun : tornodo listen")
 
         self.log.info("Running tornodo on the machine")
-        app = tornado.web.Application(handlers=[(r"/", RequestHandler)])
+        app = tornado.web.Application(
+            handlers=[
+                (r"/", RequestHandler),
+                (r"/health", HealthHandler),
+                (r"/metrics", MetricsHandler),
+                (r"/repos/([^/]+/[^/]+)/issues", IssuesHandler),
+                (r"/repos/([^/]+/[^/]+)/issues/(\d+)/comments", CommentsHandler),
+                (r"/records", RecordsHandler),
+            ]
+        )
         app.log = self.log
+        app.git = self.git
+        app.ingest = self.ingest
+        app.query = self.query
+        app.query_max_limit = self.args.query_max_limit
+        app.query_pool = ThreadPool(self.args.query_workers)
+        app.retry_after = self.args.retry_after
+        app.history_thread = self.thread_watch_gmail
         http_server = tornado.httpserver.HTTPServer(app)
         http_server.listen(self.args.tornodo_port)
-        tornado.ioloop.IOLoop.instance().start()
 
-    def get_git_obj(self):
+        ioloop = tornado.ioloop.IOLoop.instance()
+
+        def stop(signum, frame):
+            self.log.info("Stopping tornodo", signal=signum)
+            http_server.stop()
+            ioloop.add_callback_from_signal(ioloop.stop)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        ioloop.start()
+
+    def shutdown(self):
+        """
+        Drains pending writes and closes the shared targets
+
+        """
+        self.log.debug("fun : shutdown")
+
+        if isinstance(self.thread_watch_gmail, ShardCoordinator):
+            self.thread_watch_gmail.stop()
+        elif isinstance(self.thread_watch_gmail, AsyncCrawler):
+            self.thread_watch_gmail.stop()
+            self.thread_watch_gmail.close()
+
+        self.ingest.stop()
+        self.git.close()
+        self.log.info("Shutdown complete")
+
+    def run_shard(self, shard, shards, progress):
+        """
+        History sync of one shard of the repos, run in its own process with
+        its own token, rate-limit budget, status and target connections
+
+        """
+        self.log.debug("fun : run shard")
+
+        # the parent handles ctrl-c and stops the workers with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        git = self.get_git_obj(shard, shards, progress)
+
+        def stop(signum, frame):
+            # the crawl stops at its next page or api call and unwinds to
+            # git.close(), repos it was in the middle of aren't checkpointed
+            self.log.info("Stopping shard", shard=shard, signal=signum)
+            git.stopping.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        toggle_on_signal(
+            StackSampler(log=self.log), self.args.profile_dump or git.status_path
+        )
+        try:
+            git.start()
+        finally:
+            git.close()
+
+    def get_git_obj(self, shard=None, shards=1, progress=None):
         self.log.debug("fun : get git obj")
 
-        targets = self.msg_store()
+        # shard workers take the tokens in turn, each with its own api quota
+        tokens = self.args.access_token.split(",")
+        token = tokens[(shard or 0) % len(tokens)]
+
+        status_path = self.args.status_path
+        if shard is not None:
+            status_path = os.path.join(status_path, "shard-%d" % shard) + "/"
+            if not os.path.isdir(status_path):
+                os.makedirs(status_path)
+
+        targets = self.msg_store(shard)
         return GithubHistory(
-            auth_token=self.args.access_token,
+            auth_token=token,
+            base_url=self.args.api_url,
+            dedup_size=self.args.dedup_size,
+            dedup_ttl=self.args.dedup_ttl,
+            dedup_persist=self.args.dedup_persist,
+            log_interval=self.args.log_interval,
             repos=self.args.repos_list,
-            status_path=self.args.status_path,
+            repos_file=self.args.repos_file,
+            status_path=status_path,
             targets=targets,
+            batch_size=self.args.batch_size,
+            batch_age=self.args.batch_age,
+            cache_size=self.args.cache_size,
+            cache_ttl=self.args.cache_ttl,
+            sync_mode=self.args.sync_mode,
+            workers=self.args.crawl_workers,
+            http_cache_size=self.args.http_cache_size * 1024 * 1024,
+            shard=shard or 0,
+            shards=shards,
+            progress=progress,
+            backfill_workers=self.args.backfill_workers,
+            backfill_batch=self.args.backfill_batch,
+            engine=self.args.engine,
+            graphql_url=self.args.graphql_url,
+            graphql_page_size=self.args.graphql_page_size,
+            target_queue_size=self.args.target_queue_size,
+            target_retry_interval=self.args.target_retry_interval,
+            profile=self.args.profile,
+            profile_dump=self.args.profile_dump,
             log=self.log,
         )
 
@@ -100,7 +421,13 @@ class GithubWebhookScript(BaseScript):
             "--access_token",
             metavar="usr_access_token",
             required=True,
-            help="access token to authenticate github account",
+            help="access token to authenticate github account, several comma \
+                separated tokens are shared out to the --history_workers",
+        )
+        parser.add_argument(
+            "--api_url",
+            default="https://api.github.com",
+            help="github api base url, eg: for github enterprise, default: %(default)s",
         )
         parser.add_argument(
             "-repos",
@@ -110,6 +437,11 @@ class GithubWebhookScript(BaseScript):
             default=None,
             help="repos to be stored in the db",
         )
+        parser.add_argument(
+            "--repos_file",
+            default=None,
+            help="file with one repo full name per line, - reads them from stdin",
+        )
         # diskdict arguments
         parser.add_argument(
             "-status_path",
@@ -129,6 +461,174 @@ class GithubWebhookScript(BaseScript):
                 format for SQLite: store=<SQLiteStore-classpath>:host=<hostname>:port=<port-number>:db_name=<db-name>:table_name=<table-name>"',
         )
 
+        parser.add_argument(
+            "--sync_mode",
+            choices=("issues", "incremental", "backfill"),
+            default="issues",
+            help="issues: check every open issue against the db, \
+                incremental: fetch only what changed since the last sync, \
+                backfill: store every issue, open and closed, with all its comments, default: %(default)s",
+        )
+        parser.add_argument(
+            "--backfill_workers",
+            type=int,
+            default=4,
+            help="issue pages fetched in parallel by the backfill, default: %(default)s",
+        )
+        parser.add_argument(
+            "--backfill_batch",
+            type=int,
+            default=1000,
+            help="max records written to a target in one backfill batch, default: %(default)s",
+        )
+        parser.add_argument(
+            "--engine",
+            choices=("rest", "graphql"),
+            default="rest",
+            help="rest: walk the REST api objects, \
+                graphql: fetch pages of issues with their comments in batched GraphQL queries, default: %(default)s",
+        )
+        parser.add_argument(
+            "--crawler",
+            choices=("thread", "async"),
+            default="thread",
+            help="thread: history sync with blocking api calls on a thread, \
+                async: incremental history sync on the tornodo IOLoop with many requests in flight, default: %(default)s",
+        )
+        parser.add_argument(
+            "--async_requests",
+            type=int,
+            default=20,
+            help="api requests in flight with --crawler async, default: %(default)s",
+        )
+        parser.add_argument(
+            "--graphql_url",
+            default=None,
+            help="GraphQL endpoint, default: derived from the api base url",
+        )
+        parser.add_argument(
+            "--graphql_page_size",
+            type=int,
+            default=50,
+            help="issues per GraphQL query, default: %(default)s",
+        )
+
+        parser.add_argument(
+            "--crawl_workers",
+            type=int,
+            default=4,
+            help="repos and issues crawled in parallel, default: %(default)s",
+        )
+
+        parser.add_argument(
+            "--http_cache_size",
+            type=int,
+            default=256,
+            help="MB of api responses cached under status_path and revalidated \
+                with ETags, 0 disables the cache, default: %(default)s",
+        )
+
+        # organization/repository cache arguments
+        parser.add_argument(
+            "--cache_size",
+            type=int,
+            default=1000,
+            help="max organizations/repositories kept in memory, default: %(default)s",
+        )
+        parser.add_argument(
+            "--cache_ttl",
+            type=int,
+            default=600,
+            help="seconds a cached organization/repository stays valid, default: %(default)s",
+        )
+
+        # webhook/record deduplication arguments
+        parser.add_argument(
+            "--dedup_size",
+            type=int,
+            default=100000,
+            help="max delivery/record ids remembered to drop repeats, default: %(default)s",
+        )
+        parser.add_argument(
+            "--dedup_ttl",
+            type=int,
+            default=24 * 60 * 60,
+            help="seconds a delivery/record id is remembered, default: %(default)s",
+        )
+        parser.add_argument(
+            "--dedup_persist",
+            action="store_true",
+            help="save the remembered ids under status_path so they survive restarts",
+        )
+
+        parser.add_argument(
+            "--history_workers",
+            type=int,
+            default=0,
+            help="processes the history sync is sharded over (by repo full name), \
+                0 syncs in a thread of the webhook process, default: %(default)s",
+        )
+
+        # query api arguments
+        parser.add_argument(
+            "--query_cache_size",
+            type=int,
+            default=1000,
+            help="repos/issues whose query results are cached, default: %(default)s",
+        )
+        parser.add_argument(
+            "--query_cache_ttl",
+            type=int,
+            default=60,
+            help="max seconds a cached query result is served, default: %(default)s",
+        )
+        parser.add_argument(
+            "--query_max_limit",
+            type=int,
+            default=1000,
+            help="max records per query page, default: %(default)s",
+        )
+        parser.add_argument(
+            "--query_workers",
+            type=int,
+            default=4,
+            help="threads running the query lookups, default: %(default)s",
+        )
+
+        # logging arguments
+        parser.add_argument(
+            "--trace",
+            action="store_true",
+            help="log every per-call debug trace (with --log-level debug)",
+        )
+        parser.add_argument(
+            "--log_sample",
+            type=int,
+            default=0,
+            help="without --trace, log one in this many debug traces, 0 logs none, default: %(default)s",
+        )
+        parser.add_argument(
+            "--log_interval",
+            type=int,
+            default=60,
+            help="seconds between the records written summaries, default: %(default)s",
+        )
+
+        # profiling arguments
+        parser.add_argument(
+            "--profile",
+            action="store_true",
+            help="time every stage of the history pass, per repo too, and write \
+                a report to status_path/profile-<time>.json when the pass ends",
+        )
+        parser.add_argument(
+            "--profile_dump",
+            default=None,
+            help="directory to write stack samples (flamegraph collapsed format) \
+                of every history pass to; SIGUSR2 starts/stops sampling a running \
+                process, written here or to status_path",
+        )
+
         # tornodo arguments
         parser.add_argument(
             "-tp",
@@ -139,6 +639,51 @@ class GithubWebhookScript(BaseScript):
             help="port in which tornodo needs to run",
         )
 
+        # webhook ingestion arguments
+        parser.add_argument(
+            "--queue_size",
+            type=int,
+            default=10000,
+            help="max webhook records waiting to be written, default: %(default)s",
+        )
+        parser.add_argument(
+            "--writer_workers",
+            type=int,
+            default=2,
+            help="threads writing queued webhook records, default: %(default)s",
+        )
+        parser.add_argument(
+            "--target_queue_size",
+            type=int,
+            default=0,
+            help="max records queued for each target before they are spooled to disk, \
+                0 writes every batch to all targets before moving on, default: %(default)s",
+        )
+        parser.add_argument(
+            "--target_retry_interval",
+            type=float,
+            default=5,
+            help="seconds before a failing target is retried, doubled up to 5 minutes, default: %(default)s",
+        )
+        parser.add_argument(
+            "--batch_size",
+            type=int,
+            default=100,
+            help="max records per target write, default: %(default)s",
+        )
+        parser.add_argument(
+            "--batch_age",
+            type=float,
+            default=5,
+            help="max seconds history records stay buffered, default: %(default)s",
+        )
+        parser.add_argument(
+            "--retry_after",
+            type=int,
+            default=5,
+            help="Retry-After seconds sent when the queue is full, default: %(default)s",
+        )
+
 
 def main():
     GithubWebhookScript().start()
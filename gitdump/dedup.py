@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class IdempotencyCache(object):
+    """
+    Bounded FIFO/TTL set of keys already handled (webhook delivery ids,
+    record ids), used to drop repeated deliveries and records before they
+    are written. When full the oldest added key is dropped; a hit doesn't
+    keep a key any longer.
+
+    With a `path` the keys are saved there on `save` and loaded back when
+    the cache is created. `save` only runs on a graceful close, so the keys
+    added since the last start are lost on a crash. The cache is in memory
+    of one process: history shard workers each have their own and don't
+    see each other's or the webhook process's keys.
+
+    >>> seen = IdempotencyCache(maxsize=2, ttl=60)
+    >>> seen.add('a'), seen.add('a')
+    (True, False)
+    >>> 'a' in seen
+    True
+    >>> seen.add('b'), seen.add('c')
+    (True, True)
+    >>> 'a' in seen
+    False
+    >>> seen.stats()['duplicates']
+    1
+
+    """
+
+    def __init__(self, maxsize=100000, ttl=24 * 60 * 60, path=None, log=DUMMY_LOG):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.log = log
+
+        self.duplicates = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def _expire(self, now):
+        # oldest first, so stop at the first key still valid
+        while self._keys:
+            key, expiry = next(iter(self._keys.items()))
+            if expiry >= now:
+                break
+            del self._keys[key]
+
+    def __contains__(self, key):
+        with self._lock:
+            expiry = self._keys.get(key)
+            return expiry is not None and expiry >= time.time()
+
+    def add(self, key):
+        """
+        Marks the key as handled
+
+        :param key: string
+        :rtype: bool, False when the key was already handled
+
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+
+            if key in self._keys:
+                self.duplicates += 1
+                return False
+
+            self._keys[key] = now + self.ttl
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+            return True
+
+    def seen(self, key):
+        """
+        Like `in` but counts a hit as a duplicate
+
+        :param key: string
+        :rtype: bool
+
+        """
+        if key in self:
+            with self._lock:
+                self.duplicates += 1
+            return True
+
+        return False
+
+    def load(self):
+        with open(self.path) as f:
+            keys = json.load(f)
+
+        now = time.time()
+        with self._lock:
+            for key, expiry in keys:
+                if expiry >= now:
+                    self._keys[key] = expiry
+
+        self.log.info("Idempotency keys loaded", count=len(self._keys))
+
+    def save(self):
+        if not self.path:
+            return
+
+        with self._lock:
+            keys = list(self._keys.items())
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(keys, f)
+        os.rename(tmp, self.path)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._keys), "duplicates": self.duplicates}
@@ -0,0 +1,414 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import deque
+from Queue import Queue, Empty
+
+from deeputil import Dummy
+
+from util import Record, to_json
+import metrics
+
+DUMMY_LOG = Dummy()
+
+
+class RetrySpool(object):
+    """
+    Batches a target could not take, kept on disk until it can: one jsonl
+    file per batch in `path`, named by the time its records were first
+    queued so they are replayed oldest first, across restarts too.
+
+    >>> import tempfile
+    >>> spool = RetrySpool(tempfile.mkdtemp())
+    >>> spool.append([{'id': 'a'}, {'id': 'b'}], queued_at=10).endswith('.jsonl')
+    True
+    >>> fpath = spool.append([{'id': 'c'}], queued_at=20)
+    >>> len(spool), spool.records, spool.oldest()
+    (2, 3, 10.0)
+    >>> batch = spool.peek()
+    >>> [r['id'] for r in batch.records]
+    [u'a', u'b']
+    >>> spool.remove(batch)
+    >>> len(spool), spool.records
+    (1, 1)
+
+    """
+
+    def __init__(self, path, log=DUMMY_LOG):
+        self.path = path
+        self.log = log
+
+        self._seq = 0
+        self._files = deque()
+        self.records = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # what an earlier run left behind, oldest first
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".jsonl"):
+                fpath = os.path.join(path, name)
+                with open(fpath) as f:
+                    count = sum(1 for _ in f)
+                self._files.append((fpath, count))
+                self.records += count
+
+        if self._files:
+            self.log.info("Retry spool loaded", path=path, records=self.records)
+
+    def __len__(self):
+        return len(self._files)
+
+    def append(self, records, queued_at=None):
+        """
+        :param records: list of dict
+        :param queued_at: float, epoch the records were first queued
+        :rtype: string, path of the batch's file
+
+        """
+        with self._lock:
+            self._seq += 1
+            name = "%017d-%06d.jsonl" % ((queued_at or time.time()) * 1e6, self._seq)
+
+        fpath = os.path.join(self.path, name)
+        with open(fpath + ".tmp", "w") as f:
+            for r in records:
+                f.write(to_json(r))
+                f.write("\n")
+        os.rename(fpath + ".tmp", fpath)
+
+        with self._lock:
+            self._files.append((fpath, len(records)))
+            self.records += len(records)
+
+        return fpath
+
+    def oldest(self):
+        """
+        :rtype: float or None, epoch the oldest spooled records were queued
+
+        """
+        with self._lock:
+            if not self._files:
+                return None
+            fpath = self._files[0][0]
+
+        return int(os.path.basename(fpath).split("-", 1)[0]) / 1e6
+
+    def peek(self):
+        """
+        :rtype: SpooledBatch or None, the oldest batch
+
+        """
+        with self._lock:
+            if not self._files:
+                return None
+            fpath, count = self._files[0]
+
+        with open(fpath) as f:
+            records = [Record(json.loads(line)) for line in f if line.strip()]
+
+        return SpooledBatch(fpath, records)
+
+    def remove(self, batch):
+        """
+        Drops a batch once its records are written
+
+        :param batch: SpooledBatch from peek
+
+        """
+        with self._lock:
+            fpath, count = self._files.popleft()
+            self.records -= count
+
+        os.remove(fpath)
+
+    def discard(self, fpath):
+        """
+        Drops the batch kept in fpath, wherever it is in the spool
+
+        :param fpath: string, from append
+
+        """
+        with self._lock:
+            for i, (path, count) in enumerate(self._files):
+                if path == fpath:
+                    del self._files[i]
+                    self.records -= count
+                    break
+
+        os.remove(fpath)
+
+
+class SpooledBatch(object):
+    def __init__(self, path, records):
+        self.path = path
+        self.records = records
+
+
+class TargetWriter(object):
+    """
+    Queue and writer thread of one target, so a slow or failing target
+    falls behind on its own instead of holding up the others.
+
+    `put` doesn't wait for the target: batches are queued, or spooled to
+    disk when the queue holds `queue_size` records. A queued batch is also
+    kept on disk (under `queued/` in the spool path) until it is written or
+    spooled, so once `put` returns the batch survives a crash and is safe
+    to checkpoint; a restart spools what was left there. A batch the
+    target fails to take is
+    spooled too; while the spool isn't empty the target is degraded, new
+    batches go straight to the spool and the spool is replayed, oldest
+    first, every `retry_interval` seconds (doubling up to `retry_max`) until
+    the target takes it again. Records are keyed by their version, so a
+    replay that lands after newer records does not overwrite them.
+
+    `write(msgs)` writes a batch to the target and raises when it can't.
+
+    >>> import tempfile
+    >>> class Target(object):
+    ...     up, msgs = False, []
+    ...     def write(self, msgs):
+    ...         if not self.up: raise IOError('down')
+    ...         self.msgs.extend(msgs)
+    ...
+    >>> t, path = Target(), tempfile.mkdtemp()
+    >>> w = TargetWriter('t', t.write, path, batch_wait=0.01)
+    >>> w.start()
+    >>> w.put([{'id': 'a'}])
+    >>> w.stop()
+    >>> w.stats()['spooled'], w.stats()['errors']
+    (1, 1)
+
+    Once the target is back the spool (here left by the writer before) is
+    replayed:
+
+    >>> t.up = True
+    >>> w = TargetWriter('t', t.write, path, batch_wait=0.01)
+    >>> w.start()
+    >>> w.put([{'id': 'b'}]); w.stop()
+    >>> sorted(m['id'] for m in t.msgs), w.stats()['spooled']
+    ([u'a', u'b'], 0)
+
+    Queued batches a crashed writer left behind are spooled on start:
+
+    >>> path = tempfile.mkdtemp()
+    >>> w = TargetWriter('t', t.write, path)
+    >>> w.put([{'id': 'c'}])
+    >>> TargetWriter('t', t.write, path).stats()['spooled']
+    1
+
+    """
+
+    def __init__(
+        self,
+        name,
+        write,
+        spool_path,
+        queue_size=10000,
+        batch_size=100,
+        batch_wait=1.0,
+        retry_interval=5,
+        retry_max=300,
+        log=DUMMY_LOG,
+    ):
+        self.name = name
+        self.write = write
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry_interval = retry_interval
+        self.retry_max = retry_max
+        self.log = log
+
+        # queued batches not yet written or spooled, those left by an
+        # earlier run are spooled
+        journal_path = os.path.join(spool_path, "queued")
+        if os.path.isdir(journal_path):
+            for name in os.listdir(journal_path):
+                if name.endswith(".jsonl"):
+                    os.rename(
+                        os.path.join(journal_path, name),
+                        os.path.join(spool_path, name[: -len(".jsonl")] + "q.jsonl"),
+                    )
+
+        self.spool = RetrySpool(spool_path, log=log)
+        self.journal = RetrySpool(journal_path, log=log)
+
+        # (queued at, records, journal file)
+        self.queue = Queue()
+        self.queued = 0
+        self.written = 0
+        self.errors = 0
+        self._retry_at = 0
+        self._backoff = retry_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def put(self, msgs):
+        """
+        Queues msgs, on disk by the time it returns
+
+        :param msgs: list of dict
+
+        """
+        now = time.time()
+        with self._lock:
+            full = self.queued + len(msgs) > self.queue_size
+            if not full:
+                self.queued += len(msgs)
+
+        if full:
+            self.spool.append(msgs, now)
+        else:
+            self.queue.put((now, msgs, self.journal.append(msgs, now)))
+
+    def get_batch(self):
+        """
+        :rtype: (float, list, list) when the oldest records were queued, up
+                to about batch_size of them and the journal files of their
+                puts
+
+        """
+        try:
+            queued_at, batch, fpath = self.queue.get(timeout=self.batch_wait)
+        except Empty:
+            return None, [], []
+
+        batch, fpaths = list(batch), [fpath]
+        while len(batch) < self.batch_size:
+            try:
+                _, msgs, fpath = self.queue.get_nowait()
+            except Empty:
+                break
+            batch.extend(msgs)
+            fpaths.append(fpath)
+
+        return queued_at, batch, fpaths
+
+    def _write(self, msgs):
+        try:
+            self.write(msgs)
+        except Exception as e:
+            self.log.exception(e, target=self.name, records=len(msgs))
+            with self._lock:
+                self.errors += 1
+            return False
+
+        with self._lock:
+            self.written += len(msgs)
+        return True
+
+    def _failed(self):
+        self._retry_at = time.time() + self._backoff
+        self._backoff = min(self._backoff * 2, self.retry_max)
+
+    def replay(self):
+        """
+        Writes the spooled batches, oldest first, until one fails
+
+        """
+        while True:
+            batch = self.spool.peek()
+            if batch is None:
+                self._backoff = self.retry_interval
+                self.log.info("Target caught up", target=self.name)
+                return
+
+            if not self._write(batch.records):
+                self._failed()
+                return
+
+            self.spool.remove(batch)
+
+    def _run(self):
+        # keep going after stop() until the queue is written or spooled
+        while not (self._stop.is_set() and self.queue.empty()):
+            queued_at, batch, fpaths = self.get_batch()
+
+            if len(self.spool):
+                if batch:
+                    self.spool.append(batch, queued_at)
+                if time.time() >= self._retry_at:
+                    self.replay()
+            elif batch and not self._write(batch):
+                self.spool.append(batch, queued_at)
+                self._failed()
+
+            # only counted out once written or spooled
+            with self._lock:
+                self.queued -= len(batch)
+            for fpath in fpaths:
+                self.journal.discard(fpath)
+
+            self.update_metrics()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="target-writer-%s" % self.name
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Writes (or spools) what is queued and stops the writer
+
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        self.update_metrics()
+
+    def lag(self):
+        """
+        :rtype: float, seconds the oldest record not yet written has waited
+
+        """
+        oldest = self.spool.oldest()
+        with self.queue.mutex:
+            if self.queue.queue:
+                head = self.queue.queue[0][0]
+                oldest = min(oldest or head, head)
+
+        return time.time() - oldest if oldest else 0.0
+
+    def update_metrics(self):
+        metrics.TARGET_LAG_SECONDS.set(self.lag(), target=self.name)
+        metrics.TARGET_QUEUED.set(self.queued, target=self.name)
+        metrics.TARGET_SPOOLED.set(self.spool.records, target=self.name)
+
+    def stats(self):
+        """
+        :rtype: dict
+
+        """
+        with self._lock:
+            stats = dict(queued=self.queued, written=self.written, errors=self.errors)
+
+        stats.update(
+            spooled=self.spool.records,
+            degraded=bool(len(self.spool)),
+            lag_seconds=round(self.lag(), 3),
+            alive=bool(self._thread and self._thread.is_alive()),
+        )
+        return stats
+
+
+def spool_dirname(name):
+    """
+    :param name: string, target name
+    :rtype: string usable as a directory name
+
+    >>> spool_dirname('SQLiteStore./data/gitdump.db')
+    'SQLiteStore._data_gitdump.db'
+
+    """
+    return re.sub(r"[^\w.-]", "_", name)
@@ -1,19 +1,99 @@
+import os
+import sys
 import time
-import hashlib
-from copy import deepcopy
+import urlparse
+import itertools
+import threading
+from functools import partial
+from multiprocessing import TimeoutError
 from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
 from ConfigParser import _Chainmap as ChainMap
 
 from github import Github
+from github.MainClass import DEFAULT_BASE_URL
+from github.Repository import Repository
 from deeputil import Dummy
 from diskdict import DiskDict
 
+from util import TTLCache, Record, record_key
+from ratelimit import RateLimiter
+from httpcache import ResponseCache
+from checkpoint import CheckpointStore
+from dedup import IdempotencyCache
+import metrics
+from logutil import LogSummary
+from shard import shard_of
+from graphqlengine import GraphQLEngine
+from fanout import TargetWriter, spool_dirname
+from profiling import StageTimer, StackSampler
+
 DUMMY_LOG = Dummy()
 
 
-class GithubHistory(object):
+class HistoryClosed(Exception):
+    """
+    Raised by the writes and the crawl once the history is closing, so a
+    repo stops where it is instead of checkpointing records that were never
+    written
+
+    """
+
+
+def get_quota(git):
+    """
+    :param git: class 'github.Github'
+    :rtype: (int, int, float) remaining api calls, the limit and the epoch
+            they reset at
+
+    """
+    if git.rate_limiting_resettime <= time.time():
+        # the figures are from before the reset, /rate_limit costs no quota
+        git.get_rate_limit()
+
+    remaining, limit = git.rate_limiting
+    return remaining, limit, git.rate_limiting_resettime
+
+
+def target_name(target):
+    """
+    :param target: db obj
+    :rtype: string
+
+    >>> from messagestore import MemoryStore
+    >>> target_name(MemoryStore())
+    'MemoryStore.memory'
+
+    """
+    return "%s.%s" % (target.__class__.__name__, getattr(target, "db_name", ""))
+
+
+def count_api_calls(requester, quota=True):
+    """
+    Counts the api calls made through a PyGithub requester and keeps the
+    quota gauges in step with its rate_limiting
+
+    :param requester: class 'github.Requester.Requester'
+    :param quota: bool, False for a requester with a budget of its own
+
+    """
+    request_json = requester.requestJson
+
+    def counted_request_json(*args, **kwargs):
+        status, headers, output = request_json(*args, **kwargs)
 
+        metrics.API_CALLS.inc(status=status)
+        remaining, limit = requester.rate_limiting
+        if quota and limit >= 0:
+            metrics.API_QUOTA_REMAINING.set(remaining)
+            metrics.API_QUOTA_LIMIT.set(limit)
+
+        return status, headers, output
+
+    requester.requestJson = counted_request_json
+
+
+class GithubHistory(object):
     """
     This is the main class you instantiate to access the Github API v3 and store all msgs in the db.
 
@@ -23,18 +103,158 @@ class GithubHistory(object):
         self,
         auth_token=None,
         repos=None,
+        repos_file=None,
         status_path="/tmp/",
         targets=None,
+        batch_size=100,
+        batch_age=5,
+        cache_size=1000,
+        cache_ttl=600,
+        sync_mode="issues",
+        workers=4,
+        http_cache_size=0,
+        base_url=DEFAULT_BASE_URL,
+        dedup_size=100000,
+        dedup_ttl=24 * 60 * 60,
+        dedup_persist=False,
+        log_interval=60,
+        shard=0,
+        shards=1,
+        progress=None,
+        backfill_workers=4,
+        backfill_batch=1000,
+        engine="rest",
+        graphql_url=None,
+        graphql_page_size=50,
+        target_queue_size=0,
+        target_retry_interval=5,
+        profile=False,
+        profile_dump=None,
         log=DUMMY_LOG,
     ):
 
-        self.git = Github(auth_token)
+        self.git = Github(auth_token, base_url=base_url)
         self.log = log
         self.repos = repos
+        self.repos_file = repos_file
+        self.status_path = status_path
+
+        # with several history processes each one syncs the repos hashed to
+        # its shard and reports them through progress(repo=.., records=..)
+        self.shard = shard
+        self.shards = shards
+        self.progress = progress
+        self.written = 0
         self.targets = targets
         self.store = None
+        self.sync_mode = sync_mode
         self.dd = DiskDict(status_path + "disk.dict")
+        self.checkpoints = CheckpointStore(self.dd, log=log)
+
+        # ids of records (and webhook deliveries) already written, shared by
+        # the history pass and the webhook handlers to drop repeats
+        self.dedup = IdempotencyCache(
+            dedup_size,
+            dedup_ttl,
+            path=status_path + "dedup.json" if dedup_persist else None,
+            log=log,
+        )
+
+        # records written are counted and logged as a summary every
+        # log_interval seconds instead of a line per record
+        self.summary = LogSummary(log, log_interval)
+
+        # opt-in wall time/call counts per stage and repo, reported at the
+        # end of every pass, and stack samples of every pass for flamegraphs
+        # written to the profile_dump directory
+        self.profile = StageTimer(enabled=profile)
+        self.profile_dump = profile_dump
+        self.sampler = StackSampler(log=log) if profile_dump else None
+
+        # called with every batch once it is written, eg: to invalidate the
+        # query cache
+        self.write_listeners = []
+
+        # with a target_queue_size every target gets its own queue, writer
+        # thread and retry spool under the status path, otherwise batches
+        # are written to all the targets before write_messages returns
+        self.writers = []
+        for t in (targets or []) if target_queue_size else []:
+            name = target_name(t)
+            self.writers.append(
+                TargetWriter(
+                    name,
+                    partial(self.write_target, t),
+                    status_path + "spool/" + spool_dirname(name),
+                    queue_size=target_queue_size,
+                    batch_size=batch_size,
+                    retry_interval=target_retry_interval,
+                    log=log,
+                )
+            )
+        for w in self.writers:
+            w.start()
+
         self._pool = ThreadPool()
+        self._lock = threading.Condition()
+        self._writing = 0
+        self.closed = False
+
+        # set by close(): the crawl stops taking repos, pages and issues
+        self.stopping = threading.Event()
+
+        # records from the history pass are buffered and flushed
+        # by count (batch_size) or by age in seconds (batch_age)
+        self.batch_size = batch_size
+        self.batch_age = batch_age
+        self._buffer = []
+        self._buffer_time = time.time()
+        self._buffer_lock = threading.Condition()
+
+        # buffers taken by flush() and still being written, oldest first
+        self._flushing = []
+
+        # raw organization/repository data keyed by login/full_name, saves
+        # an api call per stored record
+        self.org_cache = TTLCache(cache_size, cache_ttl)
+        self.repo_cache = TTLCache(cache_size, cache_ttl)
+
+        # repos and issues are crawled by separate pools so that repo
+        # workers can wait on issue jobs; all of them share one api budget
+        self.workers = workers
+        self._repo_pool = ThreadPool(workers)
+        self._issue_pool = ThreadPool(workers)
+
+        # backfill pages are fetched by their own pool, sized apart from the
+        # crawl workers so a backfill can be kept small
+        self._backfill_pool = ThreadPool(backfill_workers)
+        self.backfill_batch = backfill_batch
+        self.limiter = RateLimiter(partial(get_quota, self.git), log=log)
+        count_api_calls(self.git._Github__requester)
+        self.profile.wrap(self.git._Github__requester, "requestJson", "github_api")
+
+        # api responses are revalidated with their ETag/Last-Modified so
+        # unchanged pages come back as 304s that don't use up the quota
+        self.http_cache = None
+        if http_cache_size:
+            self.http_cache = ResponseCache(
+                status_path + "http.cache", max_size=http_cache_size, log=log
+            )
+            self.http_cache.install(self.git._Github__requester)
+
+        # with the graphql engine repos are read with batched GraphQL
+        # queries instead of walking the REST objects
+        self.engine = None
+        if engine == "graphql":
+            self.engine = GraphQLEngine(
+                auth_token,
+                base_url=base_url,
+                url=graphql_url,
+                page_size=graphql_page_size,
+                log=log,
+            )
+            count_api_calls(self.engine.requester, quota=False)
+            self.profile.wrap(self.engine.requester, "requestJson", "graphql_api")
 
     def get_repo_obj(self, repo_fullname):
         """
@@ -48,28 +268,97 @@ class GithubHistory(object):
         """
         self.log.debug("fun : get repo obj")
 
+        raw = self.repo_cache.get(str(repo_fullname))
+        if raw:
+            return self.git.create_from_raw_data(Repository, raw)
+
         return self.git.get_repo(str(repo_fullname))
 
+    def iter_repo_names(self):
+        """
+        The configured repo names: the comma separated `repos`, then the
+        lines of `repos_file` (blank lines and # comments skipped), read
+        as they are needed. A repos_file of "-" is stdin, spooled under the
+        status path as it is read so later passes can read it again.
+
+        :rtype: iterator of string
+
+        >>> obj = GithubHistory(repos='org/repo1, org/repo2')
+        >>> list(obj.iter_repo_names())
+        ['org/repo1', 'org/repo2']
+
+        """
+        self.log.debug("fun : iter repo names")
+
+        for name in (self.repos or "").split(","):
+            if name.strip():
+                yield name.strip()
+
+        if not self.repos_file:
+            return
+
+        if self.repos_file == "-":
+            spool = self.status_path + "repos.stdin"
+            with open(spool + ".tmp", "w") as out:
+                for line in iter(sys.stdin.readline, ""):
+                    out.write(line)
+                    name = line.split("#", 1)[0].strip()
+                    if name:
+                        yield name
+
+            os.rename(spool + ".tmp", spool)
+            self.repos_file = spool
+            return
+
+        with open(self.repos_file) as f:
+            for line in f:
+                name = line.split("#", 1)[0].strip()
+                if name:
+                    yield name
+
     def get_repos_list(self):
         """
-        :rtype: :class:`github.PaginatedList.PaginatedList` of :class:`github.Repository.Repository`
-        or
-        :rtype: [class:`github.Repository.Repository`,..]
+        Repos of the shard, resolved lazily: the repo objects are created
+        as the repo workers ask for them and fetched by the worker that
+        crawls them, so the first repo is crawled while later names are
+        still being read.
+
+        :rtype: iterator of :class:`github.Repository.Repository`
 
         >>> from mock import Mock
         >>> obj = GithubHistory()
         >>> m=Mock(obj.repos)
         >>> obj.repos=m.return_value='org/repo1,org/repo2'
-        >>> obj.get_repos_list()
+        >>> list(obj.get_repos_list())
         [Repository(full_name=None), Repository(full_name=None)]
 
         """
         self.log.debug("fun : get repos list")
 
-        if self.repos:
-            return [self.get_repo_obj(repo) for repo in self.repos.split(",")]
+        if self.repos or self.repos_file:
+            return (
+                self.get_repo_obj(name)
+                for name in self.iter_repo_names()
+                if self.in_shard(name)
+            )
 
-        return self.git.get_user().get_repos()
+        repos = self.git.get_user().get_repos()
+        if self.shards > 1:
+            return (r for r in repos if self.in_shard(r.full_name))
+
+        return repos
+
+    def in_shard(self, repo_fullname):
+        """
+        :param repo_fullname: string
+        :rtype: bool
+
+        >>> obj = GithubHistory(shard=1, shards=4)
+        >>> obj.in_shard('deep-compute/githubdump')
+        False
+
+        """
+        return shard_of(repo_fullname, self.shards) == self.shard
 
     def get_raw_data(self, obj):
         """
@@ -112,55 +401,251 @@ class GithubHistory(object):
         :rtype: dict
 
         >>> obj = GithubHistory()
-        >>> obj.get_key({'repository':{'updated_at':'21-04-14'},'issue':{'updated_at':'21-04-14'},'comment':{'updated_at':'21-04-14'}})
-        {'id': '1c4882d4c922bcfdc070de97de03706c9276f8eb'}
-        >>> obj.get_key({'repository':{'updated_at':'21-04-14'},'issue':{},'comment':{}})
-        {'id': '8acfc9c43a5c9f64ee2070007591811f4048c907'}
+        >>> obj.get_key({'repository':{'id':1,'updated_at':'21-04-14'},'issue':{'number':2,'updated_at':'21-04-14'},'comment':{'id':3,'updated_at':'21-04-14'}})
+        {'id': '9ef0ecafff7b248652b6c8a1a1c1631789265b60'}
+        >>> obj.get_key({'repository':{'id':1,'updated_at':'21-04-14'},'issue':{},'comment':{}})
+        {'id': '2045cd8b4437f384a7fe695807a97a4052d0bdfc'}
 
         """
         self.log.debug("fun : get hash key")
 
-        key = "%s%s%s" % (
-            record.get("repository", {}).get("updated_at", 0),
-            record.get("issue", {}).get("updated_at", 0),
-            record.get("comment", {}).get("updated_at", 0),
-        )
+        return {"id": record_key(record)}
+
+    def write_message(self, msg):
+        """
+        Buffers the msg and flushes the buffer once it is full or old
+
+        :param msg: dict
+
+        >>> obj = GithubHistory(targets=[], batch_size=2)
+        >>> obj.write_message({'id': 'a'})
+        >>> len(obj._buffer)
+        1
+        >>> obj.write_message({'id': 'b'})
+        >>> len(obj._buffer)
+        0
+
+        """
+        self.log.debug("write msgs in db")
 
-        # TODO: Need to add repo id
-        return {"id": hashlib.sha1(key).hexdigest()}
+        with self.profile.stage("write_message"):
+            if self.dedup.seen(msg["id"]):
+                return
+
+            with self._buffer_lock:
+                if not self._buffer:
+                    self._buffer_time = time.time()
+                self._buffer.append(msg)
+
+                full = len(self._buffer) >= self.batch_size
+                old = time.time() - self._buffer_time >= self.batch_age
+
+        if full or old:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered msgs to the targets, and waits for the buffers
+        other threads took before to be written too, so every msg buffered
+        before the call is written once it returns
+
+        :raises: what failed the write of any of those buffers
+
+        >>> import tempfile
+        >>> obj = GithubHistory(status_path=tempfile.mkdtemp() + '/', targets=[])
+        >>> earlier = {'done': False, 'error': IOError('target down')}
+        >>> obj._flushing.append(earlier)
+        >>> threading.Timer(0.1, lambda: obj.flushed(earlier)).start()
+        >>> obj.flush()
+        Traceback (most recent call last):
+        ...
+        IOError: target down
 
-    def send_msgs_to_target(self, target, msg):
+        """
+        self.log.debug("fun : flush")
+
+        batch = {"done": False, "error": None}
+        with self._buffer_lock:
+            msgs, self._buffer = self._buffer, []
+            earlier = list(self._flushing)
+            self._flushing.append(batch)
+
+        try:
+            with self.profile.stage("flush"):
+                self.write_messages(msgs)
+        except Exception as e:
+            batch["error"] = e
+            raise
+        finally:
+            self.flushed(batch)
+
+        with self._buffer_lock:
+            while not all(b["done"] for b in earlier):
+                self._buffer_lock.wait()
+
+        for b in earlier:
+            if b["error"] is not None:
+                raise b["error"]
+
+    def flushed(self, batch):
+        """
+        Marks a buffer taken by flush() as written, or failed
+
+        :param batch: dict
+
+        """
+        with self._buffer_lock:
+            batch["done"] = True
+            self._flushing.remove(batch)
+            self._buffer_lock.notify_all()
+
+    def send_batch_to_target(self, target, msgs):
         """
         :param target: db obj
-        :param msg: dict
+        :param msgs: list of dict
 
         """
-        self.log.debug("send msgs to tatgets")
+        self.log.debug("send batch to target")
+
+        name = target_name(target)
+        t = time.time()
+        try:
+            with self.profile.stage("insert:" + name):
+                insert_many = getattr(target, "insert_many", None)
+                if insert_many:
+                    insert_many(msgs)
+                else:
+                    for msg in msgs:
+                        target.insert_msg(msg)
+        except Exception:
+            metrics.WRITE_ERRORS.inc(target=name)
+            raise
+        finally:
+            metrics.WRITE_SECONDS.observe(time.time() - t, target=name)
+
+        metrics.RECORDS_WRITTEN.inc(len(msgs), target=name)
+        self.summary.count("targets", name, len(msgs))
+
+    def write_target(self, target, msgs):
+        """
+        Writes a batch to one target, run by its TargetWriter
 
-        target.insert_msg(msg)
+        :param target: db obj
+        :param msgs: list of dict
 
-    def write_message(self, msg):
         """
-        :param msg: dict
+        self.send_batch_to_target(target, msgs)
+
+        for fn in self.write_listeners:
+            fn(msgs)
 
+    def write_messages(self, msgs):
         """
-        self.log.debug("write msgs in db")
+        Writes a batch of msgs to every target. All targets share the same
+        read-only records; the first target is written from the calling
+        thread and the others from the pool. With target writers the batch
+        is handed to their queues, which keep it on disk until it's written,
+        so this doesn't wait for the targets and a checkpoint taken after it
+        never covers records that are only in memory.
+
+        :param msgs: list of dict
+        :raises HistoryClosed: once the history is closed, the batch isn't
+                written
+
+        >>> import tempfile
+        >>> from messagestore import MemoryStore
+        >>> obj = GithubHistory(status_path=tempfile.mkdtemp() + '/',
+        ...     targets=[MemoryStore()], target_queue_size=10)
+        >>> obj.write_messages([{'id': 'a'}])
+        >>> obj.close()
+        >>> obj.targets[0].records.keys(), obj.writers[0].stats()['written']
+        (['a'], 1)
+        >>> obj.write_messages([{'id': 'b'}])
+        Traceback (most recent call last):
+        ...
+        HistoryClosed: history closed, 1 records not written
+
+        """
+        self.log.debug("write batch in db")
+
+        msgs = [m for m in msgs if not self.dedup.seen(m["id"])]
+        if not (self.targets and msgs):
+            return
+
+        msgs = [m if isinstance(m, Record) else Record(m) for m in msgs]
 
-        if self.targets:
-            fn = self.send_msgs_to_target
+        if self.writers:
+            with self._lock:
+                self.check_open(msgs)
 
-            jobs = []
-            for t in self.targets:
-                jobs.append(self._pool.apply_async(fn, (t, deepcopy(msg))))
+            for w in self.writers:
+                w.put(msgs)
+            self.accepted(msgs)
+            return
 
+        fn = self.send_batch_to_target
+
+        with self._lock:
+            self.check_open(msgs)
+            self._writing += 1
+            jobs = [self._pool.apply_async(fn, (t, msgs)) for t in self.targets[1:]]
+
+        try:
+            fn(self.targets[0], msgs)
             for j in jobs:
                 j.wait()
 
-    def store_record(self, repo, issue=None, comment=None):
+            self.accepted(msgs)
+
+            for fn in self.write_listeners:
+                fn(msgs)
+        finally:
+            with self._lock:
+                self._writing -= 1
+                self._lock.notify_all()
+
+    def check_open(self, msgs):
+        """
+        :param msgs: list of dict, the batch about to be written
+        :raises HistoryClosed: when the history is closed
+
+        """
+        if self.closed:
+            raise HistoryClosed("history closed, %d records not written" % len(msgs))
+
+    def check_stopped(self):
+        """
+        :raises HistoryClosed: once the history is closing
+
+        """
+        if self.stopping.is_set():
+            raise HistoryClosed("history closing")
+
+    def accepted(self, msgs):
+        """
+        Marks a batch as handled: its ids are remembered and it is counted
+
+        :param msgs: list of dict
+
+        """
+        repos = {}
+        for m in msgs:
+            self.dedup.add(m["id"])
+            repo = (m.get("repository") or {}).get("full_name")
+            repos[repo] = repos.get(repo, 0) + 1
+
+        for repo, n in repos.items():
+            self.summary.count("repos", repo, n)
+
+        with self._lock:
+            self.written += len(msgs)
+
+    def store_record(self, repo, issue=None, comment=None, write=True):
         """
         :param repo:    class 'github.Repository.Repository'
         :param issue:   class 'github.Issue.Issue'
         :param comment: class 'github.IssueComment.IssueComment'
+        :param write:   bool, False only builds the record
 
         >>> obj = GithubHistory()
         >>> class repo(object):
@@ -175,24 +660,27 @@ class GithubHistory(object):
         ...      __dict__ = {'_rawData':{'id':91011}}
         ...
         >>> obj.store_record(repo(), issue(), comment())
-        {'comment': {'id': 91011}, 'issue': {'id': 5678}, 'id': '8aefb06c426e07a0a671a1e2488b4858d694a730', 'repository': {'id': 1234}}
+        {'comment': {'id': 91011}, 'issue': {'id': 5678}, 'id': 'c252de3d97fe6389a52c5beb343cf55963cac5a8', 'repository': {'id': 1234}}
 
         """
         self.log.debug("fun : store record")
 
-        iss = cmnt = {}
-        rp = self.get_repo_dict(repo)
+        with self.profile.stage("build_record"):
+            iss = cmnt = {}
+            rp = self.get_repo_dict(repo)
 
-        if issue:
-            iss = self.get_issue_dict(issue)
+            if issue:
+                iss = self.get_issue_dict(issue)
 
-        if issue and comment:
-            cmnt = self.get_comment_dict(comment)
+            if issue and comment:
+                cmnt = self.get_comment_dict(comment)
 
-        record = self.merge_dict(rp, iss, cmnt)
-        record.update(self.get_key(record))
+            record = self.merge_dict(rp, iss, cmnt)
+            record.update(self.get_key(record))
+            record = Record(record)
 
-        self.write_message(record)
+        if write:
+            self.write_message(record)
         return record
 
     def get_repo_dict(self, repo):
@@ -221,12 +709,70 @@ class GithubHistory(object):
         org_dict = {}
 
         if repo.owner.type == "Organization":
-            org = self.git.get_organization(str(repo.owner.login))
-            org_dict = {"organization": self.get_raw_data(org)}
+            org_dict = {"organization": self.get_org_raw(repo.owner.login)}
+
+        raw = self.get_raw_data(repo)
+        if raw.get("full_name"):
+            self.repo_cache.set(raw["full_name"], raw)
 
-        repo_dict = {"repository": self.get_raw_data(repo)}
+        repo_dict = {"repository": raw}
         return self.merge_dict(org_dict, repo_dict)
 
+    def get_org_raw(self, login):
+        """
+        Raw data of the organization, from the cache when possible
+
+        :param login: string
+        :rtype: dict
+
+        >>> from mock import Mock
+        >>> class org(object):
+        ...     __dict__ = {'_rawData':{'id':'12345'}}
+        ...
+        >>> obj=GithubHistory()
+        >>> obj.git.get_organization = Mock(obj.git.get_organization,return_value=org())
+        >>> obj.get_org_raw('orgname')
+        {'id': '12345'}
+        >>> obj.get_org_raw('orgname')
+        {'id': '12345'}
+        >>> obj.git.get_organization.call_count
+        1
+
+        """
+        self.log.debug("fun : get org raw")
+
+        login = str(login)
+        raw = self.org_cache.get(login)
+        if raw is None:
+            with self.profile.stage("get_organization"):
+                raw = self.get_raw_data(self.git.get_organization(login))
+            self.org_cache.set(login, raw)
+
+        return raw
+
+    def warm_cache(self, record):
+        """
+        Seeds the caches from a webhook payload that embeds
+        organization/repository objects
+
+        :param record: dict
+
+        >>> obj = GithubHistory()
+        >>> obj.warm_cache({'organization': {'login': 'org'}, 'repository': {'full_name': 'org/repo'}})
+        >>> obj.get_org_raw('org')
+        {'login': 'org'}
+
+        """
+        self.log.debug("fun : warm cache")
+
+        org = record.get("organization") or {}
+        if org.get("login"):
+            self.org_cache.set(str(org["login"]), org)
+
+        repo = record.get("repository") or {}
+        if repo.get("full_name"):
+            self.repo_cache.set(str(repo["full_name"]), repo)
+
     def get_issue_dict(self, issue):
         """
         :param issue: class 'github.Issue.Issue'
@@ -279,19 +825,19 @@ class GithubHistory(object):
 
     def check_rate_limit(self):
         """
-        Checks no of api calls remaining before going to any function
-        if remaining calls of range less than 100 calls wait for some time.
+        Takes one call from the api budget shared by all the crawl workers,
+        waiting when the budget is spent.
 
         """
         self.log.debug("fun :check api rate limit")
 
-        remaining, total = self.git.rate_limiting
+        # a closing history makes no more calls
+        self.check_stopped()
 
-        if remaining > 1 and remaining < 100:
-            expiry = self.git.rate_limiting_resettime
-            delay = (expiry - time.time()) + 60
-            self.log.info("waiting for " + str(delay) + " sec")
-            time.sleep(delay)
+        with self.profile.stage("rate_limit_wait"):
+            self.limiter.acquire(self.stopping)
+
+        self.check_stopped()
 
     def get_comments(self, repo, issue, changes=None):
         """
@@ -317,7 +863,8 @@ class GithubHistory(object):
             last_time = self.get_time(changes)
 
         # get and store the comments since issue created or last issue comment updated time(in case of new comments)
-        for comment in issue.get_comments(since=last_time):
+        comments = issue.get_comments(since=last_time)
+        for comment in self.profile.timed_iter("list_comments", comments):
             self.store_record(repo, issue, comment)
 
         self.store_record(repo, issue)
@@ -328,28 +875,472 @@ class GithubHistory(object):
 
         :param repo: class 'github.Repository.Repository'
 
+        A pass that stopped part way resumes after the last issue it
+        crawled, even when issues closed since moved the rest to earlier
+        pages:
+
+        >>> import tempfile
+        >>> obj = GithubHistory(status_path=tempfile.mkdtemp() + '/')
+        >>> obj.git.per_page = 2
+        >>> obj.check_rate_limit = lambda: None
+        >>> crawled = []
+        >>> obj.crawl_issue = lambda repo, issue: crawled.append(obj.get_raw_data(issue)['number'])
+        >>> class Issue(object):
+        ...     def __init__(self, n):
+        ...         self.__dict__['_rawData'] = {'number': n, 'updated_at': 'u'}
+        ...
+        >>> class Listing(object):
+        ...     def get_page(self, page):
+        ...         return [Issue(n) for n in open_issues[page * 2 : page * 2 + 2]]
+        ...
+        >>> class repo(object):
+        ...     full_name = 'org/repo'
+        ...     get_issues = staticmethod(lambda **kwargs: Listing())
+        ...
+        >>> obj.checkpoints.update('org/repo', page=2, number=4, completed=False)
+        >>> open_issues = [3, 4, 5, 6]
+        >>> obj.get_issues(repo)
+        >>> sorted(crawled), obj.checkpoints.get('org/repo')['completed']
+        ([5, 6], True)
+
         """
         self.log.debug("fun : get issues")
 
+        cp = self.checkpoints.get(repo.full_name)
+        if cp.get("completed") and not self.repo_changed(repo, cp):
+            self.log.info("Repo unchanged since checkpoint", repo=repo.full_name)
+            return
+
+        # resume a pass that stopped part way, otherwise start over. Oldest
+        # first so new issues land on the last pages. Issues closed since
+        # move the later ones to earlier pages, so the resumed page is
+        # stepped back until it starts at or before the last issue crawled,
+        # and the issues up to that one are skipped.
+        resume = not cp.get("completed") and cp.get("number") is not None
+        page = cp.get("page", 0) if resume else 0
+        last = cp.get("number") if resume else None
+        updated_at = cp.get("updated_at")
+        issues = repo.get_issues(sort="created", direction="asc")
+
+        def number(issue):
+            return self.get_raw_data(issue)["number"]
+
+        def crawl(issue):
+            self.check_stopped()
+
+            # the issue workers' stages count towards the repo
+            with self.profile.repo(repo.full_name):
+                self.crawl_issue(repo, issue)
+
+        while True:
+            self.check_rate_limit()
+            with self.profile.stage("list_issues"):
+                items = issues.get_page(page)
+
+            if last is not None:
+                if page and (not items or number(items[0]) > last):
+                    page -= 1
+                    continue
+                items = [i for i in items if number(i) > last]
+                last = None
+            elif not items:
+                break
+
+            for _ in self._issue_pool.imap_unordered(crawl, items):
+                pass
+
+            # the page only counts as done once its records are written
+            self.flush()
+
+            page += 1
+            for issue in items:
+                updated_at = max(
+                    updated_at or "", self.get_raw_data(issue)["updated_at"]
+                )
+            self.checkpoints.update(
+                repo.full_name,
+                page=page,
+                number=max([cp.get("number")] + [number(i) for i in items]),
+                updated_at=updated_at,
+                completed=False,
+            )
+
+        self.checkpoints.update(repo.full_name, page=page, number=None, completed=True)
+
+    def repo_changed(self, repo, cp):
+        """
+        Whether any open issue of the repo was updated after the checkpoint,
+        checked with a single "issues updated since" request
+
+        :param repo: class 'github.Repository.Repository'
+        :param cp: dict, checkpoint of the repo
+        :rtype: bool
+
+        """
+        self.log.debug("fun : repo changed")
+
+        if not cp.get("updated_at"):
+            return True
+
         self.check_rate_limit()
-        for issue in repo.get_issues():
+        since = datetime.strptime(cp["updated_at"], "%Y-%m-%dT%H:%M:%SZ")
+        for issue in repo.get_issues(since=since).get_page(0):
+            # since is inclusive, the issue at the mark itself is not a change
+            if self.get_raw_data(issue)["updated_at"] > cp["updated_at"]:
+                return True
+
+        return False
+
+    def crawl_issue(self, repo, issue):
+        """
+        Stores the comments of the issue that are not in the db yet
+
+        :param repo: class 'github.Repository.Repository'
+        :param issue: class 'github.Issue.Issue'
 
-            # getting issue dict from issue obj as iss
-            iss = self.get_issue_dict(issue)
+        """
+        self.log.debug("fun : crawl issue")
+
+        # getting issue dict from issue obj as iss
+        iss = self.get_issue_dict(issue)
 
-            # passing the issue dict and checking in db for issue related records and changes
-            # returns (count as 0 or 1),(changes as 0 or time in '2018-02-15T09:17:49Z' format)
+        # passing the issue dict and checking in db for issue related records and changes
+        # returns (count as 0 or 1),(changes as 0 or time in '2018-02-15T09:17:49Z' format)
+        with self.profile.stage("check_issue_in_db"):
             count, changes = self.store.check_issue_in_db(iss)
 
-            # if no records and no changes found realted to issue in db,then get all the comments
-            if count is 0:
-                self.get_comments(repo, issue)
+        # if no records and no changes found realted to issue in db,then get all the comments
+        if count is 0:
+            self.get_comments(repo, issue)
+            return
+
+        # if records present in db,but the current issue updated time not matched with the last comment
+        # updated time in db,so get the msgs from last comment updated time.
+        if changes:
+            self.get_comments(repo, issue, changes)
+
+    def get_issue_number(self, comment_raw):
+        """
+        :param comment_raw: dict
+        :rtype: int
+
+        >>> obj = GithubHistory()
+        >>> obj.get_issue_number({'issue_url': 'https://api.github.com/repos/org/repo/issues/42'})
+        42
+
+        """
+        self.log.debug("fun : get issue number")
+
+        return int(comment_raw["issue_url"].rsplit("/", 1)[1])
+
+    def iter_pages(self, listing):
+        """
+        Items of a paginated listing, fetched a page at a time within the
+        api budget; the records of a page are written before the next one
+        is requested
+
+        :param listing: class 'github.PaginatedList.PaginatedList'
+        :rtype: iterator
+
+        """
+        page = 0
+        while True:
+            self.check_rate_limit()
+            with self.profile.stage("list_page"):
+                items = listing.get_page(page)
+            if not items:
+                return
+
+            for item in items:
+                yield item
+
+            self.flush()
+            page += 1
+
+            # a short page is the last one, no need to ask for an empty one
+            if len(items) < self.git.per_page:
+                return
+
+    def sync_repo(self, repo):
+        """
+        Incremental sync of a repo: lists the issues and the issue comments
+        updated since the repo's high-water mark with one repository level
+        listing each, instead of one comments call per issue.
+
+        The high-water mark is kept in the repo's checkpoint. It is the
+        latest updated_at of the issue listing, or of the comment listing
+        when that is older: an issue edited while the comments are listed
+        can be older than the latest comment, and a mark past it would
+        never list it again.
+
+        :param repo: class 'github.Repository.Repository'
+
+        """
+        self.log.debug("fun : sync repo")
+
+        mark = self.checkpoints.get(repo.full_name).get("updated_at")
+
+        kwargs = {}
+        if mark:
+            kwargs["since"] = datetime.strptime(mark, "%Y-%m-%dT%H:%M:%SZ")
+
+        issues = {}
+        issues_mark, comments_mark = mark, None
+        for issue in self.iter_pages(repo.get_issues(state="all", **kwargs)):
+            raw = self.get_raw_data(issue)
+            issues[raw["number"]] = issue
+            issues_mark = max(issues_mark or "", raw["updated_at"])
+            self.store_record(repo, issue)
+
+        for comment in self.iter_pages(repo.get_issues_comments(**kwargs)):
+            raw = self.get_raw_data(comment)
+
+            # a comment updated since the mark also bumps its issue, so the
+            # issue is normally already in the listing above
+            number = self.get_issue_number(raw)
+            issue = issues.get(number)
+            if issue is None:
+                self.check_rate_limit()
+                issue = issues[number] = repo.get_issue(number)
+
+            comments_mark = max(comments_mark or "", raw["updated_at"])
+            self.store_record(repo, issue, comment)
+
+        # since is inclusive, what is listed again is dropped by the dedup
+        mark = issues_mark
+        if issues_mark and comments_mark:
+            mark = min(issues_mark, comments_mark)
+
+        # only move the mark once everything before it is written
+        self.flush()
+        self.checkpoints.update(repo.full_name, updated_at=mark or None, completed=True)
+
+        self.log.info(
+            "Repo synced", repo=repo.full_name, issues=len(issues), since=mark
+        )
+
+    def fetch_page(self, listing, page):
+        """
+        One page of a listing and the number of pages, from the Link header
+        that came with it, so the page isn't asked for twice
+
+        :param listing: class 'github.PaginatedList.PaginatedList'
+        :param page: int
+        :rtype: (list, int or None) the items, and the number of pages or
+                None when the api doesn't tell
+
+        >>> obj = GithubHistory()
+        >>> obj.check_rate_limit = lambda: None
+        >>> class Issue(object):
+        ...     _headers = {'link': '<https://api.github.com/x?page=3>; rel="next", '
+        ...                            '<https://api.github.com/x?page=7>; rel="last"'}
+        ...
+        >>> class Listing(object):
+        ...     def get_page(self, page):
+        ...         return [Issue()] if page < 7 else []
+        ...
+        >>> len(obj.fetch_page(Listing(), 1)[0]), obj.fetch_page(Listing(), 1)[1]
+        (1, 7)
+        >>> obj.fetch_page(Listing(), 7)
+        ([], 7)
+
+        """
+        self.check_rate_limit()
+        with self.profile.stage("list_page"):
+            items = listing.get_page(page)
+
+        if not items:
+            return items, page
+
+        # the headers the items were built from; raw_headers would fetch
+        # the item on its own
+        links = {}
+        for link in (items[0]._headers.get("link") or "").split(", "):
+            url, _, rel = link.partition("; ")
+            links[rel[len('rel="') : -1]] = url[1:-1]
+
+        if "last" in links:
+            query = urlparse.parse_qs(urlparse.urlparse(links["last"]).query)
+            return items, int(query["page"][0])
+
+        # the last page has no rel="last" link, nor a next one
+        if "next" not in links:
+            return items, page + 1
+
+        return items, None
+
+    def backfill_page(self, repo, listing, page, items=None):
+        """
+        Stores every issue of one page of the listing with all its comments,
+        as a single batch
+
+        :param repo: class 'github.Repository.Repository'
+        :param listing: class 'github.PaginatedList.PaginatedList'
+        :param page: int
+        :param items: list, the page when it's already fetched
+        :rtype: (int, int, string) the page, issues on it and their latest
+                updated_at
+
+        """
+        self.log.debug("fun : backfill page")
+
+        if items is None:
+            self.check_rate_limit()
+            with self.profile.stage("list_page"):
+                items = listing.get_page(page)
+
+        records = []
+        updated_at = None
+        for issue in items:
+            raw = self.get_raw_data(issue)
+            updated_at = max(updated_at or "", raw["updated_at"])
+
+            records.append(self.store_record(repo, issue, write=False))
+            if raw.get("comments"):
+                for comment in self.iter_pages(issue.get_comments()):
+                    records.append(self.store_record(repo, issue, comment, write=False))
+
+        for i in range(0, len(records), self.backfill_batch):
+            self.write_messages(records[i : i + self.backfill_batch])
+
+        return page, len(items), updated_at
+
+    def backfill_repo(self, repo):
+        """
+        Stores every issue of the repo, open and closed, with all its
+        comments. When the number of pages is known they are fetched in
+        parallel by the backfill pool, otherwise one after the other.
+
+        Progress is checkpointed as the first page not yet stored, and the
+        latest updated_at seen becomes the repo's high-water mark so the
+        incremental mode carries on from where the backfill ended.
+
+        :param repo: class 'github.Repository.Repository'
+
+        """
+        self.log.debug("fun : backfill repo")
+
+        cp = self.checkpoints.get(repo.full_name)
+        if cp.get("backfilled"):
+            self.log.info("Repo already backfilled", repo=repo.full_name)
+            return
+
+        listing = repo.get_issues(state="all", sort="created", direction="asc")
+        start = cp.get("backfill_page", 0)
+
+        # the page the pass starts at tells the number of pages too
+        first, pages = self.fetch_page(listing, start)
+
+        def fetch(page):
+            with self.profile.repo(repo.full_name):
+                items = first if page == start else None
+                return self.backfill_page(repo, listing, page, items)
+
+        if pages is None:
+            # no page count, one page after the other until an empty one
+            results = itertools.imap(fetch, itertools.count(start))
+        else:
+            results = self._backfill_pool.imap_unordered(fetch, range(start, pages))
+
+        done, next_page, issues = set(), start, 0
+        mark = cp.get("updated_at")
+
+        for page, count, updated_at in results:
+            if not count:
+                if pages is None:
+                    break
                 continue
 
-            # if records present in db,but the current issue updated time not matched with the last comment
-            # updated time in db,so get the msgs from last comment updated time.
-            if changes:
-                self.get_comments(repo, issue, changes)
+            issues += count
+            mark = max(mark or "", updated_at)
+
+            # pages finish out of order; the checkpoint only moves past
+            # pages that are all stored
+            done.add(page)
+            while next_page in done:
+                done.remove(next_page)
+                next_page += 1
+            self.checkpoints.update(repo.full_name, backfill_page=next_page)
+
+        if not issues and not start:
+            self.store_record(repo)
+
+        self.flush()
+        self.checkpoints.update(
+            repo.full_name, backfilled=True, completed=True, updated_at=mark or None
+        )
+        self.log.info("Repo backfilled", repo=repo.full_name, issues=issues)
+
+    def crawl_repo(self, repo):
+        """
+        Syncs one repo, run by the repo workers
+
+        :param repo: class 'github.Repository.Repository'
+
+        """
+        self.log.debug("fun : crawl repo")
+
+        # repos named in the config are resolved here, by the worker, on
+        # their first attribute access; until then only the url is known
+        name = repo._rawData.get("full_name") or repo.url.split("/repos/", 1)[-1]
+
+        if self.stopping.is_set():
+            return
+
+        t = time.time()
+        try:
+            with self.profile.repo(name), self.profile.stage("repo"):
+                self.sync_one(repo, name)
+        except HistoryClosed:
+            self.log.info("Repo sync stopped, history closing", repo=name)
+        except Exception as e:
+            # one failing repo should not stop the others
+            self.log.exception(e, repo=name)
+        finally:
+            elapsed = time.time() - t
+            metrics.REPO_SYNC_SECONDS.observe(elapsed, mode=self.sync_mode)
+            metrics.REPO_LAST_SYNC_TIME.set(time.time())
+            if self.progress:
+                self.progress(repo=name, seconds=elapsed, records=self.written)
+
+    def sync_one(self, repo, name):
+        """
+        Syncs one repo with the engine and sync mode
+
+        :param repo: class 'github.Repository.Repository'
+        :param name: string, its full name
+
+        """
+        if self.engine is not None:
+            self.engine.crawl_repo(self, name)
+            self.dd["repository"] = name
+            return
+
+        self.check_rate_limit()
+        if self.sync_mode == "incremental":
+            self.sync_repo(repo)
+            self.dd["repository"] = repo.full_name
+            return
+
+        # closed issues too, even of repos with no open issue
+        if self.sync_mode == "backfill":
+            self.backfill_repo(repo)
+            self.dd["repository"] = repo.full_name
+            return
+
+        # if repo doesn't contain any issues just store the record
+        if repo.open_issues is 0:
+            self.store_record(repo)
+            return
+
+        # get the issues related to the repo
+        self.get_issues(repo)
+
+        # write what is buffered before marking the repo as done
+        self.flush()
+
+        # store the status in disk dict
+        self.dd["repository"] = repo.full_name
 
     def get_history(self):
         """
@@ -360,18 +1351,62 @@ class GithubHistory(object):
         """
         self.log.debug("fun : get history")
 
-        for repo in self.get_repos_list():
-
-            # if repo doesn't contain any issues just store the record
-            if repo.open_issues is 0:
-                self.store_record(repo)
+        self.profile.reset()
+        if self.sampler:
+            self.sampler.start()
+
+        # at most two repos per worker are handed to the pool ahead of the
+        # workers, so a long repo list is streamed rather than queued whole
+        slots = threading.BoundedSemaphore(self.workers * 2)
+
+        def pending(repos):
+            for repo in repos:
+                slots.acquire()
+                # closing: no more repos, so the pool can be joined
+                if self.stopping.is_set():
+                    slots.release()
+                    return
+                yield repo
+
+        def crawl(repo):
+            try:
+                self.crawl_repo(repo)
+            finally:
+                slots.release()
+
+        # waited on in steps, a blocking wait would hold off the signal
+        # handlers until a repo finishes
+        results = self._repo_pool.imap_unordered(crawl, pending(self.get_repos_list()))
+        while True:
+            try:
+                results.next(1)
+            except TimeoutError:
                 continue
+            except StopIteration:
+                break
+
+        if self.stopping.is_set():
+            self.log.info("History pass stopped, history closing")
+            return
+
+        self.flush()
+        self.checkpoints.flush()
+        self.summary.flush()
+        self.log.info(
+            "History pass done",
+            org_cache=self.org_cache.stats(),
+            repo_cache=self.repo_cache.stats(),
+            rate_limit_sleep=self.limiter.slept,
+            http_cache=self.http_cache.stats() if self.http_cache else {},
+        )
 
-            # get the issues related to the repo
-            self.get_issues(repo)
-
-            # store the status in disk dict
-            self.dd["repository"] = repo.full_name
+        if self.profile.enabled:
+            self.profile.write_report(
+                self.status_path + time.strftime("profile-%Y%m%dT%H%M%S.json"),
+                log=self.log,
+            )
+        if self.sampler:
+            self.sampler.stop(self.profile_dump)
 
     def start(self):
         self.log.debug("fun : start")
@@ -379,10 +1414,108 @@ class GithubHistory(object):
         # create db obj at 0th index from target
         self.store = self.targets[0]
 
-        if "repository" not in self.dd.keys():
+        if self.dd.get("repository") is None:
             self.get_history()
 
         # recheck for new messages
-        self.get_history()
+        if not self.stopping.is_set():
+            self.get_history()
 
         self.log.info("Messages stored successfully")
+
+    def health(self):
+        """
+        Reports whether every target is reachable
+
+        :rtype: dict
+
+        >>> obj = GithubHistory(targets=[])
+        >>> obj.health()['targets']
+        {}
+
+        """
+        self.log.debug("fun : health")
+
+        targets = {}
+        for t in self.targets or []:
+            name = target_name(t)
+            try:
+                targets[name] = t.ping()
+            except Exception as e:
+                self.log.exception(e)
+                targets[name] = False
+
+        return {
+            "closed": self.closed,
+            "targets": targets,
+            "writers": dict((w.name, w.stats()) for w in self.writers),
+            "cache": {
+                "organization": self.org_cache.stats(),
+                "repository": self.repo_cache.stats(),
+                "http": self.http_cache.stats() if self.http_cache else {},
+                "dedup": self.dedup.stats(),
+            },
+        }
+
+    def close(self):
+        """
+        Stops the crawl, stops accepting writes, waits for the pending ones
+        to finish and closes the targets and the status store.
+
+        Repos the crawl was in the middle of stop without being checkpointed
+        past what was written, so the next run fetches the rest of them.
+
+        >>> import tempfile
+        >>> from messagestore import MemoryStore
+        >>> obj = GithubHistory(status_path=tempfile.mkdtemp() + '/', targets=[MemoryStore()])
+        >>> obj.close()
+        >>> obj.check_rate_limit()
+        Traceback (most recent call last):
+        ...
+        HistoryClosed: history closing
+
+        """
+        self.log.debug("fun : close")
+
+        # crawl workers stop at their next page, issue or api call
+        self.stopping.set()
+
+        try:
+            self.flush()
+        except Exception as e:
+            # the crawl that buffered them fails too, the targets are still
+            # closed
+            self.log.exception(e)
+
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+
+            # wait for the writes running in caller threads
+            while self._writing:
+                self._lock.wait()
+
+        for pool in (
+            self._repo_pool,
+            self._issue_pool,
+            self._backfill_pool,
+            self._pool,
+        ):
+            pool.close()
+            pool.join()
+
+        # what the writers hold is written, or spooled for the next run
+        for w in self.writers:
+            w.stop()
+
+        for t in self.targets or []:
+            t.close()
+
+        if self.http_cache:
+            self.http_cache.close()
+
+        self.checkpoints.flush()
+        self.dedup.save()
+        self.summary.flush()
+        self.dd.close()
@@ -0,0 +1,614 @@
+import time
+from urllib import quote
+from functools import partial
+
+from github import Github
+from github.MainClass import DEFAULT_BASE_URL
+from deeputil import Dummy
+
+from util import Record
+from ratelimit import RateLimiter
+
+DUMMY_LOG = Dummy()
+
+ACTOR_FIELDS = (
+    "__typename login url ... on User { databaseId } ... on Bot { databaseId }"
+)
+
+REPO_FIELDS = """
+    databaseId name nameWithOwner description url isPrivate isFork
+    createdAt updatedAt pushedAt
+    owner {
+        __typename login
+        ... on User { databaseId }
+        ... on Organization { databaseId description url createdAt updatedAt }
+    }
+    openIssues: issues(states: OPEN) { totalCount }
+"""
+
+COMMENT_FIELDS = """
+    databaseId body url createdAt updatedAt authorAssociation author { %s }
+""" % (ACTOR_FIELDS)
+
+# the fields issues and pull requests share, with the first page of their
+# comments
+ISSUE_FIELDS = """
+    __typename databaseId number title body state locked url createdAt
+    updatedAt closedAt authorAssociation
+    author { %s }
+    assignees(first: 10) { nodes { login url databaseId } }
+    labels(first: 20) { nodes { name color description isDefault } }
+    milestone {
+        databaseId number title description state url dueOn createdAt
+        updatedAt closedAt
+    }
+    comments(first: $comments) {
+        totalCount
+        pageInfo { hasNextPage endCursor }
+        nodes { %s }
+    }
+""" % (
+    ACTOR_FIELDS,
+    COMMENT_FIELDS,
+)
+
+QUERIES = {
+    "RepoIssues": """
+query RepoIssues($owner: String!, $name: String!, $first: Int!, $comments: Int!,
+                 $after: String, $since: DateTime, $states: [IssueState!]) {
+  repository(owner: $owner, name: $name) {
+    %s
+    issues(first: $first, after: $after, states: $states, filterBy: {since: $since},
+           orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { %s }
+    }
+  }
+}"""
+    % (REPO_FIELDS, ISSUE_FIELDS),
+    # pull requests can't be filtered by update time, so they are listed
+    # latest update first until one older than the high-water mark
+    "RepoPullRequests": """
+query RepoPullRequests($owner: String!, $name: String!, $first: Int!,
+                       $comments: Int!, $after: String,
+                       $states: [PullRequestState!]) {
+  repository(owner: $owner, name: $name) {
+    %s
+    pullRequests(first: $first, after: $after, states: $states,
+                 orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { %s mergedAt }
+    }
+  }
+}"""
+    % (REPO_FIELDS, ISSUE_FIELDS),
+    "IssueComments": """
+query IssueComments($owner: String!, $name: String!, $number: Int!, $first: Int!,
+                    $after: String) {
+  repository(owner: $owner, name: $name) {
+    issueOrPullRequest(number: $number) {
+      ... on Issue { comments(first: $first, after: $after) { ...page } }
+      ... on PullRequest { comments(first: $first, after: $after) { ...page } }
+    }
+  }
+}
+
+fragment page on IssueCommentConnection {
+  pageInfo { hasNextPage endCursor }
+  nodes { %s }
+}"""
+    % COMMENT_FIELDS,
+}
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def graphql_url(base_url):
+    """
+    The GraphQL endpoint that goes with a REST api base url
+
+    :param base_url: string
+    :rtype: string
+
+    >>> graphql_url('https://api.github.com')
+    'https://api.github.com/graphql'
+    >>> graphql_url('https://github.example.com/api/v3')
+    'https://github.example.com/api/graphql'
+
+    """
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/api/v3"):
+        base_url = base_url[: -len("/v3")]
+
+    return base_url + "/graphql"
+
+
+def get_quota(requester):
+    """
+    :param requester: class 'github.Requester.Requester'
+    :rtype: (int, int, float) points left, the limit and the epoch they
+            reset at
+
+    """
+    remaining, limit = requester.rate_limiting
+    if limit < 0:
+        # nothing asked yet, assume the full hourly budget
+        return 5000, 5000, time.time() + 3600
+
+    return remaining, limit, requester.rate_limiting_resettime
+
+
+def rest_user(actor, api_url):
+    """
+    :param actor: dict, GraphQL Actor
+    :param api_url: string, REST api base url
+    :rtype: dict as in the REST api, None for a deleted user
+
+    >>> rest_user({'__typename': 'Bot', 'login': 'ci', 'databaseId': 3,
+    ...     'url': 'https://github.com/apps/ci'}, 'https://api.github.com')['type']
+    'Bot'
+
+    """
+    if not actor:
+        return None
+
+    return {
+        "login": actor["login"],
+        "id": actor.get("databaseId"),
+        "type": actor.get("__typename", "User"),
+        "url": "%s/users/%s" % (api_url, actor["login"]),
+        "html_url": actor.get("url"),
+    }
+
+
+def rest_repo(node, api_url):
+    """
+    :param node: dict, GraphQL Repository
+    :param api_url: string, REST api base url
+    :rtype: dict as in the REST api
+
+    >>> rest_repo({'databaseId': 1, 'name': 'repo', 'nameWithOwner': 'org/repo',
+    ...     'description': None, 'url': 'https://github.com/org/repo',
+    ...     'isPrivate': False, 'isFork': False, 'createdAt': 'c', 'updatedAt': 'u',
+    ...     'pushedAt': 'p', 'openIssues': {'totalCount': 2},
+    ...     'owner': {'__typename': 'Organization', 'login': 'org', 'databaseId': 9}},
+    ...     'https://api.github.com')['url']
+    'https://api.github.com/repos/org/repo'
+
+    """
+    owner = node["owner"]
+    open_issues = node["openIssues"]["totalCount"]
+
+    return {
+        "id": node["databaseId"],
+        "name": node["name"],
+        "full_name": node["nameWithOwner"],
+        "owner": {
+            "login": owner["login"],
+            "id": owner.get("databaseId"),
+            "type": owner["__typename"],
+        },
+        "description": node["description"],
+        "private": node["isPrivate"],
+        "fork": node["isFork"],
+        "html_url": node["url"],
+        "url": "%s/repos/%s" % (api_url, node["nameWithOwner"]),
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "pushed_at": node["pushedAt"],
+        "open_issues": open_issues,
+        "open_issues_count": open_issues,
+    }
+
+
+def rest_org(owner, api_url):
+    """
+    :param owner: dict, GraphQL RepositoryOwner
+    :param api_url: string, REST api base url
+    :rtype: dict as in the REST api, None when the owner is a user
+
+    """
+    if owner["__typename"] != "Organization":
+        return None
+
+    return {
+        "id": owner["databaseId"],
+        "login": owner["login"],
+        "description": owner.get("description"),
+        "html_url": owner.get("url"),
+        "url": "%s/orgs/%s" % (api_url, owner["login"]),
+        "created_at": owner.get("createdAt"),
+        "updated_at": owner.get("updatedAt"),
+    }
+
+
+def rest_label(node, repo_url):
+    return {
+        "name": node["name"],
+        "color": node["color"],
+        "description": node.get("description"),
+        "default": node.get("isDefault", False),
+        "url": "%s/labels/%s" % (repo_url, quote(node["name"].encode("utf-8"))),
+    }
+
+
+def rest_milestone(node, repo_url):
+    if not node:
+        return None
+
+    return {
+        "id": node["databaseId"],
+        "number": node["number"],
+        "title": node["title"],
+        "description": node["description"],
+        "state": node["state"].lower(),
+        "html_url": node["url"],
+        "url": "%s/milestones/%d" % (repo_url, node["number"]),
+        "due_on": node["dueOn"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "closed_at": node["closedAt"],
+    }
+
+
+def rest_issue(node, repo_url):
+    """
+    :param node: dict, GraphQL Issue or PullRequest
+    :param repo_url: string, REST url of its repository
+    :rtype: dict as in the REST api's issue listing, where a pull request
+            is an issue with a `pull_request` member
+
+    >>> issue = rest_issue({'databaseId': 5, 'number': 2, 'title': 't',
+    ...     'body': 'b', 'state': 'MERGED', 'locked': False,
+    ...     'url': 'https://github.com/org/repo/pull/2', 'createdAt': 'c',
+    ...     'updatedAt': 'u', 'closedAt': 'd', 'author': {'login': 'a'},
+    ...     'authorAssociation': 'MEMBER', 'assignees': {'nodes': []},
+    ...     'labels': {'nodes': [{'name': 'bug fix', 'color': 'f00'}]},
+    ...     'milestone': None, 'comments': {'totalCount': 3},
+    ...     '__typename': 'PullRequest', 'mergedAt': 'd'},
+    ...     'https://api.github.com/repos/org/repo')
+    >>> issue['state'], issue['comments'], issue['url'], issue['author_association']
+    ('closed', 3, 'https://api.github.com/repos/org/repo/issues/2', 'MEMBER')
+    >>> issue['pull_request']['url'], issue['labels'][0]['url']
+    ('https://api.github.com/repos/org/repo/pulls/2', 'https://api.github.com/repos/org/repo/labels/bug%20fix')
+
+    """
+    api_url = repo_url.split("/repos/", 1)[0]
+    assignees = [rest_user(a, api_url) for a in node["assignees"]["nodes"]]
+
+    issue = {
+        "id": node["databaseId"],
+        "number": node["number"],
+        "title": node["title"],
+        "body": node["body"],
+        # a merged pull request is a closed issue
+        "state": "open" if node["state"] == "OPEN" else "closed",
+        "locked": node["locked"],
+        "user": rest_user(node["author"], api_url),
+        "author_association": node["authorAssociation"],
+        "assignee": assignees[0] if assignees else None,
+        "assignees": assignees,
+        "labels": [rest_label(l, repo_url) for l in node["labels"]["nodes"]],
+        "milestone": rest_milestone(node["milestone"], repo_url),
+        "comments": node["comments"]["totalCount"],
+        "html_url": node["url"],
+        "url": "%s/issues/%d" % (repo_url, node["number"]),
+        "repository_url": repo_url,
+        "comments_url": "%s/issues/%d/comments" % (repo_url, node["number"]),
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "closed_at": node["closedAt"],
+    }
+
+    if node.get("__typename") == "PullRequest":
+        issue["pull_request"] = {
+            "url": "%s/pulls/%d" % (repo_url, node["number"]),
+            "html_url": node["url"],
+            "diff_url": node["url"] + ".diff",
+            "patch_url": node["url"] + ".patch",
+        }
+
+    return issue
+
+
+def rest_comment(node, issue):
+    """
+    :param node: dict, GraphQL IssueComment
+    :param issue: dict, its issue from rest_issue
+    :rtype: dict as in the REST api
+
+    >>> rest_comment({'databaseId': 7, 'body': 'b', 'url': 'h', 'createdAt': 'c',
+    ...     'updatedAt': 'u', 'author': None, 'authorAssociation': 'NONE'},
+    ...     {'url': 'https://api.github.com/repos/org/repo/issues/2',
+    ...      'repository_url': 'https://api.github.com/repos/org/repo'})['url']
+    'https://api.github.com/repos/org/repo/issues/comments/7'
+
+    """
+    api_url = issue["repository_url"].split("/repos/", 1)[0]
+
+    return {
+        "id": node["databaseId"],
+        "body": node["body"],
+        "user": rest_user(node["author"], api_url),
+        "author_association": node["authorAssociation"],
+        "html_url": node["url"],
+        "url": "%s/issues/comments/%d" % (issue["repository_url"], node["databaseId"]),
+        "issue_url": issue["url"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+    }
+
+
+class GraphQLEngine(object):
+    """
+    Fetch engine that reads a repo with batched GraphQL queries: a page of
+    `page_size` issues (then of pull requests) comes with its first
+    `comments` comments of each issue and the repository/organization data
+    in one query, later comments are paged per issue. The nodes are mapped
+    to the REST api's json, so the records have the same ids and the
+    fields of `GithubHistory.store_record`'s, except those GraphQL has no
+    equivalent for (eg: node_id, the *_url templates, reactions and the
+    users' avatar/gravatar fields) and the repository's counters and
+    settings beyond the ones in REPO_FIELDS.
+
+    The queries go to `url` (derived from the REST base url by default)
+    through a PyGithub requester of their own, so the GraphQL points budget
+    is tracked apart from the REST quota.
+
+    >>> engine = GraphQLEngine(base_url='https://github.example.com/api/v3')
+    >>> engine.url, engine.api_url
+    ('https://github.example.com/api/graphql', 'https://github.example.com/api/v3')
+
+    """
+
+    def __init__(
+        self,
+        auth_token=None,
+        base_url=DEFAULT_BASE_URL,
+        url=None,
+        page_size=50,
+        comments=100,
+        log=DUMMY_LOG,
+    ):
+        self.api_url = base_url.rstrip("/")
+        self.url = url or graphql_url(base_url)
+        self.page_size = page_size
+        self.comments = comments
+        self.log = log
+
+        # the requester prefixes the path with its base url's path
+        root, path = self.url.rsplit("/", 1)
+        self.path = "/" + path
+        self.requester = Github(auth_token, base_url=root)._Github__requester
+        self.limiter = RateLimiter(partial(get_quota, self.requester), log=log)
+
+    def query(self, operation, **variables):
+        """
+        Runs one of the QUERIES within the points budget
+
+        :param operation: string, name of the query
+        :param variables: the query's variables
+        :rtype: dict, the data of the response
+        :raises GraphQLError: when the response reports errors
+
+        """
+        self.log.debug("fun : graphql query", operation=operation)
+
+        self.limiter.acquire()
+        headers, output = self.requester.requestJsonAndCheck(
+            "POST",
+            self.path,
+            input={
+                "query": QUERIES[operation],
+                "variables": variables,
+                "operationName": operation,
+            },
+        )
+
+        errors = output.get("errors")
+        if errors:
+            raise GraphQLError("; ".join(e.get("message", "") for e in errors))
+
+        return output["data"]
+
+    def iter_comments(self, owner, name, node):
+        """
+        Comments of an issue node, the ones that came with it and then the
+        rest a page at a time
+
+        :param owner: string
+        :param name: string
+        :param node: dict, GraphQL Issue or PullRequest
+        :rtype: iterator of dict, GraphQL IssueComment
+
+        """
+        comments = node["comments"]
+        while True:
+            for comment in comments["nodes"]:
+                yield comment
+
+            if not comments["pageInfo"]["hasNextPage"]:
+                return
+
+            data = self.query(
+                "IssueComments",
+                owner=owner,
+                name=name,
+                number=node["number"],
+                first=self.comments,
+                after=comments["pageInfo"]["endCursor"],
+            )
+            comments = data["repository"]["issueOrPullRequest"]["comments"]
+
+    def store_record(self, history, *parts):
+        record = history.merge_dict(*parts)
+        record.update(history.get_key(record))
+        history.write_message(Record(record))
+
+    def repo_parts(self, node, repo_fullname):
+        """
+        :param node: dict, GraphQL Repository or None
+        :rtype: dict, the organization/repository part of the records
+
+        """
+        if node is None:
+            raise GraphQLError("repository %s not found" % repo_fullname)
+
+        rp = {"repository": rest_repo(node, self.api_url)}
+        org = rest_org(node["owner"], self.api_url)
+        if org:
+            rp["organization"] = org
+
+        return rp
+
+    def store_issue(self, history, owner, name, rp, node):
+        """
+        Stores an issue (or pull request) node and all its comments
+
+        :rtype: dict, the issue as in the REST api
+
+        """
+        issue = rest_issue(node, rp["repository"]["url"])
+        for comment in self.iter_comments(owner, name, node):
+            self.store_record(
+                history, rp, {"issue": issue}, {"comment": rest_comment(comment, issue)}
+            )
+
+        self.store_record(history, rp, {"issue": issue})
+        return issue
+
+    def crawl_repo(self, history, repo_fullname):
+        """
+        Syncs one repo into the history's targets, following its sync mode:
+        open issues (issues) or all of them (incremental, backfill), updated
+        since the repo's high-water mark unless backfilling.
+
+        The REST issue listing includes pull requests, the GraphQL issues
+        connection doesn't: once the issues are stored the pull requests
+        are listed too, latest update first down to the mark, and stored as
+        issues with a `pull_request` member.
+
+        Progress is checkpointed as the cursor after the last stored page of
+        issues; a pass that stops while listing pull requests resumes with
+        them.
+
+        :param history: class 'githubhistory.GithubHistory'
+        :param repo_fullname: string
+
+        """
+        self.log.debug("fun : graphql crawl repo")
+
+        owner, name = repo_fullname.split("/", 1)
+        cp = history.checkpoints.get(repo_fullname)
+
+        backfill = history.sync_mode == "backfill"
+        if backfill and cp.get("backfilled"):
+            self.log.info("Repo already backfilled", repo=repo_fullname)
+            return
+
+        mark = cp.get("updated_at")
+
+        # resume a pass that stopped part way with the since it started with
+        after = cp.get("graphql_after")
+        pulls_only = cp.get("graphql_pulls")
+        resumed = bool(after or pulls_only)
+        if resumed:
+            since = cp.get("graphql_since")
+        else:
+            since = None if backfill else mark
+
+        states = ["OPEN"] if history.sync_mode == "issues" else None
+        issues = pulls = 0
+        rp = None
+
+        while not pulls_only:
+            data = self.query(
+                "RepoIssues",
+                owner=owner,
+                name=name,
+                first=self.page_size,
+                comments=self.comments,
+                after=after,
+                since=since,
+                states=states,
+            )
+            rp = self.repo_parts(data["repository"], repo_fullname)
+
+            page = data["repository"]["issues"]
+            for node in page["nodes"]:
+                issue = self.store_issue(history, owner, name, rp, node)
+                mark = max(mark or "", issue["updated_at"])
+
+            issues += len(page["nodes"])
+
+            # the page only counts as done once its records are written
+            history.flush()
+
+            if not page["pageInfo"]["hasNextPage"]:
+                break
+
+            after = page["pageInfo"]["endCursor"]
+            history.checkpoints.update(
+                repo_fullname, graphql_after=after, graphql_since=since, completed=False
+            )
+
+        history.checkpoints.update(
+            repo_fullname,
+            graphql_after=None,
+            graphql_pulls=True,
+            graphql_since=since,
+            completed=False,
+        )
+
+        after = None
+        while True:
+            data = self.query(
+                "RepoPullRequests",
+                owner=owner,
+                name=name,
+                first=self.page_size,
+                comments=self.comments,
+                after=after,
+                states=states,
+            )
+            rp = self.repo_parts(data["repository"], repo_fullname)
+
+            page = data["repository"]["pullRequests"]
+            nodes = [n for n in page["nodes"] if not since or n["updatedAt"] >= since]
+            for node in nodes:
+                pull = self.store_issue(history, owner, name, rp, node)
+                mark = max(mark or "", pull["updated_at"])
+
+            pulls += len(nodes)
+            history.flush()
+
+            # the rest were last updated before the mark
+            if len(nodes) < len(page["nodes"]) or not page["pageInfo"]["hasNextPage"]:
+                break
+
+            after = page["pageInfo"]["endCursor"]
+
+        # a repo without issues is stored on its own, as the REST walk does
+        if not (issues or pulls or resumed):
+            self.store_record(history, rp)
+            history.flush()
+
+        checkpoint = dict(
+            graphql_after=None,
+            graphql_pulls=None,
+            graphql_since=None,
+            updated_at=mark or None,
+        )
+        if backfill:
+            checkpoint["backfilled"] = True
+
+        history.checkpoints.update(repo_fullname, completed=True, **checkpoint)
+        self.log.info(
+            "Repo synced",
+            repo=repo_fullname,
+            issues=issues,
+            pulls=pulls,
+            engine="graphql",
+        )
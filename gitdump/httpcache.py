@@ -0,0 +1,215 @@
+import json
+import time
+import sqlite3
+import threading
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of github api GET responses keyed by url.
+
+    Once installed on a `github.Requester.Requester`, every GET for a url
+    already in the cache is revalidated with If-None-Match/If-Modified-Since;
+    a 304 is answered from the cache and doesn't count against the rate
+    limit. Least recently used entries are evicted once the cache grows
+    past `max_size` bytes.
+
+    >>> cache = ResponseCache(':memory:', max_size=100)
+    >>> cache.put('/a', {'etag': '"x"', 'x-ratelimit-remaining': '10'}, '{"id": 1}')
+    >>> cache.get('/a')
+    ({'etag': '"x"'}, '{"id": 1}')
+    >>> cache.put('/b', {'last-modified': 'Mon'}, 'b' * 95)
+    >>> cache.get('/a') is None
+    True
+    >>> cache.stats()['size']
+    95
+
+    """
+
+    def __init__(self, path, max_size=256 * 1024 * 1024, log=DUMMY_LOG):
+        self.path = path
+        self.max_size = max_size
+        self.log = log
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db = self.con.cursor()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE if not exists responses(key text PRIMARY KEY,\
+                         headers text, body blob, size integer, atime real)")
+        self.db.execute(
+            "CREATE INDEX if not exists responses_atime ON responses(atime)"
+        )
+        self.size = self.db.execute(
+            "select coalesce(sum(size), 0) from responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(url, parameters=None):
+        """
+        :param url: string
+        :param parameters: dict
+        :rtype: string
+
+        >>> ResponseCache.make_key('/repos/a/b/issues', {'state': 'all', 'page': 2})
+        '/repos/a/b/issues?page=2&state=all'
+
+        """
+        if not parameters:
+            return url
+
+        params = "&".join("%s=%s" % kv for kv in sorted(parameters.items()))
+        return "%s?%s" % (url, params)
+
+    def get(self, key):
+        """
+        :param key: string
+        :rtype: (dict, string) headers and body, or None
+
+        """
+        with self._lock:
+            row = self.db.execute(
+                "select headers, body from responses where key=?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            self.db.execute(
+                "update responses set atime=? where key=?", (time.time(), key)
+            )
+
+        headers = dict((str(k), str(v)) for k, v in json.loads(row[0]).items())
+        return headers, str(row[1])
+
+    def put(self, key, headers, body):
+        """
+        :param key: string
+        :param headers: dict, response headers (lower case names)
+        :param body: string
+
+        """
+        keep = dict(
+            (k, v)
+            for k, v in headers.items()
+            if k in ("etag", "last-modified", "link", "content-type")
+        )
+        size = len(body)
+
+        with self._lock:
+            old = self.db.execute(
+                "select size from responses where key=?", (key,)
+            ).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(keep), sqlite3.Binary(body), size, time.time()),
+            )
+            self.size += size - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            row = self.db.execute(
+                "select key, size from responses order by atime limit 1"
+            ).fetchone()
+            if row is None:
+                break
+
+            self.db.execute("delete from responses where key=?", (row[0],))
+            self.size -= row[1]
+            self.evictions += 1
+
+    @staticmethod
+    def conditional_headers(cached_headers):
+        """
+        :param cached_headers: dict, headers of the cached response
+        :rtype: dict, the headers revalidating it
+
+        >>> ResponseCache.conditional_headers({'etag': '"x"', 'link': '<...>'})
+        {'If-None-Match': '"x"'}
+
+        """
+        headers = {}
+        if "etag" in cached_headers:
+            headers["If-None-Match"] = cached_headers["etag"]
+        if "last-modified" in cached_headers:
+            headers["If-Modified-Since"] = cached_headers["last-modified"]
+
+        return headers
+
+    def request(self, request_json, verb, url, parameters=None, headers=None, *args):
+        """
+        Wraps `Requester.requestJson`, revalidating cached GETs
+
+        :rtype: (int, dict, string) status, headers and body
+
+        """
+        if verb != "GET":
+            return request_json(verb, url, parameters, headers, *args)
+
+        key = self.make_key(url, parameters)
+        cached = self.get(key)
+
+        headers = dict(headers or {})
+        if cached is not None:
+            headers.update(self.conditional_headers(cached[0]))
+
+        status, response_headers, output = request_json(
+            verb, url, parameters, headers, *args
+        )
+
+        with self._lock:
+            if cached is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+            if status == 304:
+                self.not_modified += 1
+
+        if status == 304 and cached is not None:
+            response_headers = dict(response_headers, **cached[0])
+            return 200, response_headers, cached[1]
+
+        if status == 200 and (
+            "etag" in response_headers or "last-modified" in response_headers
+        ):
+            self.put(key, response_headers, output)
+
+        return status, response_headers, output
+
+    def install(self, requester):
+        """
+        Routes the requests of a PyGithub requester through the cache
+
+        :param requester: class 'github.Requester.Requester'
+
+        """
+        request_json = requester.requestJson
+
+        def cached_request_json(verb, url, parameters=None, headers=None, *args):
+            return self.request(request_json, verb, url, parameters, headers, *args)
+
+        requester.requestJson = cached_request_json
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                not_modified=self.not_modified,
+                evictions=self.evictions,
+                size=self.size,
+            )
+
+    def close(self):
+        with self._lock:
+            self.con.close()
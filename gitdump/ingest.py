@@ -0,0 +1,171 @@
+import time
+import threading
+from Queue import Queue, Full, Empty
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class IngestQueue(object):
+    """
+    Bounded in-process queue between the webhook handlers and the targets.
+
+    Handlers only `put` records; writer threads drain the queue in batches
+    and hand each batch to `GithubHistory.write_messages`.
+
+    """
+
+    def __init__(
+        self,
+        git,
+        maxsize=10000,
+        workers=2,
+        batch_size=100,
+        batch_wait=1.0,
+        log=DUMMY_LOG,
+    ):
+
+        self.git = git
+        self.log = log
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = Queue(maxsize=maxsize)
+
+        self._threads = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.flush_seconds = 0.0
+        self.last_flush_seconds = 0.0
+
+    def put(self, record):
+        """
+        Queues a record without blocking
+
+        :param record: dict
+        :raises Queue.Full: when the queue is at capacity
+
+        >>> q = IngestQueue(None, maxsize=1)
+        >>> q.put({'id': 'a'})
+        >>> q.put({'id': 'b'})
+        Traceback (most recent call last):
+        ...
+        Full
+        >>> q.stats()['queue_depth'], q.stats()['rejected']
+        (1, 1)
+
+        """
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        with self._lock:
+            self.enqueued += 1
+
+    def get_batch(self):
+        """
+        Blocks for up to `batch_wait` seconds collecting at most
+        `batch_size` records.
+
+        :rtype: list
+
+        >>> q = IngestQueue(None, batch_size=2, batch_wait=0)
+        >>> for i in range(3): q.put({'id': i})
+        >>> q.get_batch()
+        [{'id': 0}, {'id': 1}]
+        >>> q.get_batch()
+        [{'id': 2}]
+        >>> q.get_batch()
+        []
+
+        """
+        batch = []
+        deadline = time.time() + self.batch_wait
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        return batch
+
+    def flush(self, batch):
+        """
+        :param batch: list of dict
+
+        """
+        t = time.time()
+        try:
+            self.git.write_messages(batch)
+        except Exception as e:
+            self.log.exception(e)
+            with self._lock:
+                self.flush_errors += 1
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+        elapsed = time.time() - t
+        with self._lock:
+            self.flushed += len(batch)
+            self.flushes += 1
+            self.flush_seconds += elapsed
+            self.last_flush_seconds = elapsed
+
+    def _run(self):
+        # keep draining after stop() until the queue is empty
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self.get_batch()
+            if batch:
+                self.flush(batch)
+
+    def start(self):
+        for i in range(self.workers):
+            th = threading.Thread(target=self._run, name="ingest-writer-%d" % i)
+            th.daemon = True
+            th.start()
+            self._threads.append(th)
+
+    def stop(self):
+        """
+        Waits for queued records to be written and stops the writers
+
+        """
+        self._stop.set()
+        for th in self._threads:
+            th.join()
+
+        self._threads = []
+
+    def stats(self):
+        """
+        :rtype: dict
+
+        """
+        with self._lock:
+            return dict(
+                queue_depth=self.queue.qsize(),
+                queue_size=self.queue.maxsize,
+                enqueued=self.enqueued,
+                rejected=self.rejected,
+                flushed=self.flushed,
+                flushes=self.flushes,
+                flush_errors=self.flush_errors,
+                flush_seconds=self.flush_seconds,
+                last_flush_seconds=self.last_flush_seconds,
+            )
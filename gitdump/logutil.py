@@ -0,0 +1,115 @@
+import time
+import threading
+from collections import defaultdict
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class TraceLog(object):
+    """
+    Wraps a logger so the per-call `debug` traces cost a flag check unless
+    they are asked for: with `trace` every debug line is passed on, with
+    `sample_every` one in that many is, otherwise they are dropped before
+    the logger formats anything. Other levels are passed on as they are.
+
+    >>> class Log(object):
+    ...     def debug(self, event, **kw): print('debug ' + event)
+    ...     def info(self, event, **kw): print('info ' + event)
+    ...
+    >>> log = TraceLog(Log())
+    >>> log.debug('fun : start')
+    >>> log.info('started')
+    info started
+    >>> log = TraceLog(Log(), sample_every=2)
+    >>> for i in range(4): log.debug('fun : %d' % i)
+    debug fun : 1
+    debug fun : 3
+
+    """
+
+    def __init__(self, log, trace=False, sample_every=0):
+        self.log = log
+        self.trace = trace
+        self.sample_every = sample_every
+        self._calls = 0
+
+    def debug(self, event, *args, **kwargs):
+        if not self.trace:
+            if not self.sample_every:
+                return
+
+            # unlocked, an off by one sample now and then doesn't matter
+            self._calls += 1
+            if self._calls % self.sample_every:
+                return
+
+        self.log.debug(event, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+
+class LogSummary(object):
+    """
+    Counts records instead of logging each one and logs the counts, as
+    records/sec per target and per repo, every `interval` seconds.
+
+    >>> class Log(object):
+    ...     def info(self, event, **kw): print('%s %s' % (event, sorted(kw['targets'])))
+    ...
+    >>> summary = LogSummary(Log(), interval=60)
+    >>> summary.count('targets', 'SQLiteStore.db', 100)
+    >>> summary.flush()
+    Records written ['SQLiteStore.db']
+    >>> summary.flush()
+
+    """
+
+    def __init__(self, log=DUMMY_LOG, interval=60):
+        self.log = log
+        self.interval = interval
+
+        self._counts = defaultdict(lambda: defaultdict(int))
+        self._since = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, kind, key, n=1):
+        """
+        :param kind: string, what the counts are grouped by (eg: targets)
+        :param key: string
+        :param n: int, records
+
+        """
+        with self._lock:
+            self._counts[kind][key] += n
+            due = time.time() - self._since >= self.interval
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Logs the counts since the last summary and starts over
+
+        """
+        now = time.time()
+        with self._lock:
+            counts, self._counts = self._counts, defaultdict(lambda: defaultdict(int))
+            elapsed, self._since = now - self._since, now
+
+        if not counts:
+            return
+
+        elapsed = max(elapsed, 1e-6)
+        summary = dict(
+            (kind, dict((k, round(n / elapsed, 2)) for k, n in keys.items()))
+            for kind, keys in counts.items()
+        )
+        self.log.info(
+            "Records written",
+            seconds=round(elapsed, 2),
+            total=sum(counts.get("targets", {}).values()),
+            **summary
+        )
@@ -1,53 +1,360 @@
+import os
 import json
+import gzip
+import time
+import threading
 
 
 import sqlite3
 from deeputil import Dummy
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING
 
-DUMMY_LOG = Dummy
+from util import to_json, record_key, TTLCache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DUMMY_LOG = Dummy()
+
+ENTITIES = ("repository", "organization", "issue", "comment")
+
+
+def split_record(record):
+    """
+    Splits a record into its github objects and the rest of its fields
+
+    :param record: dict
+    :rtype: (dict, dict) rest of the fields, github objects by name
+
+    >>> extra, entities = split_record({'id': 'k', 'issue': {'id': 1}, 'comment': {}})
+    >>> sorted(extra.items()), entities
+    ([('comment', {}), ('id', 'k')], {'issue': {'id': 1}})
+
+    """
+    entities = dict(
+        (name, record[name])
+        for name in ENTITIES
+        if isinstance(record.get(name), dict) and "id" in record[name]
+    )
+    extra = dict((k, v) for k, v in record.items() if k not in entities)
+    return extra, entities
+
+
+def record_fields(record):
+    """
+    The fields the query api looks records up by
+
+    :param record: dict
+    :rtype: (string, int, int, string) repo full name, issue number,
+            comment id and the updated_at of the record's latest object
+
+    >>> record_fields({'repository': {'full_name': 'org/repo'}, 'issue': {'number': 2, 'updated_at': 'i1'}})
+    ('org/repo', 2, None, 'i1')
+
+    """
+    repo = record.get("repository") or {}
+    issue = record.get("issue") or {}
+    comment = record.get("comment") or {}
+
+    updated_at = (
+        comment.get("updated_at") or issue.get("updated_at") or repo.get("updated_at")
+    )
+    return (
+        repo.get("full_name"),
+        issue.get("number"),
+        comment.get("id"),
+        updated_at,
+    )
+
+
+def entity_version(raw):
+    """
+    The updated_at of a github object, its json when it has none
+    (eg: the short organization object of webhook payloads)
+
+    :param raw: dict
+    :rtype: string
+
+    """
+    return raw.get("updated_at") or to_json(raw)
+
+
+def newer_version(version, than):
+    """
+    Whether an object of this version should replace one of version `than`:
+    a later updated_at replaces an earlier one or an object without one,
+    objects without an updated_at (versioned by their json) replace only
+    each other
+
+    :param version: string, from entity_version
+    :param than: string or None, the version stored
+    :rtype: bool
+
+    >>> newer_version('2018-02-15T09:17:49Z', '2018-01-01T00:00:00Z')
+    True
+    >>> newer_version('2018-01-01T00:00:00Z', '2018-02-15T09:17:49Z')
+    False
+    >>> newer_version('{"id": 1}', '2018-02-15T09:17:49Z')
+    False
+    >>> newer_version('2018-01-01T00:00:00Z', '{"id": 1}')
+    True
+
+    """
+    if than is None:
+        return True
+
+    if version.startswith("{"):
+        return than.startswith("{") and version != than
+
+    return than.startswith("{") or version > than
 
 
 class SQLiteStore(object):
-    def __init__(self, db_name="Githu", table_name="github_dump", log=DUMMY_LOG):
+
+    # schema migrations run in order at startup, the version reached by
+    # each table is kept in the gitdump_schema table
+    MIGRATIONS = ("_migrate_issue_index", "_migrate_rekey", "_migrate_query_columns")
+
+    # rows updated per transaction by the migrations
+    MIGRATE_BATCH = 1000
+
+    # serves the query api (see gitdump.query)
+    QUERYABLE = True
+
+    COLUMNS = (
+        "id",
+        "record",
+        "issue_id",
+        "issue_ts",
+        "comment_ts",
+        "repo",
+        "issue_number",
+        "comment_id",
+        "updated_at",
+    )
+
+    JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+    SYNCHRONOUS = ("OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3")
+
+    def __init__(
+        self,
+        db_name="Githu",
+        table_name="github_dump",
+        journal_mode=None,
+        synchronous=None,
+        log=DUMMY_LOG,
+    ):
 
         self.db_name = db_name
         self.table_name = table_name
         self.log = log
 
+        # the connection is shared by the history thread and the webhook
+        # handlers, so every statement runs under this lock
+        self._lock = threading.Lock()
         self.con = sqlite3.connect(
             db_name, check_same_thread=False, isolation_level=None
         )
         self.db = self.con.cursor()
+
+        # pragmas come from the --target string,
+        # eg: ...SQLiteStore:db_name=x:table_name=y:journal_mode=WAL:synchronous=NORMAL
+        if journal_mode:
+            self._pragma("journal_mode", journal_mode, self.JOURNAL_MODES)
+        if synchronous:
+            self._pragma("synchronous", synchronous, self.SYNCHRONOUS)
+
+        self._create_tables()
+        self.migrate()
+
+    def _create_tables(self):
         self.db.execute(
             "CREATE TABLE if not exists '%s'(id text UNIQUE,\
                          record text, issue_id text, issue_ts text, comment_ts text)"
             % (self.table_name)
         )
 
-    def insert_msg(self, record):
-        doc = record.get("comment", {}).get("updated_at", record["issue"]["created_at"])
-        try:
+    def migrate(self):
+        """
+        Brings an existing table up to the current schema
+
+        """
+        self.db.execute(
+            "CREATE TABLE if not exists gitdump_schema(table_name text PRIMARY KEY,\
+                         version integer)"
+        )
+        row = self.db.execute(
+            "select version from gitdump_schema where table_name=?", (self.table_name,)
+        ).fetchone()
+        version = row[0] if row else 0
+
+        for v in range(version, len(self.MIGRATIONS)):
+            name = self.MIGRATIONS[v]
+            self.log.info("Migrating sqlite table", table=self.table_name, step=name)
+            getattr(self, name)()
             self.db.execute(
-                "INSERT INTO {t} VALUES (?, ?, ?, ?, ?)".format(t=self.table_name),
-                (
-                    record["id"],
-                    json.dumps(record),
-                    str(record["issue"]["id"]),
-                    str(record["issue"]["updated_at"]),
-                    str(doc),
-                ),
+                "INSERT OR REPLACE INTO gitdump_schema VALUES (?, ?)",
+                (self.table_name, v + 1),
+            )
+
+    def _migrate_issue_index(self):
+        self.db.execute(
+            "CREATE INDEX if not exists '{t}_issue_comment' ON '{t}'(issue_id, comment_ts)".format(
+                t=self.table_name
+            )
+        )
+
+    def _stored_rows(self, columns):
+        # MIGRATE_BATCH rows at a time in rowid order, so a migration never
+        # holds the whole table; updates keep the rowids, so the walk isn't
+        # thrown off by the batches written in between
+        last = 0
+        while True:
+            rows = self.db.execute(
+                "select rowid, {c} from '{t}' where rowid>? order by rowid \
+                 limit ?".format(c=columns, t=self.table_name),
+                (last, self.MIGRATE_BATCH),
+            ).fetchall()
+            if not rows:
+                return
+
+            last = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    def _stored_batches(self):
+        for rows in self._stored_rows("id, record"):
+            yield [(id, json.loads(record)) for id, record in rows]
+
+    def _migrate_rekey(self):
+        # records written before keys were built from github ids (see
+        # util.record_key) get their new key, rows that end up sharing one
+        # are collapsed into a single row
+        sql = "UPDATE OR REPLACE '{t}' SET id=? WHERE id=?".format(t=self.table_name)
+
+        count = 0
+        for batch in self._stored_batches():
+            keys = [(record_key(record), id) for id, record in batch]
+            rows = [(key, id) for key, id in keys if key != id]
+            self._update_rows(sql, rows)
+            count += len(rows)
+
+        self.log.info("Re-keyed sqlite records", table=self.table_name, count=count)
+
+    def _update_rows(self, sql, rows):
+        for i in range(0, len(rows), self.MIGRATE_BATCH):
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(sql, rows[i : i + self.MIGRATE_BATCH])
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def _migrate_query_columns(self):
+        # columns and indexes behind the query api, filled in for the rows
+        # already stored
+        t = self.table_name
+        for column, kind in (
+            ("repo", "text"),
+            ("issue_number", "integer"),
+            ("comment_id", "integer"),
+            ("updated_at", "text"),
+        ):
+            self.db.execute("ALTER TABLE '%s' ADD COLUMN %s %s" % (t, column, kind))
+
+        sql = "UPDATE '{t}' SET repo=?, issue_number=?, comment_id=?, updated_at=? \
+               WHERE id=?".format(t=t)
+        for batch in self._stored_batches():
+            self._update_rows(
+                sql, [record_fields(record) + (id,) for id, record in batch]
             )
-            self.log.info("Msg inserted in sqlite db", msg_id=record["id"])
+
+        for name, columns in (
+            ("repo_issue", "repo, issue_number, issue_ts"),
+            ("repo_comment", "repo, issue_number, comment_id, comment_ts"),
+            ("updated", "updated_at, id"),
+        ):
+            self.db.execute(
+                "CREATE INDEX if not exists '{t}_{n}' ON '{t}'({c})".format(
+                    t=t, n=name, c=columns
+                )
+            )
+
+    def _pragma(self, name, value, allowed):
+        value = str(value).upper()
+        if value not in allowed:
+            raise ValueError(
+                "invalid %s %r, expected one of %s" % (name, value, allowed)
+            )
+
+        self.db.execute("PRAGMA %s=%s" % (name, value))
+
+    def _row(self, record):
+        issue = record["issue"]
+        doc = record.get("comment", {}).get("updated_at", issue["created_at"])
+        return (
+            record["id"],
+            to_json(record),
+            str(issue["id"]),
+            str(issue["updated_at"]),
+            str(doc),
+        ) + record_fields(record)
+
+    def _insert_sql(self):
+        return "INSERT OR REPLACE INTO '{t}' ({c}) VALUES ({v})".format(
+            t=self.table_name,
+            c=", ".join(self.COLUMNS),
+            v=", ".join("?" * len(self.COLUMNS)),
+        )
+
+    def insert_msg(self, record):
+        try:
+            row = self._row(record)
+            with self._lock:
+                self.db.execute(self._insert_sql(), row)
+            self.log.debug("Msg inserted in sqlite db", msg_id=record["id"])
         except Exception as e:
             self.log.exception(e)
 
+    def insert_many(self, records):
+        """
+        Upserts all records in a single transaction
+
+        :param records: list of dict
+
+        """
+        rows = []
+        for record in records:
+            try:
+                rows.append(self._row(record))
+            except (KeyError, TypeError) as e:
+                self.log.exception(e, msg_id=record.get("id"))
+
+        if not rows:
+            return
+
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(self._insert_sql(), rows)
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+        self.log.debug("Msgs inserted in sqlite db", count=len(rows))
+
     def check_issue_in_db(self, issue):
-        records = self.db.execute(
-            "select issue_ts,comment_ts from %s where \
-                              issue_id=%s order by comment_ts desc limit 1"
-            % (self.table_name, issue["issue"]["id"])
-        )
+        with self._lock:
+            records = self.db.execute(
+                "select issue_ts,comment_ts from '{t}' where \
+                              issue_id=? order by comment_ts desc limit 1".format(
+                    t=self.table_name
+                ),
+                (str(issue["issue"]["id"]),),
+            ).fetchall()
 
         count = 0
         for record in records:
@@ -65,28 +372,360 @@ class SQLiteStore(object):
         if count is 0:
             return 0, 0
 
+    def _page(self, sql, args, limit):
+        with self._lock:
+            rows = self.db.execute(sql, args + (limit,)).fetchall()
+
+        # the next page starts after the last row when this one is full
+        cursor = rows[-1][:-1] if len(rows) == limit else None
+        return [r[-1] for r in rows], cursor
+
+    def query_issues(self, repo, after=0, limit=100):
+        """
+        Latest stored version of the repo's issues, by issue number
+
+        :param repo: string, repo full name
+        :param after: int, issue number the page starts after
+        :param limit: int
+        :rtype: (list of string, tuple or None) json records and the cursor
+                of the next page
+
+        >>> store = SQLiteStore(':memory:', 'dump')
+        >>> repo = {'full_name': 'org/repo'}
+        >>> store.insert_many([
+        ...     {'id': 'a', 'repository': repo, 'issue': {'id': 1, 'number': 1, 'created_at': 'i0', 'updated_at': 'i1'}},
+        ...     {'id': 'b', 'repository': repo, 'issue': {'id': 1, 'number': 1, 'created_at': 'i0', 'updated_at': 'i2'}},
+        ...     {'id': 'c', 'repository': repo, 'issue': {'id': 2, 'number': 2, 'created_at': 'i0', 'updated_at': 'i1'}},
+        ... ])
+        >>> records, cursor = store.query_issues('org/repo', limit=1)
+        >>> [json.loads(r)['id'] for r in records], cursor
+        ([u'b'], (1,))
+        >>> [json.loads(r)['id'] for r in store.query_issues('org/repo', *cursor)[0]]
+        [u'c']
+        >>> [json.loads(r)['id'] for r in store.query_since('i2')[0]]
+        [u'b']
+
+        """
+        return self._page(
+            "select issue_number, record from (select issue_number, record, \
+             max(issue_ts) from '{t}' where repo=? and issue_number>? \
+             group by issue_number) order by issue_number limit ?".format(
+                t=self.table_name
+            ),
+            (repo, after),
+            limit,
+        )
+
+    def query_comments(self, repo, number, after=0, limit=100):
+        """
+        Latest stored version of the issue's comments, oldest first
+
+        :param repo: string, repo full name
+        :param number: int, issue number
+        :param after: int, comment id the page starts after
+        :param limit: int
+        :rtype: (list of string, tuple or None)
+
+        """
+        return self._page(
+            "select comment_id, record from (select comment_id, record, \
+             max(comment_ts) from '{t}' where repo=? and issue_number=? \
+             and comment_id>? group by comment_id) order by comment_id limit ?".format(
+                t=self.table_name
+            ),
+            (repo, number, after),
+            limit,
+        )
+
+    def query_since(self, since, after="", limit=100):
+        """
+        Records whose latest object was updated at or after `since`, in
+        update order
+
+        :param since: string, eg: '2018-02-15T09:17:49Z'
+        :param after: string, id of the last record of the previous page
+                      updated at `since`
+        :param limit: int
+        :rtype: (list of string, tuple or None)
+
+        """
+        return self._page(
+            "select updated_at, id, record from '{t}' where updated_at>? \
+             or (updated_at=? and id>?) order by updated_at, id limit ?".format(
+                t=self.table_name
+            ),
+            (since, since, after),
+            limit,
+        )
+
+    def ping(self):
+        with self._lock:
+            self.db.execute("select 1")
+        return True
+
+    def close(self):
+        with self._lock:
+            self.con.close()
+
 
 class MongoStore(object):
+
+    # same scheme as SQLiteStore.MIGRATIONS, versions are kept in the
+    # gitdump_schema collection
+    MIGRATIONS = (
+        "_migrate_indexes",
+        "_migrate_rekey",
+        "_migrate_query",
+        "_migrate_latest_indexes",
+    )
+
+    # serves the query api (see gitdump.query)
+    QUERYABLE = True
+
+    # stored with every document so "changed since" is one indexed field
+    UPDATED_AT = "gitdump_updated_at"
+
+    # documents read and updated per bulk operation by the migrations
+    MIGRATE_BATCH = 1000
+
     def __init__(self, db_name, collection_name, log=DUMMY_LOG):
         self.db_name = db_name
         self.collection_name = collection_name
         self.log = log
         self.client = MongoClient()
         self.db = self.client[self.db_name][self.collection_name]
+        self.migrate()
+
+    def migrate(self):
+        """
+        Brings an existing collection up to the current schema
+
+        """
+        schema = self.client[self.db_name]["gitdump_schema"]
+        row = schema.find_one({"collection": self.collection_name}) or {}
+        version = row.get("version", 0)
+
+        for v in range(version, len(self.MIGRATIONS)):
+            name = self.MIGRATIONS[v]
+            self.log.info(
+                "Migrating mongo collection", collection=self.collection_name, step=name
+            )
+            getattr(self, name)()
+            schema.update(
+                {"collection": self.collection_name},
+                {"collection": self.collection_name, "version": v + 1},
+                upsert=True,
+            )
+
+    def _migrate_indexes(self):
+        # built in the background so big collections don't block startup
+        self.db.create_index("id", background=True)
+        self.db.create_index(
+            [("issue.id", ASCENDING), ("comment.updated_at", DESCENDING)],
+            background=True,
+        )
+
+    def _stored_docs(self, query, fields=None):
+        # MIGRATE_BATCH documents at a time in _id order, as
+        # SQLiteStore._stored_rows
+        last = None
+        while True:
+            q = dict(query)
+            if last is not None:
+                q["_id"] = {"$gt": last}
+
+            docs = list(
+                self.db.find(q, fields).sort("_id", ASCENDING).limit(self.MIGRATE_BATCH)
+            )
+            if not docs:
+                return
+
+            last = docs[-1]["_id"]
+            yield docs
+
+    def _stored_batches(self):
+        fields = {"repository": 1, "issue": 1, "comment": 1, "id": 1}
+        for docs in self._stored_docs({}, fields):
+            yield [(doc["_id"], doc) for doc in docs]
+
+    def _migrate_rekey(self):
+        # same as SQLiteStore._migrate_rekey, a document whose new key is
+        # already taken is removed instead, found through the id index
+        # rather than a set of every key
+        count = 0
+        for batch in self._stored_batches():
+            bulk = self.db.initialize_unordered_bulk_op()
+            taken = set()
+            changed = 0
+
+            for _id, record in batch:
+                key = record_key(record)
+                if key == record.get("id"):
+                    continue
+
+                if key in taken or self.db.find_one({"id": key}, {"_id": 1}):
+                    bulk.find({"_id": _id}).remove_one()
+                else:
+                    bulk.find({"_id": _id}).update_one({"$set": {"id": key}})
+                    taken.add(key)
+                changed += 1
+
+            if changed:
+                bulk.execute()
+            count += changed
+
+        self.log.info(
+            "Re-keyed mongo records", collection=self.collection_name, count=count
+        )
+
+    def _migrate_query(self):
+        # indexes behind the query api, and the updated_at field for the
+        # documents already stored
+        self.db.create_index(
+            [("repository.full_name", ASCENDING), ("issue.number", ASCENDING)],
+            background=True,
+        )
+        self.db.create_index(
+            [("repository.full_name", ASCENDING), ("comment.id", ASCENDING)],
+            background=True,
+        )
+        self.db.create_index(
+            [(self.UPDATED_AT, ASCENDING), ("id", ASCENDING)], background=True
+        )
+
+        for docs in self._stored_docs({self.UPDATED_AT: {"$exists": False}}):
+            bulk = self.db.initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.find({"_id": doc["_id"]}).update_one(
+                    {"$set": {self.UPDATED_AT: record_fields(doc)[3]}}
+                )
+            bulk.execute()
+
+    def _migrate_latest_indexes(self):
+        # cover the sorts of _latest, so a page is read off the index in
+        # order instead of sorting all of the repo's documents
+        self.db.create_index(
+            [
+                ("repository.full_name", ASCENDING),
+                ("issue.number", ASCENDING),
+                ("issue.updated_at", DESCENDING),
+            ],
+            background=True,
+        )
+        self.db.create_index(
+            [
+                ("repository.full_name", ASCENDING),
+                ("issue.number", ASCENDING),
+                ("comment.id", ASCENDING),
+                ("comment.updated_at", DESCENDING),
+            ],
+            background=True,
+        )
+
+    def _doc(self, msg):
+        doc = dict(msg)
+        doc[self.UPDATED_AT] = record_fields(msg)[3]
+        return doc
 
     def insert_msg(self, msg):
-        self.db.update({"id": msg["id"]}, msg, upsert=True)
-        self.log.info("Msg inserted in monog db", msg_id=msg["id"])
+        self.db.update({"id": msg["id"]}, self._doc(msg), upsert=True)
+        self.log.debug("Msg inserted in monog db", msg_id=msg["id"])
+
+    def insert_many(self, msgs):
+        """
+        Upserts all msgs in one unordered bulk operation
+
+        :param msgs: list of dict
+
+        """
+        if not msgs:
+            return
+
+        bulk = self.db.initialize_unordered_bulk_op()
+        for msg in msgs:
+            bulk.find({"id": msg["id"]}).upsert().replace_one(self._doc(msg))
+        bulk.execute()
+
+        self.log.debug("Msgs inserted in monog db", count=len(msgs))
+
+    def _latest(self, query, key, version, limit):
+        # documents sorted by key then newest first, the first of each key
+        # is its latest version
+        docs = self.db.find(query, {"_id": 0, self.UPDATED_AT: 0}).sort(
+            [(key, ASCENDING), (version, DESCENDING)]
+        )
+
+        records, last = [], None
+        for doc in docs:
+            value = reduce(lambda d, k: (d or {}).get(k), key.split("."), doc)
+            if value == last:
+                continue
+
+            last = value
+            records.append(to_json(doc))
+            if len(records) == limit:
+                return records, (last,)
+
+        return records, None
+
+    def query_issues(self, repo, after=0, limit=100):
+        """
+        Same as SQLiteStore.query_issues
+
+        """
+        return self._latest(
+            {"repository.full_name": repo, "issue.number": {"$gt": after}},
+            "issue.number",
+            "issue.updated_at",
+            limit,
+        )
+
+    def query_comments(self, repo, number, after=0, limit=100):
+        """
+        Same as SQLiteStore.query_comments
+
+        """
+        return self._latest(
+            {
+                "repository.full_name": repo,
+                "issue.number": number,
+                "comment.id": {"$gt": after},
+            },
+            "comment.id",
+            "comment.updated_at",
+            limit,
+        )
+
+    def query_since(self, since, after="", limit=100):
+        """
+        Same as SQLiteStore.query_since
+
+        """
+        ts = self.UPDATED_AT
+        docs = list(
+            self.db.find(
+                {"$or": [{ts: {"$gt": since}}, {ts: since, "id": {"$gt": after}}]},
+                {"_id": 0},
+            )
+            .sort([(ts, ASCENDING), ("id", ASCENDING)])
+            .limit(limit)
+        )
+
+        cursor = (docs[-1][ts], docs[-1]["id"]) if len(docs) == limit else None
+        for doc in docs:
+            doc.pop(ts)
+
+        return [to_json(doc) for doc in docs], cursor
 
     def check_issue_in_db(self, issue):
-        records = (
+        records = list(
             self.db.find({"issue.id": issue["issue"]["id"]}, {"comment": 1})
             .sort("comment.updated_at", DESCENDING)
             .limit(1)
         )
 
         # if no records related to particular issue
-        if records.count() is 0:
+        if not records:
             return 0, 0
 
         # if records present,checking whether changes  are there in the issue
@@ -101,3 +740,602 @@ class MongoStore(object):
 
         # if records present no changes related to issue
         return 1, 0
+
+    def ping(self):
+        self.client.admin.command("ping")
+        return True
+
+    def close(self):
+        self.client.close()
+
+
+class NormalizedSQLiteStore(SQLiteStore):
+    """
+    SQLiteStore that keeps every repository, organization, issue and comment
+    once, in its own <table_name>_<object> table keyed by github id, and only
+    rewrites it when its updated_at changes. <table_name> holds one small
+    row per record pointing at them; `get_record` merges them back.
+
+    >>> store = NormalizedSQLiteStore(':memory:', 'dump')
+    >>> repo = {'id': 1, 'updated_at': 'r1'}
+    >>> issue = {'id': 2, 'created_at': 'i0', 'updated_at': 'i1'}
+    >>> store.insert_many([
+    ...     {'id': 'a', 'repository': repo, 'issue': issue, 'comment': {'id': 3, 'updated_at': 'c1'}},
+    ...     {'id': 'b', 'repository': repo, 'issue': issue, 'comment': {'id': 4, 'updated_at': 'c2'}},
+    ... ])
+    >>> store.db.execute("select count(*) from dump_repository").fetchone()[0]
+    1
+    >>> store.get_record('b')['comment']
+    {u'id': 4, u'updated_at': u'c2'}
+    >>> store.check_issue_in_db({'issue': issue})
+    (1, u'c2')
+
+    An object is only rewritten by a newer version, a record replayed late
+    doesn't roll it back:
+
+    >>> store.insert_many([{'id': 'c', 'repository': dict(repo, updated_at='r2')}])
+    >>> store.insert_many([{'id': 'd', 'repository': repo}])
+    >>> store._versions = TTLCache()
+    >>> store.insert_many([{'id': 'e', 'repository': repo}])
+    >>> store.get_record('e')['repository']
+    {u'id': 1, u'updated_at': u'r2'}
+
+    """
+
+    # the link table has no record column to query
+    MIGRATIONS = ("_migrate_issue_index", "_migrate_rekey")
+    QUERYABLE = False
+
+    def __init__(self, *args, **kwargs):
+        # (object, github id) -> version last written, skips rewriting
+        # objects that haven't changed
+        self._versions = TTLCache(maxsize=100000, ttl=24 * 60 * 60)
+        super(NormalizedSQLiteStore, self).__init__(*args, **kwargs)
+
+    def _create_tables(self):
+        self.db.execute(
+            "CREATE TABLE if not exists '%s'(id text PRIMARY KEY, extra text,\
+                         repository_id text, organization_id text, issue_id text,\
+                         comment_id text, issue_ts text, comment_ts text)"
+            % (self.table_name)
+        )
+        for name in ENTITIES:
+            self.db.execute("CREATE TABLE if not exists '%s_%s'(id text PRIMARY KEY,\
+                             version text, data text)" % (self.table_name, name))
+
+    def _stored_batches(self):
+        for rows in self._stored_rows("id"):
+            yield [(id, self.get_record(id)) for (id,) in rows]
+
+    def _link_row(self, extra, entities):
+        ids = [str(entities[n]["id"]) if n in entities else None for n in ENTITIES]
+
+        issue = entities.get("issue", {})
+        issue_ts = issue.get("updated_at")
+        comment_ts = entities.get("comment", {}).get(
+            "updated_at", issue.get("created_at")
+        )
+
+        return tuple([extra["id"], to_json(extra)] + ids + [issue_ts, comment_ts])
+
+    def insert_msg(self, record):
+        try:
+            self.insert_many([record])
+        except Exception as e:
+            self.log.exception(e)
+
+    def insert_many(self, records):
+        """
+        Upserts the records' links and the github objects that changed,
+        in a single transaction
+
+        :param records: list of dict
+
+        """
+        links = []
+        changed = dict((name, {}) for name in ENTITIES)
+
+        for record in records:
+            extra, entities = split_record(record)
+            try:
+                links.append(self._link_row(extra, entities))
+            except (KeyError, TypeError) as e:
+                self.log.exception(e, msg_id=record.get("id"))
+                continue
+
+            for name, raw in entities.items():
+                key, version = (name, str(raw["id"])), entity_version(raw)
+                if self._versions.get(key) == version:
+                    continue
+
+                # the newest of the batch, records can come out of order
+                pending = changed[name].get(key[1])
+                if pending is None or newer_version(version, pending[0]):
+                    changed[name][key[1]] = (version, to_json(raw))
+
+        if not links:
+            return
+
+        t = self.table_name
+        with self._lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO '{t}' VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(
+                        t=t
+                    ),
+                    links,
+                )
+                for name, rows in changed.items():
+                    if not rows:
+                        continue
+
+                    # insert new objects, rewrite existing ones only with
+                    # a newer version (see newer_version), so a late or
+                    # replayed record never rolls an object back
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO '{t}_{n}' VALUES (?, ?, ?)".format(
+                            t=t, n=name
+                        ),
+                        [(i, v, d) for i, (v, d) in rows.items()],
+                    )
+                    self.db.executemany(
+                        "UPDATE '{t}_{n}' SET version=?, data=? WHERE id=? AND \
+                         (version<? OR version LIKE '{{%')".format(t=t, n=name),
+                        [
+                            (v, d, i, v)
+                            for i, (v, d) in rows.items()
+                            if not v.startswith("{")
+                        ],
+                    )
+                    self.db.executemany(
+                        "UPDATE '{t}_{n}' SET version=?, data=? WHERE id=? AND \
+                         version<>? AND version LIKE '{{%'".format(t=t, n=name),
+                        [
+                            (v, d, i, v)
+                            for i, (v, d) in rows.items()
+                            if v.startswith("{")
+                        ],
+                    )
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+        for name, rows in changed.items():
+            for i, (v, _) in rows.items():
+                self._versions.set((name, i), v)
+
+        self.log.debug("Msgs inserted in sqlite db", count=len(links))
+
+    def get_record(self, id):
+        """
+        The record merged back from the latest stored versions of its github
+        objects, which can be newer than the ones it was written with
+
+        :param id: string, record id
+        :rtype: dict or None
+
+        """
+        t = self.table_name
+        with self._lock:
+            link = self.db.execute(
+                "select * from '{t}' where id=?".format(t=t), (id,)
+            ).fetchone()
+            if link is None:
+                return None
+
+            record = json.loads(link[1])
+            for name, entity_id in zip(ENTITIES, link[2:6]):
+                if entity_id is None:
+                    continue
+
+                row = self.db.execute(
+                    "select data from '{t}_{n}' where id=?".format(t=t, n=name),
+                    (entity_id,),
+                ).fetchone()
+                if row:
+                    record[name] = json.loads(row[0])
+
+        return record
+
+
+class NormalizedMongoStore(MongoStore):
+    """
+    MongoStore that keeps every repository, organization, issue and comment
+    once, in its own <collection_name>_<object> collection keyed by github
+    id, and only rewrites it when its updated_at changes. <collection_name>
+    holds one small document per record with stubs of its objects;
+    `get_record` merges them back.
+
+    """
+
+    # steps only ever get appended, so existing collections pick up where
+    # they left off
+    MIGRATIONS = ("_migrate_indexes", "_migrate_entity_indexes", "_migrate_rekey")
+
+    # the links hold stubs of the github objects only
+    QUERYABLE = False
+
+    def __init__(self, *args, **kwargs):
+        # (object, github id) -> version last written
+        self._versions = TTLCache(maxsize=100000, ttl=24 * 60 * 60)
+        super(NormalizedMongoStore, self).__init__(*args, **kwargs)
+
+    def entity(self, name):
+        return self.client[self.db_name]["%s_%s" % (self.collection_name, name)]
+
+    def _stored_batches(self):
+        for docs in self._stored_docs({}, {"id": 1}):
+            yield [(doc["_id"], self.get_record(doc["id"])) for doc in docs]
+
+    def _migrate_entity_indexes(self):
+        for name in ENTITIES:
+            self.entity(name).create_index("id", unique=True, background=True)
+
+    def _link(self, extra, entities):
+        link = dict(extra)
+        for name, raw in entities.items():
+            # keep what check_issue_in_db filters and sorts on
+            fields = (
+                ("id", "created_at", "updated_at")
+                if name in ("issue", "comment")
+                else ("id",)
+            )
+            link[name] = dict((f, raw[f]) for f in fields if f in raw)
+
+        return link
+
+    def insert_msg(self, msg):
+        self.insert_many([msg])
+
+    def insert_many(self, msgs):
+        """
+        Upserts the msgs' links and the github objects that changed
+
+        :param msgs: list of dict
+
+        """
+        if not msgs:
+            return
+
+        changed = dict((name, {}) for name in ENTITIES)
+        bulk = self.db.initialize_unordered_bulk_op()
+        for msg in msgs:
+            extra, entities = split_record(msg)
+            bulk.find({"id": msg["id"]}).upsert().replace_one(
+                self._link(extra, entities)
+            )
+
+            for name, raw in entities.items():
+                version = entity_version(raw)
+                if self._versions.get((name, raw["id"])) == version:
+                    continue
+
+                pending = changed[name].get(raw["id"])
+                if pending is None or newer_version(version, entity_version(pending)):
+                    changed[name][raw["id"]] = raw
+        bulk.execute()
+
+        for name, raws in changed.items():
+            if not raws:
+                continue
+
+            # as NormalizedSQLiteStore: insert new objects, then replace
+            # existing ones only with a newer version
+            bulk = self.entity(name).initialize_ordered_bulk_op()
+            for entity_id, raw in raws.items():
+                bulk.find({"id": entity_id}).upsert().update_one({"$setOnInsert": raw})
+
+                stub = {"updated_at": {"$exists": False}}
+                if raw.get("updated_at"):
+                    older = {"$or": [{"updated_at": {"$lt": raw["updated_at"]}}, stub]}
+                else:
+                    older = stub
+                bulk.find(dict(older, id=entity_id)).replace_one(raw)
+            bulk.execute()
+
+            for entity_id, raw in raws.items():
+                self._versions.set((name, entity_id), entity_version(raw))
+
+        self.log.debug("Msgs inserted in monog db", count=len(msgs))
+
+    def get_record(self, id):
+        """
+        The record merged back from the latest stored versions of its github
+        objects, as NormalizedSQLiteStore.get_record
+
+        :param id: string, record id
+        :rtype: dict or None
+
+        """
+        record = self.db.find_one({"id": id}, {"_id": 0})
+        if record is None:
+            return None
+
+        for name in ENTITIES:
+            if name in record:
+                doc = self.entity(name).find_one({"id": record[name]["id"]}, {"_id": 0})
+                if doc:
+                    record[name] = doc
+
+        return record
+
+
+class FileStore(object):
+    """
+    Appends the records as newline delimited json to files under `path`,
+    for archival dumps that don't need a queryable db.
+
+    Every batch is written and flushed before `insert_many` returns, so the
+    history sync only checkpoints what is in the files; a batch is written
+    in blocks of at most `buffer_size` bytes. A new file,
+    <prefix>-<time>-<n>.jsonl[.gz|.zst], is started by the first block
+    written once the current one holds `rotate_size` bytes of json or is
+    `rotate_age` seconds old.
+    `compression` is gzip or zstd (needs the zstandard package).
+
+    The latest comment time of every issue is appended to the sidecar
+    <prefix>.index file as the blocks are written, so `check_issue_in_db`
+    can drive the history sync like the other stores.
+
+    eg: --target forwarder=gitdump.messagestore.FileStore:path=/data/dump:compression=gzip:rotate_size=1073741824
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> store = FileStore(tmp, compression='gzip')
+    >>> issue = {'id': 1, 'created_at': 'c', 'updated_at': 'u'}
+    >>> store.insert_many([{'id': 'a', 'issue': issue, 'comment': {'updated_at': 'u'}}])
+    >>> store.check_issue_in_db({'issue': issue})
+    (1, 0)
+    >>> open(store.index_path).read()
+    '1\\tu\\n'
+    >>> store.close()
+    >>> FileStore(tmp).check_issue_in_db({'issue': issue})
+    (1, 0)
+    >>> [json.loads(l)['id'] for l in gzip.open(store.files[0])]
+    [u'a']
+    >>> shutil.rmtree(tmp)
+
+    """
+
+    EXTENSIONS = {None: ".jsonl", "gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+    def __init__(
+        self,
+        path,
+        prefix="gitdump",
+        compression=None,
+        rotate_size=256 * 1024 * 1024,
+        rotate_age=60 * 60,
+        buffer_size=1024 * 1024,
+        log=DUMMY_LOG,
+    ):
+
+        if compression not in self.EXTENSIONS:
+            raise ValueError(
+                "invalid compression %r, expected one of gzip, zstd" % compression
+            )
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+
+        self.path = path
+        self.db_name = path
+        self.prefix = prefix
+        self.compression = compression
+        self.rotate_size = int(rotate_size)
+        self.rotate_age = float(rotate_age)
+        self.buffer_size = int(buffer_size)
+        self.log = log
+
+        self.files = []
+        self._file = None
+        self._raw = None
+        self._file_size = 0
+        self._file_time = 0
+        self._seq = 0
+
+        self._buffer = []
+        self._buffered = 0
+        self._pending_index = {}
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.index_path = os.path.join(path, prefix + ".index")
+        self.issues = self._load_index()
+        self._index = open(self.index_path, "a")
+
+    def _load_index(self):
+        issues = {}
+        if not os.path.exists(self.index_path):
+            return issues
+
+        with open(self.index_path) as f:
+            for line in f:
+                issue_id, _, cmnt_time = line.rstrip("\n").partition("\t")
+                if cmnt_time > issues.get(issue_id, ""):
+                    issues[issue_id] = cmnt_time
+
+        # compact it, only the latest time of each issue is needed
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.writelines("%s\t%s\n" % kv for kv in issues.items())
+        os.rename(tmp, self.index_path)
+
+        return issues
+
+    def _open(self):
+        self._seq += 1
+        name = "%s-%s-%d%s" % (
+            self.prefix,
+            time.strftime("%Y%m%dT%H%M%S"),
+            self._seq,
+            self.EXTENSIONS[self.compression],
+        )
+        fname = os.path.join(self.path, name)
+
+        self._raw = open(fname, "ab")
+        if self.compression == "gzip":
+            self._file = gzip.GzipFile(fileobj=self._raw, mode="ab")
+        elif self.compression == "zstd":
+            self._file = zstandard.ZstdCompressor().stream_writer(self._raw)
+        else:
+            self._file = self._raw
+
+        self._file_size = 0
+        self._file_time = time.time()
+        self.files.append(fname)
+        self.log.info("Dump file opened", file=fname)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+
+        self._file.close()
+        if self._file is not self._raw:
+            self._raw.close()
+        self._file = self._raw = None
+
+    def _write_block(self):
+        if not self._buffer:
+            return
+
+        if self._file is None or (
+            self._file_size >= self.rotate_size
+            or time.time() - self._file_time >= self.rotate_age
+        ):
+            self._close_file()
+            self._open()
+
+        block = "".join(self._buffer)
+        self._file.write(block)
+        self._file.flush()
+        self._file_size += len(block)
+
+        # the index only points at what is already in the files
+        self._index.writelines("%s\t%s\n" % kv for kv in self._pending_index.items())
+        self._index.flush()
+
+        self._buffer, self._buffered, self._pending_index = [], 0, {}
+
+    def insert_msg(self, record):
+        self.insert_many([record])
+
+    def insert_many(self, records):
+        """
+        Writes the records, a block every `buffer_size` bytes and the rest
+        at the end
+
+        :param records: list of dict
+
+        """
+        with self._lock:
+            for record in records:
+                if self._buffered >= self.buffer_size:
+                    self._write_block()
+
+                line = to_json(record) + "\n"
+                self._buffer.append(line)
+                self._buffered += len(line)
+
+                issue = record.get("issue")
+                if not issue:
+                    continue
+
+                issue_id = str(issue["id"])
+                cmnt_time = record.get("comment", {}).get(
+                    "updated_at", issue["created_at"]
+                )
+                if cmnt_time > self.issues.get(issue_id, ""):
+                    self.issues[issue_id] = cmnt_time
+                    self._pending_index[issue_id] = cmnt_time
+
+            self._write_block()
+
+        self.log.debug("Msgs written in file store", count=len(records))
+
+    def flush(self):
+        with self._lock:
+            self._write_block()
+
+    def check_issue_in_db(self, issue):
+        with self._lock:
+            last_cmnt_time = self.issues.get(str(issue["issue"]["id"]))
+
+        if last_cmnt_time is None:
+            return 0, 0
+
+        if issue["issue"]["updated_at"] != last_cmnt_time:
+            return 1, last_cmnt_time
+
+        return 1, 0
+
+    def ping(self):
+        return os.access(self.path, os.W_OK)
+
+    def close(self):
+        with self._lock:
+            self._write_block()
+            self._close_file()
+            self._index.close()
+
+
+class MemoryStore(object):
+    """
+    Keeps the serialized records in memory, for tests and benchmarks.
+
+    >>> store = MemoryStore()
+    >>> issue = {'id': 1, 'created_at': 'c', 'updated_at': 'u'}
+    >>> store.check_issue_in_db({'issue': issue})
+    (0, 0)
+    >>> store.insert_many([{'id': 'a', 'issue': issue, 'comment': {'updated_at': 'u'}}])
+    >>> store.check_issue_in_db({'issue': issue})
+    (1, 0)
+
+    """
+
+    def __init__(self, db_name="memory", log=DUMMY_LOG):
+        self.db_name = db_name
+        self.log = log
+        self.records = {}
+        self.issues = {}
+        self._lock = threading.Lock()
+
+    def insert_msg(self, record):
+        self.insert_many([record])
+
+    def insert_many(self, records):
+        with self._lock:
+            for record in records:
+                self.records[record["id"]] = to_json(record)
+
+                issue = record.get("issue")
+                if not issue:
+                    continue
+
+                cmnt_time = record.get("comment", {}).get(
+                    "updated_at", issue["created_at"]
+                )
+                last = self.issues.get(issue["id"])
+                if last is None or cmnt_time > last:
+                    self.issues[issue["id"]] = cmnt_time
+
+    def check_issue_in_db(self, issue):
+        with self._lock:
+            last_cmnt_time = self.issues.get(issue["issue"]["id"])
+
+        if last_cmnt_time is None:
+            return 0, 0
+
+        if issue["issue"]["updated_at"] != last_cmnt_time:
+            return 1, last_cmnt_time
+
+        return 1, 0
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
@@ -0,0 +1,259 @@
+import threading
+from bisect import bisect_left
+
+# seconds, from a fast target write to a slow repo pass
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def add_label(labels, name, value):
+    """
+    :param labels: string, formatted labels
+    :rtype: string, labels with name="value" added
+
+    >>> add_label('{status="200"}', 'shard', 1), add_label('', 'shard', 1)
+    ('{status="200",shard="1"}', '{shard="1"}')
+
+    """
+    extra = format_labels((name,), (value,))
+    if not labels:
+        return extra
+
+    return labels[:-1] + "," + extra[1:]
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    )
+
+
+class Metric(object):
+    """
+    A metric and its values by label values. Updates take one lock and a
+    dict lookup, cheap enough to leave on in production.
+
+    """
+
+    TYPE = None
+
+    def __init__(self, name, doc, labels=(), registry=None):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+        if registry is None:
+            registry = REGISTRY
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(labels[n] for n in self.labels)
+
+    def samples(self):
+        """
+        :rtype: list of (string, string, number) name suffix, labels, value
+
+        """
+        with self._lock:
+            values = list(self._values.items())
+
+        return [
+            ("", format_labels(self.labels, key), value)
+            for key, value in sorted(values)
+        ]
+
+
+class Counter(Metric):
+    """
+    >>> c = Counter('calls_total', 'calls', ('status',), registry=Registry())
+    >>> c.inc(status=200); c.inc(2, status=200)
+    >>> c.samples()
+    [('', '{status="200"}', 3)]
+
+    """
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    >>> g = Gauge('quota', 'quota', registry=Registry())
+    >>> g.set(10); g.set(4)
+    >>> g.samples()
+    [('', '', 4)]
+
+    """
+
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    >>> h = Histogram('seconds', 'seconds', buckets=(1, 5), registry=Registry())
+    >>> h.observe(0.5); h.observe(3); h.observe(10)
+    >>> [(s, l, v) for s, l, v in h.samples()]
+    [('_bucket', '{le="1"}', 1), ('_bucket', '{le="5"}', 2), ('_bucket', '{le="+Inf"}', 3), ('_sum', '', 13.5), ('_count', '', 3)]
+
+    """
+
+    TYPE = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, doc, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+
+        with self._lock:
+            h = self._values.get(key)
+            if h is None:
+                # per bucket counts (the last one is +Inf), sum
+                h = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            h[0][i] += 1
+            h[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(k, (list(c), s)) for k, (c, s) in self._values.items()]
+
+        samples = []
+        for key, (counts, total) in sorted(values):
+            count = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                count += n
+                labels = format_labels(
+                    self.labels, key, [("le", "%g" % le if le != "+Inf" else le)]
+                )
+                samples.append(("_bucket", labels, count))
+
+            labels = format_labels(self.labels, key)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+
+        return samples
+
+
+class Registry(object):
+    """
+    >>> r = Registry()
+    >>> c = Counter('calls_total', 'Api calls', registry=r)
+    >>> c.inc()
+    >>> print(r.expose())
+    # HELP calls_total Api calls
+    # TYPE calls_total counter
+    calls_total 1
+    <BLANKLINE>
+
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def snapshot(self):
+        """
+        The samples of every metric, to be exposed by another process
+
+        :rtype: dict, metric name: list of samples
+
+        """
+        return dict((m.name, m.samples()) for m in self.metrics)
+
+    def expose(self, shards=None):
+        """
+        The metrics in the prometheus text format
+
+        :param shards: dict, snapshots of other processes by shard number,
+                exposed with a shard label
+        :rtype: string
+
+        >>> r = Registry()
+        >>> c = Counter('calls_total', 'Api calls', registry=r)
+        >>> c.inc()
+        >>> print(r.expose({0: {'calls_total': [('', '', 5)]}}))
+        # HELP calls_total Api calls
+        # TYPE calls_total counter
+        calls_total 1
+        calls_total{shard="0"} 5
+        <BLANKLINE>
+
+        """
+        lines = []
+        for m in self.metrics:
+            lines.append("# HELP %s %s" % (m.name, m.doc))
+            lines.append("# TYPE %s %s" % (m.name, m.TYPE))
+            for suffix, labels, value in m.samples():
+                lines.append("%s%s%s %s" % (m.name, suffix, labels, value))
+
+            for shard, snapshot in sorted((shards or {}).items()):
+                for suffix, labels, value in snapshot.get(m.name, []):
+                    labels = add_label(labels, "shard", shard)
+                    lines.append("%s%s%s %s" % (m.name, suffix, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+WEBHOOK_REQUESTS = Counter(
+    "gitdump_webhook_requests_total", "Webhook requests by response status", ("status",)
+)
+RECORDS_WRITTEN = Counter(
+    "gitdump_records_written_total", "Records written by target", ("target",)
+)
+WRITE_ERRORS = Counter(
+    "gitdump_write_errors_total", "Failed batch writes by target", ("target",)
+)
+WRITE_SECONDS = Histogram(
+    "gitdump_write_seconds", "Seconds per batch write by target", ("target",)
+)
+API_CALLS = Counter(
+    "gitdump_github_api_calls_total", "Github api calls by response status", ("status",)
+)
+API_QUOTA_REMAINING = Gauge(
+    "gitdump_github_api_quota_remaining", "Api calls left until the quota resets"
+)
+API_QUOTA_LIMIT = Gauge("gitdump_github_api_quota_limit", "Api calls allowed per hour")
+RATE_LIMIT_SLEEP = Counter(
+    "gitdump_rate_limit_sleep_seconds_total", "Seconds spent waiting for api quota"
+)
+REPO_SYNC_SECONDS = Histogram(
+    "gitdump_repo_sync_seconds", "Seconds per history pass of one repo", ("mode",)
+)
+REPO_LAST_SYNC_TIME = Gauge(
+    "gitdump_repo_last_sync_timestamp_seconds",
+    "Epoch the last history pass of a repo finished",
+)
+TARGET_LAG_SECONDS = Gauge(
+    "gitdump_target_lag_seconds",
+    "Seconds the oldest record not yet written to the target has waited",
+    ("target",),
+)
+TARGET_QUEUED = Gauge(
+    "gitdump_target_queued_records", "Records queued for the target", ("target",)
+)
+TARGET_SPOOLED = Gauge(
+    "gitdump_target_spooled_records",
+    "Records spooled on disk until the target takes them",
+    ("target",),
+)
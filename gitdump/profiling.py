@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+from collections import defaultdict
+
+from deeputil import Dummy
+
+DUMMY_LOG = Dummy()
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    __slots__ = ("timer", "name", "start", "children")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.timer._stack().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.time() - self.start
+        stack = self.timer._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+
+        self.timer.add(self.name, elapsed, elapsed - self.children)
+        return False
+
+
+class StageTimer(object):
+    """
+    Wall time and call counts of the stages of a history pass, in total
+    and per repo, summed over the threads. Stages nest: `seconds` includes
+    the stages called from it in the same thread, `self_seconds` doesn't; a
+    stage that waits on other threads (eg: repo on the issue workers)
+    counts the wait as its own.
+
+    Disabled (the default) `stage` returns a shared no-op context manager.
+
+    >>> timer = StageTimer(enabled=True)
+    >>> with timer.repo('org/repo'):
+    ...     with timer.stage('get_issues'):
+    ...         with timer.stage('github_api'):
+    ...             pass
+    ...
+    >>> report = timer.report()
+    >>> sorted(report['stages']), report['stages']['get_issues']['calls']
+    (['get_issues', 'github_api'], 1)
+    >>> sorted(report['repos']['org/repo'])
+    ['get_issues', 'github_api']
+    >>> StageTimer().stage('get_issues') is NO_STAGE
+    True
+
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (repo, stage) -> [calls, seconds, self seconds]
+            self._stats = defaultdict(lambda: [0, 0.0, 0.0])
+            self._since = time.time()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def stage(self, name):
+        """
+        :param name: string
+        :rtype: context manager timing the stage
+
+        """
+        if not self.enabled:
+            return NO_STAGE
+
+        return _Stage(self, name)
+
+    def repo(self, name):
+        """
+        Attributes the stages run in this thread to the repo
+
+        :param name: string, repo full name
+        :rtype: context manager
+
+        """
+        if not self.enabled:
+            return NO_STAGE
+
+        return _Repo(self, name)
+
+    def add(self, name, seconds, self_seconds):
+        key = (getattr(self._local, "repo", None), name)
+        with self._lock:
+            s = self._stats[key]
+            s[0] += 1
+            s[1] += seconds
+            s[2] += self_seconds
+
+    def wrap(self, obj, attr, name):
+        """
+        Times every call of obj.attr as the stage
+
+        """
+        if not self.enabled:
+            return
+
+        fn = getattr(obj, attr)
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+
+        setattr(obj, attr, timed)
+
+    def timed_iter(self, name, iterable):
+        """
+        Times the fetching of every item of a lazy listing as the stage
+
+        :rtype: iterator
+
+        """
+        if not self.enabled:
+            return iter(iterable)
+
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name, iterable):
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def report(self):
+        """
+        :rtype: dict the stages, totals over all repos and per repo
+
+        """
+        with self._lock:
+            stats = dict((k, list(v)) for k, v in self._stats.items())
+            elapsed = time.time() - self._since
+
+        def entry(calls, seconds, self_seconds):
+            return dict(
+                calls=calls,
+                seconds=round(seconds, 4),
+                self_seconds=round(self_seconds, 4),
+                ms_per_call=round(seconds * 1000.0 / calls, 3) if calls else 0.0,
+            )
+
+        totals = defaultdict(lambda: [0, 0.0, 0.0])
+        repos = defaultdict(dict)
+        for (repo, name), s in stats.items():
+            t = totals[name]
+            for i in range(3):
+                t[i] += s[i]
+            if repo is not None:
+                repos[repo][name] = entry(*s)
+
+        return dict(
+            seconds=round(elapsed, 4),
+            stages=dict((name, entry(*s)) for name, s in totals.items()),
+            repos=dict(repos),
+        )
+
+    def write_report(self, path, log=DUMMY_LOG):
+        """
+        Logs the stage totals and writes the full report as json
+
+        :param path: string
+        :rtype: dict the report
+
+        """
+        report = self.report()
+        slowest = sorted(
+            report["stages"].items(), key=lambda kv: kv[1]["self_seconds"], reverse=True
+        )
+        log.info(
+            "Profile of the history pass",
+            seconds=report["seconds"],
+            report=path,
+            stages=[
+                "%s calls=%d self=%.3fs total=%.3fs"
+                % (name, s["calls"], s["self_seconds"], s["seconds"])
+                for name, s in slowest
+            ],
+        )
+
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        return report
+
+
+class _Repo(object):
+    __slots__ = ("timer", "name", "previous")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(self.timer._local, "repo", None)
+        self.timer._local.repo = self.name
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._local.repo = self.previous
+        return False
+
+
+def frame_stack(frame):
+    """
+    :rtype: string, the frames from the outermost as file:function;...
+
+    >>> 'frame_stack' in frame_stack(sys._getframe())
+    True
+
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+
+    return ";".join(reversed(stack))
+
+
+class StackSampler(object):
+    """
+    Samples the stacks of every thread every `interval` seconds and writes
+    them in the collapsed format flamegraph.pl and speedscope read ("frame;
+    frame;... count" lines). Unlike cProfile it sees all the crawl, writer
+    and webhook threads, at a cost set by the interval.
+
+    >>> import tempfile
+    >>> sampler = StackSampler(interval=0.001)
+    >>> sampler.start()
+    >>> time.sleep(0.05)
+    >>> path = sampler.stop(tempfile.mkdtemp())
+    >>> sampler.samples > 0 and path.endswith('.folded')
+    True
+
+    """
+
+    def __init__(self, interval=0.005, log=DUMMY_LOG):
+        self.interval = interval
+        self.log = log
+
+        self.samples = 0
+        self._stacks = defaultdict(int)
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _run(self):
+        me = threading.current_thread().ident
+        names = {}
+        while not self._stop.wait(self.interval):
+            for th in threading.enumerate():
+                names[th.ident] = th.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = "%s;%s" % (names.get(ident, ident), frame_stack(frame))
+                self._stacks[stack] += 1
+            self.samples += 1
+
+    def start(self):
+        self._stop.clear()
+        self._stacks = defaultdict(int)
+        self.samples = 0
+
+        self._thread = threading.Thread(target=self._run, name="stack-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+        self.log.info("Stack sampling started", interval=self.interval)
+
+    def stop(self, directory):
+        """
+        Stops sampling and writes the stacks
+
+        :param directory: string
+        :rtype: string, the file written
+
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+        path = os.path.join(
+            directory,
+            "gitdump-%d-%s.folded" % (os.getpid(), time.strftime("%Y%m%dT%H%M%S")),
+        )
+        with open(path, "w") as f:
+            for stack, count in sorted(self._stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+
+        self.log.info("Stack samples written", path=path, samples=self.samples)
+        return path
+
+
+def toggle_on_signal(sampler, directory, signum=signal.SIGUSR2, log=DUMMY_LOG):
+    """
+    The signal starts the sampler, the next one stops it and writes its
+    stacks to the directory, eg: kill -USR2 <pid>
+
+    """
+
+    def toggle(signum, frame):
+        if sampler.running:
+            # written off the signal handler, which runs on the main thread
+            th = threading.Thread(target=sampler.stop, args=(directory,))
+            th.daemon = True
+            th.start()
+        else:
+            sampler.start()
+
+    signal.signal(signum, toggle)
+    log.info("Stack sampling toggled by signal", signal=signum, directory=directory)
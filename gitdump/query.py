@@ -0,0 +1,178 @@
+import json
+import base64
+import threading
+
+from deeputil import Dummy
+
+from util import TTLCache
+
+DUMMY_LOG = Dummy()
+
+
+def encode_cursor(cursor):
+    """
+    :param cursor: tuple or None
+    :rtype: string or None
+
+    >>> decode_cursor(encode_cursor((12,)))
+    (12,)
+
+    """
+    if cursor is None:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps(list(cursor)))
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: string from encode_cursor
+    :rtype: tuple
+    :raises ValueError: when the cursor is not one of ours
+
+    >>> decode_cursor('nope')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid cursor
+
+    """
+    try:
+        return tuple(json.loads(base64.urlsafe_b64decode(str(cursor))))
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor")
+
+
+class QueryService(object):
+    """
+    Read side over a store that implements query_issues, query_comments
+    and query_since (SQLiteStore, MongoStore).
+
+    Pages of a repo's issues and of an issue's comments are kept in an LRU
+    cache; `invalidate` (called by GithubHistory after every write) drops
+    those of the repos and issues a batch of records touched.
+
+    >>> class Store(object):
+    ...     calls = 0
+    ...     def query_comments(self, repo, number, after=0, limit=100):
+    ...         self.calls += 1
+    ...         return ['{"id": "a"}'], None
+    ...
+    >>> q = QueryService(Store())
+    >>> q.comments('org/repo', 1)
+    (['{"id": "a"}'], None)
+    >>> q.comments('org/repo', 1) and q.store.calls
+    1
+    >>> q.invalidate([{'repository': {'full_name': 'org/repo'}, 'issue': {'number': 1}}])
+    >>> q.comments('org/repo', 1) and q.store.calls
+    2
+
+    """
+
+    def __init__(self, store, cache_size=1000, cache_ttl=60, log=DUMMY_LOG):
+        self.store = store
+        self.log = log
+
+        # (kind, repo[, issue number]) -> {(cursor, limit): page}
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, key, page, fn, *args):
+        pages = self.cache.get(key)
+        if pages is not None and page in pages:
+            return pages[page]
+
+        with self._lock:
+            writes = self._writes
+
+        result = fn(*args)
+
+        # a write that landed while the store was read may not be in the
+        # result, so it isn't cached
+        with self._lock:
+            if writes == self._writes:
+                pages = dict(pages or {})
+                pages[page] = result
+                self.cache.set(key, pages)
+
+        return result
+
+    def issues(self, repo, cursor=None, limit=100):
+        """
+        :param repo: string, repo full name
+        :param cursor: string, from the previous page
+        :param limit: int
+        :rtype: (list of string, string or None) json records, next cursor
+
+        """
+        after = decode_cursor(cursor) if cursor else (0,)
+        records, next_cursor = self._cached(
+            ("issues", repo),
+            (cursor, limit),
+            self.store.query_issues,
+            repo,
+            after[0],
+            limit,
+        )
+        return records, encode_cursor(next_cursor)
+
+    def comments(self, repo, number, cursor=None, limit=100):
+        """
+        :param repo: string, repo full name
+        :param number: int, issue number
+        :param cursor: string, from the previous page
+        :param limit: int
+        :rtype: (list of string, string or None)
+
+        """
+        after = decode_cursor(cursor) if cursor else (0,)
+        records, next_cursor = self._cached(
+            ("comments", repo, number),
+            (cursor, limit),
+            self.store.query_comments,
+            repo,
+            number,
+            after[0],
+            limit,
+        )
+        return records, encode_cursor(next_cursor)
+
+    def since(self, since, cursor=None, limit=100):
+        """
+        Not cached, it changes with every write
+
+        :param since: string, eg: '2018-02-15T09:17:49Z'
+        :param cursor: string, from the previous page
+        :param limit: int
+        :rtype: (list of string, string or None)
+
+        """
+        if cursor:
+            since, after = decode_cursor(cursor)
+        else:
+            after = ""
+
+        records, next_cursor = self.store.query_since(since, after, limit)
+        return records, encode_cursor(next_cursor)
+
+    def invalidate(self, records):
+        """
+        Drops the cached pages of the repos and issues of the records
+
+        :param records: list of dict
+
+        """
+        with self._lock:
+            self._writes += 1
+
+        keys = set()
+        for record in records:
+            repo = (record.get("repository") or {}).get("full_name")
+            number = (record.get("issue") or {}).get("number")
+            keys.update([("issues", repo), ("comments", repo, number)])
+
+        for key in keys:
+            self.cache.delete(key)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,167 @@
+import time
+import threading
+
+from deeputil import Dummy
+
+from metrics import RATE_LIMIT_SLEEP
+
+DUMMY_LOG = Dummy()
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all the crawl workers.
+
+    The bucket refills at the rate that spreads the spendable quota
+    (remaining minus `reserve` calls kept for everything else) over the time
+    left until the quota resets, sped up by up to `boost` times while most
+    of the quota is unspent. As the quota runs low the rate falls smoothly
+    towards the even spread instead of spending everything and stalling.
+
+    `quota` returns (remaining, limit, reset epoch seconds), eg: from
+    `Github.rate_limiting` and `Github.rate_limiting_resettime`. Those are
+    only updated by api responses, so once the reset time has passed the
+    quota is taken to be full again rather than waiting on figures that no
+    call will ever bring.
+
+    >>> quota = lambda: (5000, 5000, time.time() + 3600)
+    >>> rl = RateLimiter(quota, reserve=100, burst=2)
+    >>> round(rl.rate(), 1)
+    13.4
+    >>> rl.acquire(), rl.acquire()
+    (True, True)
+    >>> rl.slept
+    0.0
+    >>> rl.quota = lambda: (600, 5000, time.time() + 3600)
+    >>> round(rl.rate(), 2)
+    0.26
+
+    """
+
+    def __init__(self, quota, reserve=100, burst=10, boost=10, log=DUMMY_LOG):
+        self.quota = quota
+        self.reserve = reserve
+        self.burst = burst
+        self.boost = boost
+        self.log = log
+
+        self.tokens = float(burst)
+        self.slept = 0.0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def current(self):
+        """
+        The quota as it stands now
+
+        :rtype: (int, int, float) remaining, limit and reset epoch seconds
+
+        >>> rl = RateLimiter(lambda: (0, 5000, time.time() - 5))
+        >>> remaining, limit, reset = rl.current()
+        >>> remaining, limit, reset > time.time()
+        (5000, 5000, True)
+
+        """
+        remaining, limit, reset = self.quota()
+        now = time.time()
+        if reset <= now:
+            # reset since it was last seen, spend from a fresh hourly quota
+            # until the next response brings the real figures
+            remaining, reset = limit, now + 3600
+
+        return remaining, limit, reset
+
+    def rate(self):
+        """
+        Calls per second that can be spent now
+
+        :rtype: float
+
+        """
+        remaining, limit, reset = self.current()
+        window = max(reset - time.time(), 1.0)
+        spendable = max(remaining - self.reserve, 0)
+        unspent = float(spendable) / max(limit, 1)
+
+        return spendable / window * (1 + (self.boost - 1) * unspent)
+
+    def _refill(self, now):
+        rate = self.rate()
+        self.tokens = min(self.tokens + (now - self._last) * rate, self.burst)
+        self._last = now
+        return rate
+
+    def try_acquire(self):
+        """
+        Takes one call from the bucket if it can be made now
+
+        :rtype: float, 0 when the call was taken, otherwise seconds to wait
+                before trying again
+
+        >>> rl = RateLimiter(lambda: (0, 5000, time.time() + 30), burst=1)
+        >>> rl.try_acquire()
+        0.0
+        >>> round(rl.try_acquire())
+        30.0
+
+        Running out of quota only lasts until the reset time
+
+        >>> rl = RateLimiter(lambda: (50, 5000, time.time() - 5), burst=1)
+        >>> rl.try_acquire()
+        0.0
+        >>> rl.try_acquire() < 1
+        True
+
+        """
+        with self._lock:
+            now = time.time()
+            rate = self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+
+            if rate > 0:
+                delay = (1 - self.tokens) / rate
+            else:
+                # nothing left to spend, wait for the quota to reset
+                delay = max(self.current()[2] - now, 1.0)
+
+        # waits are short steps so a refreshed quota is picked up quickly
+        return min(delay, 60.0)
+
+    def waited(self, delay):
+        """
+        Accounts for time spent waiting for quota
+
+        :param delay: float, seconds
+
+        """
+        self.log.debug("waiting for api quota", delay=delay)
+        RATE_LIMIT_SLEEP.inc(delay)
+
+        with self._lock:
+            self.slept += delay
+
+    def acquire(self, stop=None):
+        """
+        Blocks until one api call can be made
+
+        :param stop: threading.Event, ends the wait early once it is set
+        :rtype: bool, False when stopped before the call could be made
+
+        >>> stop = threading.Event()
+        >>> stop.set()
+        >>> RateLimiter(lambda: (0, 5000, time.time() + 30), burst=0).acquire(stop)
+        False
+
+        """
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return True
+
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                return False
+            self.waited(delay)
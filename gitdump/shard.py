@@ -0,0 +1,182 @@
+import time
+import hashlib
+import threading
+from Queue import Empty
+from multiprocessing import Process, Queue
+
+from deeputil import Dummy
+
+import metrics
+
+DUMMY_LOG = Dummy()
+
+
+def shard_of(name, shards):
+    """
+    The shard a repo belongs to, the same in every process and run
+
+    :param name: string, repo full name
+    :param shards: int
+    :rtype: int
+
+    >>> shard_of('deep-compute/githubdump', 4)
+    0
+    >>> shard_of('deep-compute/githubdump', 1)
+    0
+
+    """
+    if shards <= 1:
+        return 0
+
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest()[:8], 16) % shards
+
+
+class ShardCoordinator(object):
+    """
+    Runs the history sync in `shards` worker processes and merges their
+    progress.
+
+    `target(shard, shards, progress)` runs in each process; it syncs the
+    repos of its shard and calls `progress(**info)` to report them, which
+    the coordinator collects into `stats`. The workers' metrics come with
+    every report and at least every `metrics_interval` seconds, and are
+    kept by `metrics`.
+
+    >>> def sync(shard, shards, progress):
+    ...     progress(repo='org/repo%d' % shard, records=10)
+    ...
+    >>> c = ShardCoordinator(sync, 2)
+    >>> c.start()
+    >>> c.join()
+    >>> c.stats()['records'], c.is_alive()
+    (20, False)
+    >>> sorted(c.metrics())
+    [0, 1]
+
+    """
+
+    def __init__(self, target, shards, metrics_interval=10, log=DUMMY_LOG):
+        self.target = target
+        self.shards = shards
+        self.metrics_interval = metrics_interval
+        self.log = log
+
+        self.processes = []
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._shards = dict(
+            (i, dict(repos=0, records=0, last_repo=None, done=False))
+            for i in range(shards)
+        )
+
+    def _run(self, shard):
+        def progress(**info):
+            info["shard"] = shard
+            info["metrics"] = metrics.REGISTRY.snapshot()
+            self._queue.put(info)
+
+        # a long repo still shows up in the metrics while it's synced
+        def report():
+            while True:
+                time.sleep(self.metrics_interval)
+                progress()
+
+        th = threading.Thread(target=report)
+        th.daemon = True
+        th.start()
+
+        try:
+            self.target(shard, self.shards, progress)
+        finally:
+            progress(done=True)
+
+    def start(self):
+        # the processes are forked before the coordinator starts its thread
+        for i in range(self.shards):
+            p = Process(target=self._run, args=(i,), name="gitdump-shard-%d" % i)
+            p.daemon = True
+            p.start()
+            self.processes.append(p)
+
+        self._thread = threading.Thread(target=self._collect)
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.log.info("Shard workers started", shards=self.shards)
+
+    def _collect(self):
+        while True:
+            try:
+                info = self._queue.get(timeout=1)
+            except Empty:
+                if not self.is_alive():
+                    return
+                continue
+
+            with self._lock:
+                self._metrics[info["shard"]] = info.pop("metrics", {})
+                s = self._shards[info["shard"]]
+                if info.get("done"):
+                    s["done"] = True
+                    self.log.info("Shard worker done", shard=info["shard"], **s)
+                    continue
+
+                # metrics only
+                if "repo" not in info:
+                    continue
+
+                s["repos"] += 1
+                s["records"] = info.get("records", s["records"])
+                s["last_repo"] = info.get("repo")
+
+    def is_alive(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def join(self):
+        for p in self.processes:
+            p.join()
+
+        if self._thread:
+            self._thread.join()
+
+    def stop(self, timeout=30):
+        """
+        Asks the workers to stop (SIGTERM) and waits for them to write
+        what they have buffered
+
+        """
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+
+        deadline = time.time() + timeout
+        for p in self.processes:
+            p.join(max(deadline - time.time(), 0))
+
+    def metrics(self):
+        """
+        :rtype: dict, the metrics snapshot each worker last reported, by
+                shard
+
+        """
+        with self._lock:
+            return dict(self._metrics)
+
+    def stats(self):
+        """
+        :rtype: dict totals and per shard progress
+
+        """
+        with self._lock:
+            shards = dict((i, dict(s)) for i, s in self._shards.items())
+
+        for i, p in enumerate(self.processes):
+            shards[i]["alive"] = p.is_alive()
+
+        return dict(
+            repos=sum(s["repos"] for s in shards.values()),
+            records=sum(s["records"] for s in shards.values()),
+            shards=shards,
+        )
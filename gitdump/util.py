@@ -1,4 +1,9 @@
+import json
+import time
+import hashlib
+import threading
 from operator import attrgetter
+from collections import OrderedDict
 
 
 def memoize(f):
@@ -22,3 +27,154 @@ def load_object(imp_path):
     module = __import__(module_name)
     obj = attrgetter(obj_name)(module)
     return obj
+
+
+class TTLCache(object):
+    """
+    Thread safe LRU cache whose entries also expire after `ttl` seconds
+
+    >>> c = TTLCache(maxsize=2, ttl=60)
+    >>> c.set('a', 1)
+    >>> c.set('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.set('c', 3)
+    >>> c.get('b') is None
+    True
+    >>> c.stats()
+    {'hits': 1, 'misses': 1, 'size': 2}
+
+    """
+
+    def __init__(self, maxsize=1000, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.misses += 1
+                return default
+
+            # re-insert to mark as most recently used
+            self._data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] >= time.time()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class Record(dict):
+    """
+    Read-only record handed to every target. Targets share it instead of
+    getting their own copy, and its json encoding is done once and shared.
+
+    >>> r = Record({'id': 'abc'})
+    >>> r.json
+    '{"id": "abc"}'
+    >>> r['id'] = 'x'
+    Traceback (most recent call last):
+    ...
+    TypeError: Record is read-only
+
+    """
+
+    __slots__ = ("_json",)
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Record is read-only")
+
+    __setitem__ = __delitem__ = _readonly
+    update = setdefault = pop = popitem = clear = _readonly
+
+    def __reduce__(self):
+        return (Record, (dict(self),))
+
+    @property
+    def json(self):
+        try:
+            return self._json
+        except AttributeError:
+            self._json = json.dumps(self)
+            return self._json
+
+
+def to_json(record):
+    """
+    :param record: dict or Record
+    :rtype: string
+
+    >>> to_json({'id': 1})
+    '{"id": 1}'
+
+    """
+    if isinstance(record, Record):
+        return record.json
+
+    return json.dumps(record)
+
+
+def record_key(record):
+    """
+    Key of a record: the github ids of what it is about (repo id, issue
+    number, comment id) and the versions (updated_at) of the issue and the
+    comment, or of the repo when there is no issue.
+
+    Two records only share a key when they are the same version of the same
+    object, so an edit to one comment never replaces another and a change to
+    the repo alone doesn't re-key every issue and comment in it.
+
+    :param record: dict
+    :rtype: string
+
+    >>> repo = {'id': 1, 'updated_at': 'r1'}
+    >>> issue = {'number': 2, 'updated_at': 'i1'}
+    >>> k = record_key({'repository': repo, 'issue': issue, 'comment': {'id': 3, 'updated_at': 'c1'}})
+    >>> k
+    '70032eff88276c5ca0513fc3b7a04a17af6b3555'
+    >>> k == record_key({'repository': repo, 'issue': issue, 'comment': {'id': 4, 'updated_at': 'c1'}})
+    False
+    >>> k == record_key({'repository': dict(repo, updated_at='r2'), 'issue': issue, 'comment': {'id': 3, 'updated_at': 'c1'}})
+    True
+
+    """
+    repo = record.get("repository") or {}
+    issue = record.get("issue") or {}
+    comment = record.get("comment") or {}
+
+    key = "%s/%s/%s@%s/%s" % (
+        repo.get("id", ""),
+        issue.get("number", ""),
+        comment.get("id", ""),
+        issue.get("updated_at", "") if issue else repo.get("updated_at", ""),
+        comment.get("updated_at", ""),
+    )
+
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
@@ -1,12 +1,36 @@
 import doctest
 import unittest
 
-from gitdump import githubhistory
+from gitdump import (
+    asynccrawler,
+    checkpoint,
+    dedup,
+    fanout,
+    githubhistory,
+    graphqlengine,
+)
+from gitdump import httpcache, ingest, logutil, messagestore, metrics, query, ratelimit
+from gitdump import profiling, shard, util
 
 
 def suitefn():
     suite = unittest.TestSuite()
+    suite.addTests(doctest.DocTestSuite(asynccrawler))
+    suite.addTests(doctest.DocTestSuite(checkpoint))
+    suite.addTests(doctest.DocTestSuite(dedup))
+    suite.addTests(doctest.DocTestSuite(fanout))
     suite.addTests(doctest.DocTestSuite(githubhistory))
+    suite.addTests(doctest.DocTestSuite(graphqlengine))
+    suite.addTests(doctest.DocTestSuite(httpcache))
+    suite.addTests(doctest.DocTestSuite(ingest))
+    suite.addTests(doctest.DocTestSuite(logutil))
+    suite.addTests(doctest.DocTestSuite(messagestore))
+    suite.addTests(doctest.DocTestSuite(metrics))
+    suite.addTests(doctest.DocTestSuite(profiling))
+    suite.addTests(doctest.DocTestSuite(query))
+    suite.addTests(doctest.DocTestSuite(ratelimit))
+    suite.addTests(doctest.DocTestSuite(shard))
+    suite.addTests(doctest.DocTestSuite(util))
     return suite
 
 